@@ -5,9 +5,9 @@ Created on Aug 26, 2017
 
 This module contains information to populate the test database.
 '''
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from catalog_database_setup import Base, User, Pantry, Category, Item, create_db
+from db_engine import make_engine
 
 class MockDB(object):
 
@@ -47,7 +47,7 @@ class MockDB(object):
         information contained in this class.
         '''
         create_db(testing=True)
-        engine = create_engine('sqlite:///test_item_catalog.db')
+        engine = make_engine(testing=True)
         Base.metadata.bind = engine
         session_maker = sessionmaker(bind=engine)
         session = session_maker()
@@ -0,0 +1,403 @@
+'''
+This module contains in-process caches used by the application to avoid
+repeating the same database queries on every request. LRUCache is a general
+purpose cache with a time to live. AuthCache uses it to remember which user
+belongs to an email address and which pantries a user may access.
+ObjectCache stores model objects looked up by id in an LRUCache or in any
+memcached compatible client. NameIndex keeps the category and item names of
+pantries sorted for prefix lookups.
+'''
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''Least recently used cache whose entries expire after a time to live.
+    The get, set and delete methods follow the memcached client interface, so
+    a memcached client can be used anywhere an LRUCache is expected. As with
+    memcached, None cannot be stored because get returns None on a miss.
+    '''
+    def __init__(self, max_size=1024, ttl=300):
+        '''
+        @param max_size: number of entries kept before the least recently
+        used entry is evicted
+        @param ttl: default number of seconds an entry stays valid
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Return the value stored for key, or None if it is missing or has
+        expired.
+        @param key: hashable cache key
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < _now():
+                self.misses += 1
+                return None
+            # re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, time=0):
+        '''Store value under key, evicting the least recently used entry if
+        the cache is full.
+        @param key: hashable cache key
+        @param value: any value other than None
+        @param time: seconds before the entry expires, 0 uses the cache ttl
+        '''
+        expires = _now() + (time or self.ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        '''Remove key from the cache if present.
+        @param key: hashable cache key
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+        return True
+
+    def delete_matching(self, predicate):
+        '''Remove every entry whose key satisfies predicate. This scans the
+        whole cache, so it is intended for infrequent invalidations only.
+        @param predicate: function taking a key and returning a boolean
+        '''
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        '''Remove all entries and reset the hit and miss counters.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def _now():
+    '''Current time in seconds, used for entry expiry.
+    '''
+    return time.time()
+
+
+class AuthCache(object):
+    '''Caches the data the login and authorization decorators need so an
+    authorized request does not query the database in the steady state.
+    users maps an email address to whatever DBInterface stores for that
+    user. access maps (user_id, pantry_id) to a boolean telling whether the
+    user may access the pantry.
+    DBInterface calls the invalidate methods whenever users, pantries or
+    pantry access rows are written.
+    '''
+    def __init__(self, max_size=4096, ttl=300):
+        self.users = LRUCache(max_size, ttl)
+        self.access = LRUCache(max_size, ttl)
+
+    def get_user(self, email):
+        return self.users.get(email)
+
+    def set_user(self, email, user):
+        self.users.set(email, user)
+
+    def get_access(self, user_id, pantry_id):
+        '''Return True or False if the check is cached, otherwise None.
+        '''
+        return self.access.get((user_id, pantry_id))
+
+    def set_access(self, user_id, pantry_id, allowed):
+        self.access.set((user_id, pantry_id), bool(allowed))
+
+    def invalidate_user(self, email, user_id):
+        '''Forget the user stored for email and every access check made for
+        the user.
+        '''
+        self.users.delete(email)
+        self.access.delete_matching(lambda key: key[0] == user_id)
+
+    def invalidate_pantry(self, pantry_id):
+        '''Forget every access check made against this pantry.
+        '''
+        self.access.delete_matching(lambda key: key[1] == pantry_id)
+
+    def clear(self):
+        self.users.clear()
+        self.access.clear()
+
+
+class ObjectCache(object):
+    '''Read-through cache of model objects keyed by class name and id. What
+    is stored for an object is up to DBInterface, which keeps the cache
+    consistent with its write methods. Hits and misses are counted here, so
+    they are available whatever the backend.
+    '''
+    def __init__(self, backend=None, ttl=0):
+        '''
+        @param backend: LRUCache or memcached compatible client, by default a
+        new LRUCache
+        @param ttl: seconds an entry stays valid, 0 uses the backend default
+        '''
+        self.backend = backend if backend is not None else LRUCache()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(class_name, obj_id):
+        # memcached keys are strings without spaces
+        return '%s:%d' % (class_name, obj_id)
+
+    def get(self, class_name, obj_id):
+        '''Return what is stored for the object, or None on a miss.
+        '''
+        value = self.backend.get(self._key(class_name, obj_id))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, class_name, obj_id, value):
+        self.backend.set(self._key(class_name, obj_id), value, self.ttl)
+
+    def delete(self, class_name, obj_id):
+        self.backend.delete(self._key(class_name, obj_id))
+
+    def delete_many(self, class_name, obj_ids):
+        '''Remove the entries of several objects of a class, in one request
+        if the backend supports it.
+        '''
+        keys = [self._key(class_name, obj_id) for obj_id in obj_ids]
+        delete_multi = getattr(self.backend, 'delete_multi', None)
+        if delete_multi is not None:
+            delete_multi(keys)
+        else:
+            for key in keys:
+                self.backend.delete(key)
+
+    def clear(self):
+        '''Remove every entry. The hit and miss counters are kept.
+        '''
+        flush_all = getattr(self.backend, 'flush_all', None)
+        if flush_all is not None:
+            flush_all()
+        else:
+            self.backend.clear()
+
+    def stats(self):
+        '''Return a dict of the hit and miss counters.
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits' : self.hits,
+                    'misses' : self.misses,
+                    'hit_ratio' : float(self.hits) / lookups if lookups
+                                  else 0.0}
+
+
+class NameIndex(object):
+    '''Sorted category and item names of recently used pantries, so names
+    starting with a prefix are found with a binary search instead of a LIKE
+    query. Each pantry entry records the pantry version it is current for.
+    DBInterface rebuilds an entry when the pantry version has moved on, and
+    applies the writes it commits to the entries in place, advancing their
+    version to the one each write committed, so pantries written through
+    this process are not rebuilt. A write made by another process leaves the
+    entry behind the pantry version and it is rebuilt on its next lookup.
+    Names are kept as (folded name, name, category id) tuples, the category
+    id being the id of the category itself or of the category of the item.
+    '''
+    KINDS = ('Category', 'Item')
+
+    def __init__(self, max_size=256):
+        '''
+        @param max_size: number of pantries kept before the least recently
+        used one is evicted
+        '''
+        self.max_size = max_size
+        # pantry id -> {'version' : int, 'Category' : list, 'Item' : list}
+        self._entries = OrderedDict()
+        # category id -> pantry id, for the pantries in the index
+        self._category_pantry = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _fold(name):
+        return name.lower()
+
+    def get_version(self, pantry_id):
+        '''Return the version the entry of the pantry is current for, or None
+        if the pantry is not in the index.
+        '''
+        with self._lock:
+            entry = self._entries.get(pantry_id)
+            return entry['version'] if entry is not None else None
+
+    def build(self, pantry_id, version, categories, items):
+        '''Replace the entry of a pantry.
+        @param pantry_id: int id of the pantry
+        @param version: the pantry version the names were read at
+        @param categories: iterable of (id, name) of the categories
+        @param items: iterable of (category id, name) of the items
+        '''
+        entry = {'version' : version,
+                 'Category' : sorted((self._fold(name), name, category_id)
+                                     for category_id, name in categories),
+                 'Item' : sorted((self._fold(name), name, category_id)
+                                 for category_id, name in items)}
+        with self._lock:
+            self._drop(pantry_id)
+            self._entries[pantry_id] = entry
+            for _, _, category_id in entry['Category']:
+                self._category_pantry[category_id] = pantry_id
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def complete(self, pantry_id, kind, prefix, limit):
+        '''Return the distinct names of a kind in a pantry starting with a
+        prefix, ignoring case, in alphabetical order.
+        @param pantry_id: int id of a pantry in the index
+        @param kind: 'Category' or 'Item'
+        @param prefix: the start of the name
+        @param limit: maximum number of names
+        @return: the list of names, or None if the pantry is not in the index
+        '''
+        prefix = self._fold(prefix)
+        names = []
+        with self._lock:
+            entry = self._entries.pop(pantry_id, None)
+            if entry is None:
+                return None
+            # re-insert to mark the entry as most recently used
+            self._entries[pantry_id] = entry
+            rows = entry[kind]
+            for position in xrange(bisect.bisect_left(rows, (prefix,)),
+                                   len(rows)):
+                folded, name, _ = rows[position]
+                if not folded.startswith(prefix) or len(names) == limit:
+                    break
+                if not names or names[-1] != name:
+                    names.append(name)
+        return names
+
+    def apply(self, writes):
+        '''Apply committed writes to the entries of the index. Each write
+        incremented the version of each pantry it touched once, as
+        DBInterface does, and comes with the versions it committed. A change
+        is a tuple of (kind, change, obj_id, parent_id, name, old_name) where
+        kind is 'Pantry', 'Category' or 'Item', change is 'add', 'update' or
+        'delete', obj_id may be None for a new object and old_name None when
+        the previous name is not known. An entry already at the committed
+        version was built after the commit and is left alone. An entry at
+        any other version than the one before, or that a change cannot be
+        applied to, is dropped.
+        @param writes: list of (versions, changes) tuples, in the order they
+        were made, where versions maps pantry ids to the version the write
+        gave them and changes is a list of changes
+        '''
+        with self._lock:
+            for versions, changes in writes:
+                touched = set()
+                for change in changes:
+                    pantry_id = self._apply(versions, *change)
+                    if pantry_id is not None:
+                        touched.add(pantry_id)
+                for pantry_id in touched:
+                    # the entry is gone if a later change dropped it
+                    if pantry_id in self._entries:
+                        self._entries[pantry_id]['version'] = \
+                            versions[pantry_id]
+
+    def _apply(self, versions, kind, change, obj_id, parent_id, name,
+               old_name):
+        '''Apply one change, returning the id of the pantry whose entry was
+        updated, or None.
+        '''
+        if kind == 'Pantry':
+            pantry_id = obj_id
+        elif kind == 'Category':
+            pantry_id = parent_id
+        else:
+            pantry_id = self._category_pantry.get(parent_id)
+        entry = self._entries.get(pantry_id)
+        if entry is None:
+            return None
+        version = versions.get(pantry_id)
+        if version is not None and entry['version'] >= version:
+            # read after the commit, the entry already holds the change
+            return None
+        if version is None or entry['version'] != version - 1:
+            self._drop(pantry_id)
+            return None
+        if kind == 'Pantry':
+            if change == 'delete':
+                self._drop(pantry_id)
+                return None
+            return pantry_id
+        category_id = obj_id if kind == 'Category' else parent_id
+        rows = entry[kind]
+        if change != 'add' and (old_name is None or not self._remove(
+                rows, (self._fold(old_name), old_name, category_id))):
+            self._drop(pantry_id)
+            return None
+        if change == 'delete' and kind == 'Category':
+            entry['Item'] = [row for row in entry['Item']
+                             if row[2] != category_id]
+            self._category_pantry.pop(category_id, None)
+        if change != 'delete':
+            if category_id is None:
+                self._drop(pantry_id)
+                return None
+            bisect.insort(rows, (self._fold(name), name, category_id))
+            if kind == 'Category':
+                self._category_pantry[category_id] = pantry_id
+        return pantry_id
+
+    @staticmethod
+    def _remove(rows, row):
+        '''Remove one occurrence of row from the sorted list rows.
+        @return: False if the row is not in the list
+        '''
+        position = bisect.bisect_left(rows, row)
+        if position == len(rows) or rows[position] != row:
+            return False
+        del rows[position]
+        return True
+
+    def drop(self, pantry_id):
+        '''Remove the entry of a pantry if present.
+        '''
+        with self._lock:
+            self._drop(pantry_id)
+
+    def _drop(self, pantry_id):
+        entry = self._entries.pop(pantry_id, None)
+        if entry is not None:
+            for _, _, category_id in entry['Category']:
+                self._category_pantry.pop(category_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._category_pantry.clear()
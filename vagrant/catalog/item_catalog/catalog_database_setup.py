@@ -7,10 +7,16 @@ Module defines the model schema and contains a function for creating the
 database when deploying the application.
 '''
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Table
+import datetime
+
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, \
+                       String, Table, func, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.expression import false
+from sqlalchemy import inspect
+from item_catalog.db_engine import make_engine
 
 Base = declarative_base()
 
@@ -18,7 +24,9 @@ Base = declarative_base()
 # many-to-many relationship
 pantry_access = Table('pantry_access', Base.metadata,
                       Column('user_id', Integer, ForeignKey('users.id')),
-                      Column('pantry_id', Integer, ForeignKey('pantry.id')))
+                      Column('pantry_id', Integer, ForeignKey('pantry.id')),
+                      Index('ix_pantry_access_user_id_pantry_id',
+                            'user_id', 'pantry_id'))
 
 class User(Base):
     '''Table holding information about users.
@@ -26,12 +34,17 @@ class User(Base):
     id - unique id for each user
     email - email address from OAuth2 provider
     children - pantries this user can access
+    deleted - true once the user is scheduled for deletion; the user can no
+    longer log in until a background job removes the user
     Deleting a user removes the user and all owned pantries from the database.
     '''
     __tablename__ = 'users'
+    __table_args__ = (Index('ix_users_email', 'email', unique=True),)
     name = Column(String(80), nullable = False)
     id = Column(Integer, primary_key = True)
     email = Column(String(80), nullable = False)
+    deleted = Column(Boolean, nullable=False, default=False,
+                     server_default=false())
     children = relationship('Pantry', secondary=pantry_access, backref='users')
     
     
@@ -46,12 +59,24 @@ class Pantry(Base):
     id - unique pantry id
     parent_id - user owner of this pantry (only one user owns this pantry)
     children - the categories associated with this pantry (one to many)
+    deleted - true once the pantry is scheduled for deletion; it is hidden
+    until a background job removes it and its children
+    version - incremented whenever the pantry, its categories or its items
+    change, used as the ETag of the pantry's JSON
+    modified - time of the last change counted by version
     Deleting a pantry removes the pantry and all children.
     '''
     __tablename__ = 'pantry'
+    # lookups by parent: listings ordered by id and duplicate name checks
+    __table_args__ = (Index('ix_pantry_parent_id_id', 'parent_id', 'id'),
+                      Index('ix_pantry_parent_id_name', 'parent_id', 'name'))
     name = Column(String(80), nullable = False)
     id = Column(Integer, primary_key = True)
     parent_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False,
+                     server_default=false())
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    modified = Column(DateTime, default=datetime.datetime.utcnow)
     children = relationship('Category', backref='parent',
                               cascade='all, delete-orphan')
     
@@ -73,14 +98,24 @@ class Category(Base):
     name - name of the category, not unique
     id - unique id of category
     parent_id - the pantry to which this category belongs
-    children - the list of items in this category
+    version - version of the pantry when this category was last written
+    updated_at - time this category was last written
+    children - the list of items in this category, ordered by id
     '''
     __tablename__ = 'category'
+    # lookups by parent: listings ordered by id, duplicate name checks and
+    # changes since a pantry version
+    __table_args__ = (Index('ix_category_parent_id_id', 'parent_id', 'id'),
+                      Index('ix_category_parent_id_name', 'parent_id', 'name'),
+                      Index('ix_category_parent_id_version', 'parent_id',
+                            'version'))
     name = Column(String(80), nullable = False)
     id = Column(Integer, primary_key = True)
     parent_id = Column(Integer, ForeignKey('pantry.id'), nullable=False)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
     children = relationship('Item', backref = 'parent',
-                         cascade='all, delete-orphan')
+                         cascade='all, delete-orphan', order_by='Item.id')
     
     def __init__(self, name, parent_id):
         self.name = name
@@ -105,14 +140,30 @@ class Item(Base):
     quantity - number of the item
     price - cost to purchase this item
     parent_id - id of the category to which this item belongs
+    version - version of the pantry when this item was last written
+    updated_at - time this item was last written
     '''
     __tablename__ = 'item'
+    # lookups by parent: listings ordered by id, duplicate name checks,
+    # changes since a pantry version and listings sorted or filtered by
+    # name, price or quantity, where the id orders equal values
+    __table_args__ = (Index('ix_item_parent_id_id', 'parent_id', 'id'),
+                      Index('ix_item_parent_id_name_id', 'parent_id', 'name',
+                            'id'),
+                      Index('ix_item_parent_id_version', 'parent_id',
+                            'version'),
+                      Index('ix_item_parent_id_price_id', 'parent_id',
+                            'price', 'id'),
+                      Index('ix_item_parent_id_quantity_id', 'parent_id',
+                            'quantity', 'id'))
     name = Column(String(80), nullable = False)
     id = Column(Integer, primary_key = True)
     description = Column(String(250))
     quantity = Column(Integer)
     price = Column(Integer)
     parent_id = Column(Integer, ForeignKey('category.id'), nullable=False)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     def __init__(self, name, description, quantity, price, parent_id):
         self.name = name
@@ -128,22 +179,284 @@ class Item(Base):
                 'description' : self.description,
                 'quantity' : self.quantity,
                 'price' : self.price,
-                'parent_id' : self.parent_id,
-                'purchaser' : self.purchaser
+                'parent_id' : self.parent_id
                 }
 
 
-def create_db(testing=False):
+class Job(Base):
+    '''Table holding background jobs that delete large objects in batches.
+    id - unique job id
+    kind - model class name of the object to delete, 'Pantry' or 'User'
+    target_id - id of the object to delete
+    user_id - the user who requested the job
+    status - 'pending', 'running', 'done' or 'failed'
+    progress - number of rows deleted so far
+    error - description of the error if the job failed
+    claimed - time a worker claimed the job or last reported progress, a
+    running job not heard of for longer than the lease is claimed again
+    created - time the job was scheduled
+    updated - time the job was last written
+    '''
+    __tablename__ = 'job'
+    # workers look for the oldest pending or abandoned running job
+    __table_args__ = (Index('ix_job_status_id', 'status', 'id'),)
+    id = Column(Integer, primary_key = True)
+    kind = Column(String(20), nullable = False)
+    target_id = Column(Integer, nullable = False)
+    user_id = Column(Integer)
+    status = Column(String(10), nullable = False, default='pending')
+    progress = Column(Integer, nullable = False, default=0)
+    error = Column(String(250))
+    claimed = Column(DateTime)
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+    updated = Column(DateTime, default=datetime.datetime.utcnow,
+                     onupdate=datetime.datetime.utcnow)
+
+    def __init__(self, kind, target_id, user_id):
+        self.kind = kind
+        self.target_id = target_id
+        self.user_id = user_id
+        self.status = 'pending'
+        self.progress = 0
+
+    @property
+    def serialize(self):
+        return {'id' : self.id,
+                'kind' : self.kind,
+                'target_id' : self.target_id,
+                'status' : self.status,
+                'progress' : self.progress,
+                'error' : self.error
+                }
+
+
+class PantryStats(Base):
+    '''Table holding inventory counters for each pantry, so the pantry index
+    does not aggregate items. DBInterface adjusts a pantry's row whenever it
+    writes a category or an item of the pantry; rebuild_pantry_stats
+    recomputes every row.
+    pantry_id - the pantry the counters belong to
+    category_count - number of categories in the pantry
+    item_count - number of items in the pantry
+    total_value - sum of quantity times price of the items in the pantry
+    '''
+    __tablename__ = 'pantry_stats'
+    pantry_id = Column(Integer, ForeignKey('pantry.id'), primary_key = True)
+    category_count = Column(Integer, nullable=False, default=0,
+                            server_default='0')
+    item_count = Column(Integer, nullable=False, default=0, server_default='0')
+    total_value = Column(Integer, nullable=False, default=0,
+                         server_default='0')
+
+    def __init__(self, pantry_id):
+        self.pantry_id = pantry_id
+        self.category_count = 0
+        self.item_count = 0
+        self.total_value = 0
+
+    @property
+    def serialize(self):
+        return {'pantry_id' : self.pantry_id,
+                'category_count' : self.category_count,
+                'item_count' : self.item_count,
+                'total_value' : self.total_value
+                }
+
+
+class Tombstone(Base):
+    '''Table recording deleted categories and items, so clients can sync a
+    pantry from a version without downloading all of it.
+    id - unique tombstone id
+    kind - model class name of the deleted object, 'Category' or 'Item'
+    object_id - id of the deleted object
+    pantry_id - the pantry the object belonged to
+    version - version of the pantry when the object was deleted
+    deleted_at - time the object was deleted
+    Deleting a category does not add tombstones for its items.
+    '''
+    __tablename__ = 'tombstone'
+    # changes since a pantry version
+    __table_args__ = (Index('ix_tombstone_pantry_id_version', 'pantry_id',
+                            'version'),)
+    id = Column(Integer, primary_key = True)
+    kind = Column(String(20), nullable = False)
+    object_id = Column(Integer, nullable = False)
+    pantry_id = Column(Integer, ForeignKey('pantry.id'), nullable=False)
+    version = Column(Integer, nullable = False)
+    deleted_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __init__(self, kind, object_id, pantry_id, version):
+        self.kind = kind
+        self.object_id = object_id
+        self.pantry_id = pantry_id
+        self.version = version
+
+    @property
+    def serialize(self):
+        return {'kind' : self.kind,
+                'id' : self.object_id,
+                'version' : self.version
+                }
+
+
+# Full text search of item names and descriptions. On PostgreSQL a GIN index
+# is built on the text search document of each item; DBAccessor.search_items
+# must use the same expression, with the columns prefixed by the table name,
+# for the index to be used. On SQLite the words are kept in an FTS5 table
+# that triggers on the item table keep in sync, including with bulk inserts
+# and deletes. Other databases search without an index.
+ITEM_DOCUMENT = "to_tsvector('english', coalesce({0}name, '') || ' ' || " \
+                "coalesce({0}description, ''))"
+
+SEARCH_INDEX_DDL = {
+    'postgresql' : ["CREATE INDEX IF NOT EXISTS ix_item_search ON item "
+                    "USING gin (%s)" % ITEM_DOCUMENT.format('')],
+    'sqlite' : ["CREATE VIRTUAL TABLE IF NOT EXISTS item_search USING "
+                "fts5(name, description, content='item', content_rowid='id', "
+                "tokenize='porter unicode61')",
+                "CREATE TRIGGER IF NOT EXISTS item_search_insert AFTER INSERT "
+                "ON item BEGIN "
+                "INSERT INTO item_search(rowid, name, description) "
+                "VALUES (new.id, new.name, new.description); END",
+                "CREATE TRIGGER IF NOT EXISTS item_search_delete AFTER DELETE "
+                "ON item BEGIN "
+                "INSERT INTO item_search(item_search, rowid, name, description) "
+                "VALUES ('delete', old.id, old.name, old.description); END",
+                # version stamps do not change the words of an item
+                "CREATE TRIGGER IF NOT EXISTS item_search_update AFTER UPDATE "
+                "OF name, description ON item BEGIN "
+                "INSERT INTO item_search(item_search, rowid, name, description) "
+                "VALUES ('delete', old.id, old.name, old.description); "
+                "INSERT INTO item_search(rowid, name, description) "
+                "VALUES (new.id, new.name, new.description); END",
+                # index the items that existed before the table was created
+                "INSERT INTO item_search(item_search) VALUES ('rebuild')"]}
+
+
+def pantry_counters(pantry_ids=None):
+    '''Return a SELECT computing the pantry_id, category_count, item_count and
+    total_value of pantries from their categories and items, grouping the
+    categories and the items by pantry.
+    @param pantry_ids: ids of the pantries, or None for every pantry
+    '''
+    categories = select([Category.parent_id.label('pantry_id'),
+                         func.count(Category.id).label('category_count')])\
+                 .group_by(Category.parent_id).alias('categories')
+    items = select([Category.parent_id.label('pantry_id'),
+                    func.count(Item.id).label('item_count'),
+                    func.coalesce(func.sum(Item.quantity * Item.price), 0)
+                    .label('total_value')])\
+            .where(Item.parent_id == Category.id)\
+            .group_by(Category.parent_id).alias('items')
+    pantries = Pantry.__table__
+    counters = select([pantries.c.id.label('pantry_id'),
+                       func.coalesce(categories.c.category_count, 0)
+                       .label('category_count'),
+                       func.coalesce(items.c.item_count, 0)
+                       .label('item_count'),
+                       func.coalesce(items.c.total_value, 0)
+                       .label('total_value')])\
+               .select_from(pantries
+                            .outerjoin(categories,
+                                       categories.c.pantry_id == pantries.c.id)
+                            .outerjoin(items,
+                                       items.c.pantry_id == pantries.c.id))
+    if pantry_ids is not None:
+        counters = counters.where(pantries.c.id.in_(pantry_ids))
+    return counters
+
+
+def rebuild_pantry_stats(connection):
+    '''Replace every row of the pantry stats table with counters computed
+    from the categories and items, using one INSERT from pantry_counters.
+    Readers see either the old or the new rows until the transaction is
+    committed.
+    @param connection: SQLAlchemy connection or session in a transaction
+    '''
+    stats = PantryStats.__table__
+    connection.execute(stats.delete())
+    connection.execute(stats.insert().from_select(
+        ['pantry_id', 'category_count', 'item_count', 'total_value'],
+        pantry_counters()))
+
+
+def create_search_index(engine):
+    '''Create the full text search index of the items, and fill it with the
+    existing items, if it does not exist yet.
+    @param engine: SQLAlchemy engine connected to the database
+    '''
+    dialect = engine.dialect.name
+    if dialect == 'sqlite' and 'item_search' in inspect(engine)\
+                                               .get_table_names():
+        return
+    for statement in SEARCH_INDEX_DDL.get(dialect, []):
+        engine.execute(statement)
+
+
+def drop_search_index(engine):
+    '''Drop the SQLite full text search table, which is not part of the
+    metadata. The triggers are dropped with the item table and the PostgreSQL
+    index with its table.
+    @param engine: SQLAlchemy engine connected to the database
+    '''
+    if engine.dialect.name == 'sqlite':
+        engine.execute('DROP TABLE IF EXISTS item_search')
+
+
+def add_missing_columns(engine):
+    '''Add every column declared on the models that does not yet exist in
+    the database. New columns must be nullable or have a server default so
+    that existing rows get a value.
+    @param engine: SQLAlchemy engine connected to the database to migrate
+    '''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column
+                       in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name,
+                               CreateColumn(column).compile(
+                                   dialect=engine.dialect)))
+
+
+def add_missing_indexes(engine):
+    '''Create every index declared on the models that does not yet exist in
+    the database. Existing tables and rows are left untouched.
+    N.B. the unique index on users.email cannot be created while duplicate
+    email addresses exist in the users table.
+    @param engine: SQLAlchemy engine connected to the database to migrate
+    '''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index
+                       in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+def create_db(testing=False, migrate=False):
     '''Create a production or test database. Run this function from the console
     when deploying the application before running item_server for the first
     time.
+    If migrate is true, an existing database is upgraded in place instead: 
+    missing tables, columns and indexes are created and no data is dropped,
+    and the pantry counters are rebuilt.
+    The database url is configured as described in the db_engine module.
     '''
-    if testing:
-        engine = create_engine('sqlite:///test_item_catalog.db')
+    engine = make_engine(testing)
+    if migrate:
+        Base.metadata.create_all(engine)
+        add_missing_columns(engine)
+        add_missing_indexes(engine)
+        with engine.begin() as connection:
+            rebuild_pantry_stats(connection)
     else:
-        engine = create_engine('postgresql://catalog:what a drag@localhost/catalog')
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+        drop_search_index(engine)
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+    create_search_index(engine)
 
 
 
@@ -15,38 +15,117 @@ relationship: User-->Pantry(owned, not shared)-->Category-->Item. In the
 docstrings below, references to parent are to a direct parent and child to a 
 direct child.
 '''
+import bisect
+import datetime
+import re
+
+from sqlalchemy import and_, column, exists, false, func, inspect, \
+                       literal_column, or_, select, table, tuple_
+from sqlalchemy.orm import sessionmaker, make_transient_to_detached, \
+                           joinedload, class_mapper
+from sqlalchemy.orm.util import identity_key
+from item_catalog.catalog_database_setup import Base, Category, Item, Job, \
+                                                Pantry, PantryStats, \
+                                                Tombstone, User, \
+                                                ITEM_DOCUMENT, pantry_access, \
+                                                pantry_counters, \
+                                                rebuild_pantry_stats
+from item_catalog.cache import NameIndex
+from item_catalog.db_engine import make_engine
+
+
+def _matches(item, filters):
+    '''Return True if an item passes the range filters of
+    DBInterface.get_item_page. Like SQL comparisons, a filter on a column
+    never matches an item without a value for it.
+    '''
+    price, quantity = item.price, item.quantity
+    if filters.get('min_price') is not None and \
+       (price is None or price < filters['min_price']):
+        return False
+    if filters.get('max_price') is not None and \
+       (price is None or price > filters['max_price']):
+        return False
+    if filters.get('quantity_below') is not None and \
+       (quantity is None or quantity >= filters['quantity_below']):
+        return False
+    return True
+
+
+def _value(quantity, price):
+    '''Return the value of an item, counting a missing quantity or price as 0
+    as the SQL totals do.
+    '''
+    return (quantity or 0) * (price or 0)
 
-from sqlalchemy import create_engine, and_
-from sqlalchemy.orm import sessionmaker
-from item_catalog.catalog_database_setup import Base, Category, Item, Pantry, \
-                                                User
 
 class DBInterface(object):
     '''This class acts as an interface to either an actual database for 
     production or live testing, or a testing version that uses normal
     in memory python data structures. 
     '''
+    # classes whose objects are kept in the object cache
+    CACHED_CLASSES = ('Pantry', 'Category', 'Item')
+
+    # columns item listings can be sorted by, and those that can be null
+    ITEM_SORTS = ('id', 'name', 'price', 'quantity')
+    NULLABLE_SORTS = ('price', 'quantity')
+
+    # words of a search query, the rest is ignored
+    SEARCH_TERM = re.compile(r'\w+', re.UNICODE)
+    MAX_TERMS = 10
+
     @classmethod
-    def make_session_factory(cls, testing=False):
+    def make_session_factory(cls, testing=False, read_only=False,
+                             **engine_settings):
         '''Create a SQL Alchemy session factory. This is not used in the 
         initializer because there is no need to re-create the factory object
         every time an instance of this class is created.
+        @param read_only: if true, the sessions are for requests that do not
+        write. They do not autoflush and use a separate engine, connected to
+        the replica if one is configured, whose transactions are read only on
+        postgres. Reads from a replica may lag behind writes.
+        @param engine_settings: overrides for the settings described in the
+        db_engine module
         '''
-        if testing:
-            engine = create_engine('sqlite:///test_item_catalog.db')
-        else:
-            engine = create_engine('postgresql://catalog:what a drag@localhost/catalog')
+        engine = make_engine(testing, read_only, **engine_settings)
+        if read_only:
+            return sessionmaker(bind=engine, autoflush=False)
         Base.metadata.bind = engine
         return sessionmaker(bind=engine)
 
-    def __init__(self, session, testing=False):
+    def __init__(self, session, testing=False, auth_cache=None,
+                 object_cache=None, read_only=False, name_index=None,
+                 fill_caches=True):
         '''If testing is true, will use the mock database implementation, 
         otherwise uses SQL Alchemy queries. 
         @param session: an SQL alchemy session for running a real database, 
         for testing session is an instance of MockDB from the test_db_populator
         module. 
+        @param auth_cache: optional AuthCache instance shared between requests,
+        kept consistent by the write methods of this class
+        @param object_cache: optional ObjectCache instance shared between
+        requests, used by get_db_object_by_id
+        @param read_only: true if the session comes from a read only session
+        factory, in which case it is never committed
+        @param name_index: optional NameIndex shared between requests, used
+        by complete_name and updated by invalidate_written
+        @param fill_caches: if false, what is read is never stored in the
+        shared caches, only looked up in them. Use it for sessions reading
+        from a replica, which may lag behind the writes that invalidate them.
         '''
         self.testing = testing
+        self.read_only = read_only
+        self.auth_cache = auth_cache
+        self.object_cache = object_cache
+        self.name_index = name_index
+        self.fill_caches = fill_caches
+        # (class name, id) of every cached object written by this instance
+        self._written = set()
+        # changes to apply to the name index once committed, one tuple of
+        # the versions written and the list of changes per version
+        # increment, see NameIndex.apply
+        self._name_writes = []
         if self.testing:
             self.db = MockDBAccessor(session)
         else:
@@ -63,19 +142,108 @@ class DBInterface(object):
         self.db.session.close()
 
     def get_db_object_by_id(self, obj_class, obj_id):
-        '''Get single database object based on its ID.
+        '''Get single database object based on its ID. Pantries, categories
+        and items are read through the object cache, if there is one.
         @param obj_class: string class name of the model
         @param obj_id: int id of the model
         '''
-        return self.db.get_obj(obj_class, obj_id)
+        cached = self.object_cache is not None and \
+                 obj_class in self.CACHED_CLASSES
+        if cached:
+            data = self.object_cache.get(obj_class, obj_id)
+            if data is not None:
+                return self.db.obj_from_cache(obj_class, data)
+        obj = self.db.get_obj(obj_class, obj_id)
+        if cached and self.fill_caches and obj is not None:
+            self.object_cache.set(obj_class, obj_id, self.db.obj_to_cache(obj))
+        return obj
 
-    def get_all_objects(self, obj_class, parent_id):
+    def get_all_objects(self, obj_class, parent_id, limit=None, after=None):
         '''Get all objets of given class. If superID is supplied,
         only objects directly related to superId will be returned.
         @param obj_class: string class name of the model
         @param parent_id: int id of the parent 
+        @param limit: optional maximum number of objects to return
+        @param after: optional id, only objects with a greater id are returned
+        '''
+        return self.db.get_all_objects(obj_class, parent_id, limit, after)
+
+    def iter_all_objects(self, obj_class, parent_id, batch_size=500):
+        '''Iterate over the children of a parent ordered by id, fetching rows
+        from the database in batches rather than all at once.
+        @param obj_class: string class name of the model
+        @param parent_id: int id of the parent
+        @param batch_size: number of rows fetched per round trip
         '''
-        return self.db.get_all_objects(obj_class, parent_id)
+        return self.db.iter_all_objects(obj_class, parent_id, batch_size)
+
+    def get_page(self, obj_class, parent_id, limit, after=None):
+        '''Get one page of the children of a parent, ordered by id. Pages are
+        keyed on id, so fetching a page costs the same however far into the
+        listing it is.
+        @param obj_class: string class name of the model
+        @param parent_id: int id of the parent
+        @param limit: maximum number of objects on the page
+        @param after: id of the last object on the previous page, or None for
+        the first page
+        @return: tuple of the list of objects and the id to pass as after to
+        get the next page, or None if this is the last page
+        '''
+        objects = self.db.get_all_objects(obj_class, parent_id, limit + 1,
+                                          after)
+        if len(objects) > limit:
+            objects = objects[:limit]
+            return objects, objects[-1].id
+        return objects, None
+
+    def get_item_page(self, category_id, limit, sort='id', after=None,
+                      filters=None):
+        '''Get one page of the items of a category sorted by a column, and
+        optionally filtered on price and quantity, in SQL. Pages are keyed on
+        the sort column and the id, which orders items with equal values, so
+        the (parent_id, column) indexes serve every page. Items without a
+        price or quantity come last when sorted by it.
+        @param category_id: int id of the category
+        @param limit: maximum number of items on the page
+        @param sort: one of ITEM_SORTS
+        @param after: tuple of the sort column value, None if it is null, and
+        the id of the last item of the previous page, or None for the first
+        page
+        @param filters: dict with any of 'min_price' and 'max_price', the
+        inclusive range of prices, and 'quantity_below'
+        @return: tuple of the list of items and the after tuple of the next
+        page, or None if this is the last page
+        '''
+        items = self.db.get_item_page(category_id, limit + 1, sort, after,
+                                      filters or {})
+        if len(items) > limit:
+            items = items[:limit]
+            return items, (getattr(items[-1], sort), items[-1].id)
+        return items, None
+
+    def get_category_with_items(self, category_id):
+        '''Get a category together with its items in one round trip.
+        @param category_id: int id of the category
+        @return: tuple of the category and the list of its items ordered by id
+        '''
+        return self.db.get_category_with_items(category_id)
+
+    def get_item_with_category(self, item_id):
+        '''Get an item together with the category it belongs to in one round
+        trip.
+        @param item_id: int id of the item
+        @return: tuple of the item and its category
+        '''
+        return self.db.get_item_with_category(item_id)
+
+    def get_pantry_tree(self, pantry_id):
+        '''Get every category of a pantry together with its items as plain
+        data, ready to be serialized.
+        @param pantry_id: int id of the pantry
+        @return: list of category dicts ordered by id, each with an 'items'
+        list of item dicts ordered by id
+        '''
+        return self.db.get_pantry_tree(pantry_id)
 
     def get_dbobject_by_name(self, obj_class, name, parent_id):
         '''Return any objects matching this query as a list.
@@ -86,10 +254,19 @@ class DBInterface(object):
         return self.db.get_obj_by_name(obj_class, name, parent_id)
 
     def get_user_by_email(self, email):
-        '''Return the user matching the email address if any.
+        '''Return the user matching the email address if any. If there is an
+        auth cache, a cached user is returned without querying the database.
         @param email: an email address as a string
         '''
-        return self.db.get_user_by_email(email)
+        if self.auth_cache is not None:
+            cached = self.auth_cache.get_user(email)
+            if cached is not None:
+                return self.db.user_from_cache(cached)
+        user = self.db.get_user_by_email(email)
+        if user is not None and self.auth_cache is not None and \
+           self.fill_caches:
+            self.auth_cache.set_user(email, self.db.user_to_cache(user))
+        return user
 
     def get_authorized_pantries(self, user):
         '''Return a list of users authorized to access a pantry
@@ -97,26 +274,370 @@ class DBInterface(object):
         '''
         return self.db.get_authorized_pantries(user)
 
+    def user_can_access(self, user_id, pantry_id):
+        '''Return True if the user may access the pantry. If there is an auth
+        cache, the answer is cached.
+        @param user_id: int id of the user
+        @param pantry_id: int id of the pantry
+        '''
+        if self.auth_cache is not None:
+            allowed = self.auth_cache.get_access(user_id, pantry_id)
+            if allowed is not None:
+                return allowed
+        allowed = self.db.user_can_access(user_id, pantry_id)
+        if self.auth_cache is not None and self.fill_caches:
+            self.auth_cache.set_access(user_id, pantry_id, allowed)
+        return allowed
+
+    def category_in_pantry(self, category_id, pantry_id):
+        '''Return True if the category exists and belongs to the pantry.
+        Views adding to a category check this, since add_object does not
+        load the parent.
+        @param category_id: int id of the category
+        @param pantry_id: int id of the pantry
+        '''
+        return self.db.category_in_pantry(category_id, pantry_id)
+
     def add_object(self, class_name, *args):
         '''Add an object to the database. 
         @param class_name: the name of the class the new object is to be
         an instance of
         @param args: values to populate the fields of the model class
+        @return: the new object
+        '''
+        obj = self.db.add_object(class_name, *args)
+        self._invalidate_auth(obj)
+        # ids of deleted rows can be reused by some databases
+        self._invalidate_object(obj)
+        self.db.update_pantry_stats(obj, 'add')
+        self._record_change(obj)
+        self._record_names(obj, 'add')
+        return obj
+
+
+    def add_objects(self, class_name, rows):
+        '''Add many objects of the same class to the database at once. Only
+        categories and items can be added this way.
+        @param class_name: the name of the class the new objects are to be
+        instances of
+        @param rows: list of dicts mapping column names, including parent_id,
+        to values
+        @raise ValueError: if a row refers to a parent that does not exist
+        @return: the number of objects added
         '''
-        self.db.add_object(class_name, *args)
+        # the accessors record the change and update the pantry stats, since
+        # the new objects' versions are set as they are inserted
+        count = self.db.add_objects(class_name, rows)
+        if self.name_index is not None:
+            self._add_name_write(class_name, [(class_name, 'add', None,
+                                               row['parent_id'], row['name'],
+                                               None)
+                                              for row in rows])
+        return count
 
 
     def del_object(self, obj):
         '''CRUD delete this entity from the database.
         @param obj: the object to be deleted
         '''
+        self._invalidate_auth(obj, deleted=True)
+        self._invalidate_object(obj, deleted=True)
+        if obj.__class__.__name__ != 'Pantry':
+            self.db.update_pantry_stats(obj, 'delete')
+            self._record_change(obj, deleted=True)
+        self._record_names(obj, 'delete')
         self.db.del_object(obj)
 
     def update_object(self, obj):
         '''CRUD update on this database entity.
         @param obj: the object to be deleted
         '''
+        old_name = self.db.get_previous_name(obj)
+        self._invalidate_auth(obj)
+        # the entry is dropped before the change is flushed, which raises
+        # StaleDataError if obj was rebuilt from the cache entry of a row
+        # deleted since, so the next read misses and finds it gone
+        self._invalidate_object(obj)
+        self.db.update_pantry_stats(obj, 'update')
         self.db.update_object(obj)
+        self._record_change(obj)
+        self._record_names(obj, 'update', old_name)
+
+    def get_pantry_summary(self, pantry_id):
+        '''Get inventory totals for every category of a pantry and for the
+        pantry as a whole, computed by the database. Items without a quantity
+        or a price count as having none.
+        @param pantry_id: int id of the pantry
+        @return: dict with the pantry's 'item_count', 'total_quantity' and
+        'total_value' (the sum of quantity times price), and 'categories', a
+        list of dicts holding the same totals with the 'id' and 'name' of
+        each category, ordered by id
+        '''
+        categories = self.db.get_category_totals(pantry_id)
+        summary = {'categories' : categories}
+        for total in ('item_count', 'total_quantity', 'total_value'):
+            summary[total] = sum(category[total] for category in categories)
+        return summary
+
+    def get_pantry_stats(self, pantry_ids):
+        '''Get the inventory counters of many pantries with one lookup. Unlike
+        get_pantry_summary, nothing is aggregated: the counters are kept up
+        to date by the write methods of this class.
+        @param pantry_ids: ids of the pantries
+        @return: dict mapping each pantry id to a dict with its
+        'category_count', 'item_count' and 'total_value'. The counters of
+        pantries without a stats row, created before the stats table, are
+        computed from their rows until rebuild_pantry_stats is run.
+        '''
+        return self.db.get_pantry_stats(pantry_ids)
+
+    def rebuild_pantry_stats(self):
+        '''Recompute the inventory counters of every pantry from its
+        categories and items, repairing any drift.
+        @return: the number of pantries
+        '''
+        return self.db.rebuild_pantry_stats()
+
+    def get_pantry_version(self, pantry_id):
+        '''Get the version of a pantry without loading any of its rows. The
+        version is incremented by every write to the pantry, its categories
+        or its items made through this class.
+        @param pantry_id: int id of the pantry
+        @return: tuple of the version and the time of the last change, which
+        may be None, or None if there is no such pantry
+        '''
+        return self.db.get_pantry_version(pantry_id)
+
+    def get_changes(self, pantry_id, since=None):
+        '''Get the categories and items of a pantry written after a version,
+        and tombstones for those deleted after it. A client that has synced
+        a pantry at some version only needs these to catch up.
+        @param pantry_id: int id of the pantry
+        @param since: version the client has, or None for every category and
+        item of the pantry
+        @return: dict with the current 'version' of the pantry, 'categories'
+        and 'items' as lists of dicts ordered by id, and 'deleted', a list of
+        tombstone dicts ordered by version
+        '''
+        return self.db.get_changes(pantry_id, since)
+
+    def complete_name(self, pantry_id, class_name, prefix, limit):
+        '''Get the names of the categories or the items of a pantry starting
+        with a prefix, ignoring case, from the name index. The names of the
+        pantry are read into the index the first time, and again whenever
+        the pantry was written by another process, so a lookup only queries
+        the pantry version.
+        @param pantry_id: int id of the pantry
+        @param class_name: 'Category' or 'Item'
+        @param prefix: the start of the name
+        @param limit: maximum number of names
+        @return: list of distinct names in alphabetical order, or None if
+        there is no such pantry
+        '''
+        pantry_version = self.get_pantry_version(pantry_id)
+        if pantry_version is None:
+            return None
+        version = pantry_version[0]
+        names = None
+        if self.name_index is not None and \
+           self.name_index.get_version(pantry_id) == version:
+            names = self.name_index.complete(pantry_id, class_name, prefix,
+                                             limit)
+        if names is None:
+            index = self.name_index if self.name_index is not None and \
+                    self.fill_caches else NameIndex(1)
+            categories, items = self.db.get_pantry_names(pantry_id)
+            index.build(pantry_id, version, categories, items)
+            names = index.complete(pantry_id, class_name, prefix, limit)
+        return names or []
+
+    def search_items(self, pantry_ids, query, limit, offset=0):
+        '''Search the names and descriptions of the items of some pantries
+        for all the words of a query, using the full text index of the
+        database. Results are ranked, best match first, so pages are read
+        with an offset rather than keyed on id.
+        @param pantry_ids: ids of the pantries to search
+        @param query: the text typed by the user
+        @param limit: maximum number of results
+        @param offset: number of results skipped, for later pages
+        @return: tuple of the list of results, dicts holding the columns of
+        each item and its 'pantry_id', and True if there are more results
+        '''
+        terms = self.SEARCH_TERM.findall(query.lower())
+        if not terms or not pantry_ids:
+            return [], False
+        results = self.db.search_items(pantry_ids, terms[:self.MAX_TERMS],
+                                       limit + 1, offset)
+        return results[:limit], len(results) > limit
+
+    def schedule_delete(self, obj, user_id):
+        '''Delete a pantry or a user in the background. The pantry, or every
+        pantry the user owns, is hidden at once: it is marked deleted and
+        nobody can access it any more. A job is created to delete the rows
+        in batches, see the jobs module.
+        @param obj: the Pantry or User to delete
+        @param user_id: id of the user requesting the deletion
+        @return: the job, whose id can be used to follow its progress
+        '''
+        self._invalidate_auth(obj, deleted=True)
+        self._invalidate_object(obj, deleted=True)
+        self._record_names(obj, 'delete')
+        return self.db.schedule_delete(obj, user_id)
+
+    def claim_next_job(self, lease):
+        '''Mark the oldest pending job, or the oldest running job whose
+        worker has not reported progress within the lease, as running.
+        @param lease: seconds after which a running job is deemed abandoned
+        @return: the id of the job, or None if no job is waiting
+        '''
+        return self.db.claim_next_job(lease)
+
+    def get_job(self, job_id):
+        '''Get a background job by id.
+        @param job_id: int id of the job
+        @return: the Job, or None if there is no such job
+        '''
+        return self.db.get_job(job_id)
+
+    def purge_batch(self, job, batch_size):
+        '''Delete the next batch of rows belonging to the target of a delete
+        job.
+        @param job: the Job being run
+        @param batch_size: maximum number of rows deleted
+        @return: number of rows deleted, 0 once the target is fully deleted
+        '''
+        return self.db.purge_batch(job, batch_size)
+
+    def _record_change(self, obj, deleted=False):
+        '''Increment the version of the pantry obj belongs to. A category or
+        an item is stamped with the new version, or a tombstone is recorded
+        for it if it is being deleted.
+        @param obj: the model object being written
+        @param deleted: true if obj is being deleted
+        '''
+        class_name = obj.__class__.__name__
+        if class_name == 'Pantry':
+            self.db.bump_versions(pantry_ids=[obj.id])
+            return
+        elif class_name == 'Category':
+            self.db.bump_versions(pantry_ids=[obj.parent_id])
+        elif class_name == 'Item':
+            self.db.bump_versions(category_ids=[obj.parent_id])
+        else:
+            return
+        if deleted:
+            self.db.add_tombstone(obj)
+        else:
+            self.db.stamp_version(obj)
+
+    def invalidate_written(self):
+        '''Drop the object cache entries of every object written through this
+        instance again. Call this after committing, so an entry read by
+        another request between a write and its commit does not outlive it.
+        '''
+        if self.object_cache is not None:
+            written = {}
+            for class_name, obj_id in self._written:
+                written.setdefault(class_name, []).append(obj_id)
+            for class_name, obj_ids in written.items():
+                self.object_cache.delete_many(class_name, obj_ids)
+        self._written.clear()
+        if self.name_index is not None and self._name_writes:
+            # new objects only have an id once committed
+            self.name_index.apply([(versions,
+                                    [(kind, change, obj if obj is None
+                                      else self.db.get_obj_id(obj), parent_id,
+                                      name, old_name)
+                                     for kind, change, obj, parent_id, name,
+                                         old_name in changes])
+                                   for versions, changes in self._name_writes])
+        del self._name_writes[:]
+
+    def _record_names(self, obj, change, old_name=None):
+        '''Remember a write for the name index, which is updated once the
+        write is committed. Deleting a pantry or a user drops the names at
+        once instead, since it does not increment any version.
+        @param obj: the model object being written
+        @param change: 'add', 'update' or 'delete'
+        @param old_name: the name obj had before an update, or None if it is
+        not known
+        '''
+        if self.name_index is None:
+            return
+        class_name = obj.__class__.__name__
+        if change == 'delete' and class_name == 'User':
+            self.name_index.clear()
+        elif change == 'delete' and class_name == 'Pantry':
+            self.name_index.drop(obj.id)
+        elif class_name in ('Pantry', 'Category', 'Item') and \
+             (class_name, change) != ('Pantry', 'add'):
+            if change == 'delete':
+                old_name = obj.name
+            self._add_name_write(class_name, [(class_name, change, obj,
+                                               obj.parent_id, obj.name,
+                                               old_name)])
+
+    def _add_name_write(self, class_name, changes):
+        '''Queue the changes of one write for the name index along with the
+        versions it gave the pantries it touched. The versions are read in
+        the write's transaction, so an entry built by another request after
+        the commit can be told from one that is missing the write.
+        @param class_name: 'Pantry', 'Category' or 'Item'
+        @param changes: list of changes as queued by _record_names
+        '''
+        if class_name == 'Pantry':
+            versions = self.db.get_pantry_versions(
+                pantry_ids=[obj.id for _, _, obj, _, _, _ in changes])
+        elif class_name == 'Category':
+            versions = self.db.get_pantry_versions(
+                pantry_ids=[parent_id for _, _, _, parent_id, _, _ in changes])
+        else:
+            versions = self.db.get_pantry_versions(
+                category_ids=[parent_id
+                              for _, _, _, parent_id, _, _ in changes])
+        self._name_writes.append((versions, changes))
+
+    def _invalidate_object(self, obj, deleted=False):
+        '''Drop the object cache entry of obj. Deleting a pantry or a category
+        or a user also deletes its children, whose ids may be reused, so their
+        entries are dropped too.
+        @param obj: the model object being written
+        @param deleted: true if obj is being deleted
+        '''
+        class_name = obj.__class__.__name__
+        if self.object_cache is None:
+            return
+        if deleted and class_name in ('User', 'Pantry', 'Category'):
+            for child_class, child_ids in self.db.get_child_ids(obj).items():
+                self.object_cache.delete_many(child_class, child_ids)
+                self._written.update((child_class, child_id)
+                                     for child_id in child_ids)
+        if class_name in self.CACHED_CLASSES:
+            self.object_cache.delete(class_name, obj.id)
+            self._written.add((class_name, obj.id))
+
+    def _invalidate_auth(self, obj, deleted=False):
+        '''Drop auth cache entries that a write to obj may have made stale.
+        New pantries invalidate their owner's access checks, deleted pantries
+        every check against them. Deleting a user also removes the access of
+        everyone sharing the user's pantries, so the whole cache is cleared.
+        @param obj: the model object being written
+        @param deleted: true if obj is being deleted
+        '''
+        if self.auth_cache is None:
+            return
+        class_name = obj.__class__.__name__
+        if class_name == 'User':
+            if deleted:
+                self.auth_cache.clear()
+            else:
+                self.auth_cache.invalidate_user(obj.email, obj.id)
+        elif class_name == 'Pantry':
+            if deleted:
+                self.auth_cache.invalidate_pantry(obj.id)
+            else:
+                self.auth_cache.access.delete_matching(
+                    lambda key: key[0] == obj.parent_id)
 
 
 class MockDBAccessor(object):
@@ -131,7 +652,8 @@ class MockDBAccessor(object):
     When instanting this class, an instance of the
     MockDB class must be passed as the session parameter of the constructor.
     A different mock database could be used, provided the interface was the 
-    same.
+    same. Lookups use the indexes of the MockTable holding each model class,
+    so they take constant time regardless of the size of the mock database.
     '''
     def __init__(self, session):
         '''Instantiate a new mock db test class. This class should only be
@@ -139,17 +661,36 @@ class MockDBAccessor(object):
         @param session: an instance of MockDB from test_db_populator
         '''
         self.session = session
+        # parent class and constructor argument order for bulk inserts
+        self.parents = {'Item' : 'Category',
+                        'Category' : 'Pantry'}
+        self.fields = {'Item' : ('name', 'description', 'quantity', 'price',
+                                 'parent_id'),
+                       'Category' : ('name', 'parent_id')}
 
     def get_user_by_email(self, email):
         '''Get user object by email address.
         @param email: string email address
         @return: the user model object or None if not found
         '''
-        try:
-            return filter(lambda x: x.email == email,
-                          self.session.mock_db.get("User"))[0]
-        except IndexError:
-            return None
+        return self.session.mock_db.get('User').by_email.get(email)
+
+    def user_to_cache(self, user):
+        '''Mock users live as long as the mock database, so the object
+        itself is cached.
+        '''
+        return user
+
+    def user_from_cache(self, cached):
+        return cached
+
+    def obj_to_cache(self, obj):
+        '''Mock objects are cached themselves, like users.
+        '''
+        return obj
+
+    def obj_from_cache(self, obj_class, cached):
+        return cached
 
     def get_obj(self, obj_class, obj_id):
         '''Get a model object by class name and id.
@@ -157,11 +698,7 @@ class MockDBAccessor(object):
         @param obj_id: the int id of the model object
         @return: model object instance or None if not found
         '''
-        try:
-            return filter(lambda x: x.id == obj_id,
-                          self.session.mock_db.get(obj_class))[0]
-        except IndexError:
-            return None
+        return self.session.mock_db.get(obj_class).get(obj_id)
 
 
     def get_obj_by_name(self, obj_class, obj_name, obj_parent_id):
@@ -171,27 +708,95 @@ class MockDBAccessor(object):
         @param obj_parent_id: int id of the parent
         @return: model object instance or None if not found
         '''
-        try:
-            return filter(lambda x: x.name == obj_name and x.parent_id\
-                           == obj_parent_id,
-                          self.session.mock_db.get(obj_class))[0]
-        except IndexError:
-            return None
+        return self.session.mock_db.get(obj_class).first_by_name(
+            obj_name, obj_parent_id)
 
-    def get_all_objects(self, obj_class, parent_id):
+    def get_all_objects(self, obj_class, parent_id, limit=None, after=None):
         '''Returns a list of all object of a specific mapped class in
         the table with a given parent relationship.
         @param obj_class: model class name
         @param parent_id: int id of the parent
+        @param limit: optional maximum number of objects to return
+        @param after: optional id, only objects with a greater id are returned
         '''
-        return filter(lambda x: x.parent_id == parent_id,
-                      self.session.mock_db.get(obj_class))
+        children = self.session.mock_db.get(obj_class).children(parent_id)
+        if after is not None:
+            # children are in id order, so skip to the first id after it
+            children = children[bisect.bisect_right(
+                [child.id for child in children], after):]
+        return children[:limit]
+
+    def iter_all_objects(self, obj_class, parent_id, batch_size):
+        '''Iterate over the objects returned by get_all_objects.
+        '''
+        return iter(self.get_all_objects(obj_class, parent_id))
+
+    def get_item_page(self, category_id, limit, sort, after, filters):
+        '''Return a page of items sorted and filtered in memory, see
+        DBInterface.get_item_page.
+        '''
+        items = [item for item in self.get_all_objects('Item', category_id)
+                 if _matches(item, filters)]
+        # null values sort last
+        key = lambda value, item_id: (value is None, value, item_id)
+        items.sort(key=lambda item: key(getattr(item, sort), item.id))
+        if after is not None:
+            items = [item for item in items
+                     if key(getattr(item, sort), item.id) > key(*after)]
+        return items[:limit]
+
+    def get_pantry_tree(self, pantry_id):
+        '''Return the categories of a pantry as dicts, each with a list of
+        its items as dicts.
+        @param pantry_id: int id of the pantry
+        '''
+        tree = []
+        for category in self.get_all_objects('Category', pantry_id):
+            node = category.serialize
+            node['items'] = [item.serialize for item
+                             in self.get_all_objects('Item', category.id)]
+            tree.append(node)
+        return tree
+
+    def get_category_with_items(self, category_id):
+        '''Return a tuple of the category and its items. The category is None
+        if not found.
+        @param category_id: int id of the category
+        '''
+        return (self.get_obj('Category', category_id),
+                self.get_all_objects('Item', category_id))
+
+    def get_item_with_category(self, item_id):
+        '''Return a tuple of the item and its category. Both are None if the
+        item is not found.
+        @param item_id: int id of the item
+        '''
+        item = self.get_obj('Item', item_id)
+        if item is None:
+            return None, None
+        return item, self.get_obj('Category', item.parent_id)
 
     def get_authorized_pantries(self, user):
         '''Return a list of pantry objects this user can access.
         @param user: the user to check.
         '''
-        return filter(lambda x: x.id in user.pantries, self.session.pantries)
+        pantries = self.session.pantries
+        return [pantries.get(pantry_id) for pantry_id in sorted(user.pantries)
+                if pantry_id in pantries.by_id]
+
+    def user_can_access(self, user_id, pantry_id):
+        '''Return True if the user may access the pantry.
+        @param user_id: int id of the user
+        @param pantry_id: int id of the pantry
+        '''
+        user = self.get_obj('User', user_id)
+        return user is not None and pantry_id in user.pantries
+
+    def category_in_pantry(self, category_id, pantry_id):
+        '''Return True if the category exists and belongs to the pantry.
+        '''
+        category = self.get_obj('Category', category_id)
+        return category is not None and category.parent_id == pantry_id
 
     def add_object(self, class_name, *args):
         '''Add an object to the database. 
@@ -204,19 +809,42 @@ class MockDBAccessor(object):
         # the construtors are in a dict, would conflict with names of
         # mapped classes for ORM
         constructor = self.session.constructor.get(class_name)
-        # make a new id for the object, assume it is going at the end of the
-        # list (mock db lists are ordered by id)
-        new_id = mock_table[len(mock_table) - 1].id + 1
+        # ids are never reused, like an autoincrement primary key
+        new_id = mock_table.next_id()
         args_with_id = list(args)
         args_with_id.insert(0, new_id)
         new_obj = constructor(*args_with_id)
         new_obj.id = new_id
-        mock_table.append(new_obj)
+        mock_table.add(new_obj)
         # if it is a pantry need to update user pantry access id reference
         if class_name == 'Pantry':
-            user = filter(lambda x:x.id == new_obj.parent_id,
-                          self.session.mock_db.get('User'))
-            user[0].pantries.append(new_obj.id)
+            self.get_obj('User', new_obj.parent_id).pantries.add(new_obj.id)
+        return new_obj
+
+    def add_objects(self, class_name, rows):
+        '''Add each row with add_object, after checking that all the parents
+        exist.
+        @param class_name: 'Category' or 'Item'
+        @param rows: list of dicts mapping column names to values
+        '''
+        parent_class = self.parents[class_name]
+        missing = sorted(set(row['parent_id'] for row in rows
+                             if self.get_obj(parent_class,
+                                             row['parent_id']) is None))
+        if missing:
+            raise ValueError('No %s with id %s.' % (parent_class,
+                             ', '.join(str(parent_id) for parent_id
+                                       in missing)))
+        if class_name == 'Category':
+            self.bump_versions(pantry_ids=[row['parent_id'] for row in rows])
+        else:
+            self.bump_versions(category_ids=[row['parent_id'] for row in rows])
+        for row in rows:
+            obj = self.add_object(class_name, *[row.get(field) for field
+                                                in self.fields[class_name]])
+            self.stamp_version(obj)
+            self.update_pantry_stats(obj, 'add')
+        return len(rows)
 
     def del_object(self, obj):
         '''Delete an object from the mock database.
@@ -224,8 +852,52 @@ class MockDBAccessor(object):
         '''
         mock_table = self.session.mock_db.get(obj.__class__.__name__)
         mock_table.remove(obj)
+        # deleting a pantry removes it from every user's access list
+        if obj.__class__.__name__ == 'Pantry':
+            for user in self.session.mock_db.get('User'):
+                user.pantries.discard(obj.id)
+            self.session.pantry_stats.pop(obj.id, None)
 
 
+    def get_child_ids(self, obj):
+        '''Return the ids of the objects deleted along with obj, by class
+        name.
+        @param obj: a user, pantry or category
+        '''
+        class_name = obj.__class__.__name__
+        ids = {'Pantry' : [], 'Category' : [], 'Item' : []}
+        if class_name == 'User':
+            ids['Pantry'] = [pantry.id for pantry
+                             in self.get_all_objects('Pantry', obj.id)]
+        if class_name == 'Pantry':
+            pantry_ids = [obj.id]
+        else:
+            pantry_ids = ids['Pantry']
+        for pantry_id in pantry_ids:
+            ids['Category'].extend(category.id for category
+                                   in self.get_all_objects('Category',
+                                                           pantry_id))
+        category_ids = [obj.id] if class_name == 'Category' \
+                       else ids['Category']
+        for category_id in category_ids:
+            ids['Item'].extend(item.id for item
+                               in self.get_all_objects('Item', category_id))
+        return ids
+
+    def schedule_delete(self, obj, user_id):
+        '''Delete the object at once and record a finished job, so the
+        application can be tested without a job worker.
+        '''
+        self.del_object(obj)
+        job = self.add_object('Job', obj.__class__.__name__, obj.id, user_id)
+        job.status = 'done'
+        return job
+
+    def get_job(self, job_id):
+        '''Return the job with this id, or None.
+        '''
+        return self.get_obj('Job', job_id)
+
     def update_object(self, obj):
         '''Update an existing entry in the mock table. Does not actually 
         do anything because the object's properties will already be updated
@@ -235,6 +907,204 @@ class MockDBAccessor(object):
         mock_table = self.session.mock_db.get(obj.__class__.__name__)
         assert obj in mock_table
 
+    def update_pantry_stats(self, obj, change):
+        '''Adjust the counters of the pantry obj belongs to, like the SQL
+        accessor. Mock objects are changed in place, so the value an item had
+        before an update is not known and the pantry's value is recomputed
+        instead. Pantries without counters are left alone.
+        '''
+        class_name = obj.__class__.__name__
+        stats = self.session.pantry_stats
+        if class_name == 'Pantry':
+            if change == 'add':
+                stats[obj.id] = {'category_count' : 0, 'item_count' : 0,
+                                 'total_value' : 0}
+            return
+        elif class_name not in ('Category', 'Item') or \
+             (class_name, change) == ('Category', 'update'):
+            return
+        pantry_id = self._pantry_of(obj).id
+        counters = stats.get(pantry_id)
+        if counters is None:
+            return
+        sign = -1 if change == 'delete' else 1
+        if class_name == 'Category':
+            counters['category_count'] += sign
+            if change == 'delete':
+                # the category's items are deleted with it
+                items = self.get_all_objects('Item', obj.id)
+                counters['item_count'] -= len(items)
+                counters['total_value'] -= sum(_value(item.quantity,
+                                                      item.price)
+                                               for item in items)
+        elif change == 'update':
+            counters['total_value'] = \
+                self._count_pantry(pantry_id)['total_value']
+        else:
+            counters['item_count'] += sign
+            counters['total_value'] += sign * _value(obj.quantity, obj.price)
+
+    def _count_pantry(self, pantry_id):
+        '''Compute the counters of a pantry from its categories and items.
+        '''
+        totals = self.get_category_totals(pantry_id)
+        return {'category_count' : len(totals),
+                'item_count' : sum(category['item_count']
+                                   for category in totals),
+                'total_value' : sum(category['total_value']
+                                    for category in totals)}
+
+    def rebuild_pantry_stats(self):
+        '''Recompute the counters of every pantry.
+        '''
+        self.session.pantry_stats = dict((pantry.id,
+                                          self._count_pantry(pantry.id))
+                                         for pantry in self.session.pantries)
+        return len(self.session.pantry_stats)
+
+    def get_pantry_stats(self, pantry_ids):
+        '''Return copies of the counters of the pantries. The counters of
+        pantries without any are computed from their rows.
+        '''
+        stats = {}
+        for pantry_id in pantry_ids:
+            counters = self.session.pantry_stats.get(pantry_id)
+            if counters is not None:
+                stats[pantry_id] = dict(counters)
+            elif self.get_obj('Pantry', pantry_id) is not None:
+                stats[pantry_id] = self._count_pantry(pantry_id)
+        return stats
+
+    def get_category_totals(self, pantry_id):
+        '''Return the totals of each category of a pantry, see
+        DBInterface.get_pantry_summary.
+        '''
+        totals = []
+        for category in self.get_all_objects('Category', pantry_id):
+            items = self.get_all_objects('Item', category.id)
+            totals.append({'id' : category.id,
+                           'name' : category.name,
+                           'item_count' : len(items),
+                           'total_quantity' : sum(item.quantity or 0
+                                                  for item in items),
+                           'total_value' : sum(item.quantity * item.price
+                                               for item in items
+                                               if item.quantity is not None
+                                               and item.price is not None)})
+        return totals
+
+    def get_pantry_version(self, pantry_id):
+        '''Return the version and modification time of a pantry, or None.
+        '''
+        pantry = self.get_obj('Pantry', pantry_id)
+        if pantry is None:
+            return None
+        return pantry.version, pantry.modified
+
+    def bump_versions(self, pantry_ids=(), category_ids=()):
+        '''Increment the version of the given pantries and of the pantries
+        holding the given categories.
+        '''
+        pantry_ids = set(pantry_ids)
+        for category_id in category_ids:
+            category = self.get_obj('Category', category_id)
+            if category is not None:
+                pantry_ids.add(category.parent_id)
+        for pantry_id in pantry_ids:
+            pantry = self.get_obj('Pantry', pantry_id)
+            if pantry is not None:
+                pantry.version += 1
+                pantry.modified = datetime.datetime.utcnow()
+
+    def get_pantry_versions(self, pantry_ids=(), category_ids=()):
+        '''Return a dict mapping the ids of the given pantries and of the
+        pantries holding the given categories to their versions.
+        '''
+        pantry_ids = set(pantry_ids)
+        for category_id in category_ids:
+            category = self.get_obj('Category', category_id)
+            if category is not None:
+                pantry_ids.add(category.parent_id)
+        versions = {}
+        for pantry_id in pantry_ids:
+            pantry = self.get_obj('Pantry', pantry_id)
+            if pantry is not None:
+                versions[pantry_id] = pantry.version
+        return versions
+
+    def _pantry_of(self, obj):
+        '''Return the pantry a category or an item belongs to.
+        '''
+        if obj.__class__.__name__ == 'Item':
+            return self.get_obj('Pantry',
+                                self.get_obj('Category', obj.parent_id)
+                                .parent_id)
+        return self.get_obj('Pantry', obj.parent_id)
+
+    def stamp_version(self, obj):
+        '''Set the version of a category or an item to its pantry's.
+        '''
+        obj.version = self._pantry_of(obj).version
+
+    def add_tombstone(self, obj):
+        '''Record the deletion of a category or an item.
+        '''
+        pantry = self._pantry_of(obj)
+        self.add_object('Tombstone', obj.__class__.__name__, obj.id,
+                        pantry.id, pantry.version)
+
+    def get_changes(self, pantry_id, since=None):
+        '''Return the changes to a pantry after a version, see DBInterface.
+        '''
+        changed = lambda obj: since is None or obj.version > since
+        categories = self.get_all_objects('Category', pantry_id)
+        items = sorted((item for category in categories
+                        for item in self.get_all_objects('Item', category.id)),
+                       key=lambda item: item.id)
+        deleted = [tombstone for tombstone in self.session.tombstones
+                   if tombstone.pantry_id == pantry_id and since is not None
+                   and tombstone.version > since]
+        return {'version' : self.get_obj('Pantry', pantry_id).version,
+                'categories' : [category.serialize for category
+                                in categories if changed(category)],
+                'items' : [item.serialize for item in items if changed(item)],
+                'deleted' : [tombstone.serialize for tombstone in deleted]}
+
+    def get_obj_id(self, obj):
+        return obj.id
+
+    def get_previous_name(self, obj):
+        '''Mock objects are changed in place, so the previous name is not
+        known.
+        '''
+        return None
+
+    def get_pantry_names(self, pantry_id):
+        '''Return the names of the categories and items of a pantry, see
+        DBAccessor.get_pantry_names.
+        '''
+        categories = self.get_all_objects('Category', pantry_id)
+        return ([(category.id, category.name) for category in categories],
+                [(item.parent_id, item.name) for category in categories
+                 for item in self.get_all_objects('Item', category.id)])
+
+    def search_items(self, pantry_ids, terms, limit, offset):
+        '''Return the items of the pantries containing every term as a word,
+        ranked by the number of times the terms occur.
+        '''
+        matches = []
+        for pantry_id in pantry_ids:
+            for category in self.get_all_objects('Category', pantry_id):
+                for item in self.get_all_objects('Item', category.id):
+                    words = DBInterface.SEARCH_TERM.findall(
+                        ('%s %s' % (item.name, item.description)).lower())
+                    if all(term in words for term in terms):
+                        result = dict(item.serialize, pantry_id=pantry_id)
+                        rank = sum(words.count(term) for term in terms)
+                        matches.append((-rank, item.id, result))
+        matches.sort()
+        return [result for _, _, result in matches[offset:offset + limit]]
+
 class DBAccessor(object):
     '''Provides access to the database as necessary.
     Serves as a mid-layer between the ORM and view functions. See module and
@@ -255,7 +1125,8 @@ class DBAccessor(object):
         self.classes = {'User' : User,
                         'Pantry' : Pantry,
                         'Category' : Category,
-                        'Item' : Item}
+                        'Item' : Item,
+                        'Job' : Job}
         # table allows retrieval of parent from only knowing child
         self.parents = {'Item' : 'Category',
                         'Category' : 'Pantry',
@@ -270,30 +1141,183 @@ class DBAccessor(object):
         return self.session.query(obj_class).\
             filter_by(id=obj_id).one()
 
-    def get_all_objects(self, obj_class_name, parent_id):
-        '''Returns a list of all cateogies as ORM objects.
-        @param session: SQL Alchemy session instance.
+    def get_all_objects(self, obj_class_name, parent_id, limit=None,
+                        after=None):
+        '''Returns a list of the children of parent_id as ORM objects, ordered
+        by id. The (parent_id, id) index serves both the filter and the order.
+        @param obj_class_name: ORM table class, as a string
+        @param parent_id: int id of the parent
+        @param limit: optional maximum number of objects to return
+        @param after: optional id, only objects with a greater id are returned
+        '''
+        obj_class = self.classes[obj_class_name]
+        query = self._visible(self.session.query(obj_class), obj_class)\
+                .filter_by(parent_id=parent_id)
+        if after is not None:
+            query = query.filter(obj_class.id > after)
+        query = query.order_by(obj_class.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    def iter_all_objects(self, obj_class_name, parent_id, batch_size):
+        '''Return an iterator over the children of parent_id ordered by id.
+        yield_per builds batch_size objects at a time and, on postgres, reads
+        the rows through a server side cursor.
         '''
         obj_class = self.classes[obj_class_name]
-        return self.session.query(obj_class).filter_by(parent_id=parent_id).\
-               order_by(obj_class.id).all()
+        return iter(self._visible(self.session.query(obj_class), obj_class)
+                    .filter_by(parent_id=parent_id)
+                    .order_by(obj_class.id).yield_per(batch_size))
+
+    def get_item_page(self, category_id, limit, sort, after, filters):
+        '''Return a page of items, see DBInterface.get_item_page. Items with
+        a value in the sort column are read first with a range scan of the
+        (parent_id, column, id) index, starting after the previous page, and
+        items without one are read after them in id order.
+        @param category_id: int id of the category
+        @param limit: maximum number of items
+        @param sort: column name
+        @param after: (value, id) of the last item of the previous page
+        @param filters: dict of range filters
+        '''
+        column = getattr(Item, sort)
+        query = self._visible(self.session.query(Item), Item)\
+                .filter(Item.parent_id == category_id)
+        if filters.get('min_price') is not None:
+            query = query.filter(Item.price >= filters['min_price'])
+        if filters.get('max_price') is not None:
+            query = query.filter(Item.price <= filters['max_price'])
+        if filters.get('quantity_below') is not None:
+            query = query.filter(Item.quantity < filters['quantity_below'])
+        value, after_id = after if after is not None else (None, None)
+        items = []
+        if after is None or value is not None:
+            with_values = query.filter(column.isnot(None))
+            if after is not None:
+                with_values = with_values.filter(tuple_(column, Item.id)
+                                                 > tuple_(value, after_id))
+            items = with_values.order_by(column, Item.id).limit(limit).all()
+        if len(items) < limit and sort in DBInterface.NULLABLE_SORTS:
+            without_values = query.filter(column.is_(None))
+            if after_id is not None and value is None:
+                without_values = without_values.filter(Item.id > after_id)
+            items += without_values.order_by(Item.id)\
+                     .limit(limit - len(items)).all()
+        return items
+
+    def get_category_with_items(self, category_id):
+        '''Return a tuple of the category and its items ordered by id. The
+        items are joined into the same query as the category.
+        @param category_id: int id of the category
+        '''
+        category = self.session.query(Category)\
+                   .options(joinedload(Category.children))\
+                   .filter_by(id=category_id).one()
+        return category, list(category.children)
+
+    def get_item_with_category(self, item_id):
+        '''Return a tuple of the item and its category, loaded in a single
+        query.
+        @param item_id: int id of the item
+        '''
+        item = self.session.query(Item).options(joinedload(Item.parent))\
+               .filter_by(id=item_id).one()
+        return item, item.parent
+
+    def get_pantry_tree(self, pantry_id):
+        '''Return the categories of a pantry as dicts, each with a list of
+        its items as dicts. Uses one query for the categories and one for all
+        of their items, and selects columns only, so no ORM objects are built.
+        @param pantry_id: int id of the pantry
+        '''
+        categories = self.session.query(Category.name, Category.id,
+                                        Category.parent_id)\
+                     .filter_by(parent_id=pantry_id).order_by(Category.id)
+        tree = []
+        nodes = {}
+        for row in categories:
+            node = row._asdict()
+            node['items'] = []
+            nodes[row.id] = node
+            tree.append(node)
+        if tree:
+            # only the categories read above, a category added since would
+            # have no node
+            items = self.session.query(Item.name, Item.id, Item.description,
+                                       Item.quantity, Item.price,
+                                       Item.parent_id)\
+                    .filter(Item.parent_id.in_(list(nodes)))\
+                    .order_by(Item.parent_id, Item.id)
+            for row in items:
+                nodes[row.parent_id]['items'].append(row._asdict())
+        return tree
 
     def get_obj_by_name(self, obj_class_name, name, parent_id):
         '''Get the object with a given name associated with a specific parent.
         Returns None if no object with that name is found.
         '''
         obj_class = self.classes[obj_class_name]
-        return self.session.query(obj_class).filter(\
+        return self._visible(self.session.query(obj_class), obj_class)\
+                                    .filter(\
                                     and_(obj_class.name == name,
                                          obj_class.parent_id == parent_id))\
                                          .first()
 
+    def _visible(self, query, obj_class):
+        '''Exclude pantries waiting to be deleted by a background job from a
+        query.
+        @param query: query on obj_class
+        @param obj_class: the mapped class queried
+        '''
+        if obj_class is Pantry:
+            return query.filter(Pantry.deleted == false())
+        return query
+
     def get_user_by_email(self, email):
         '''Get a user by their email address, will return None if no user is
         found.
         '''
         return self.session.query(User).filter_by(email=email).first()
 
+    def user_to_cache(self, user):
+        '''Return the column values of user, which unlike the ORM object
+        remain valid after this session is closed.
+        '''
+        return (user.id, user.name, user.email, user.deleted)
+
+    def user_from_cache(self, cached):
+        '''Rebuild a persistent user from cached column values without
+        querying the database. Relationships are loaded lazily as usual.
+        @param cached: tuple returned by user_to_cache
+        '''
+        user_id, name, email, deleted = cached
+        user = User(name, email)
+        user.id = user_id
+        user.deleted = deleted
+        make_transient_to_detached(user)
+        return self.session.merge(user, load=False)
+
+    def obj_to_cache(self, obj):
+        '''Return the serialize dict of a pantry, category or item for the
+        object cache.
+        '''
+        return obj.serialize
+
+    def obj_from_cache(self, obj_class_name, cached):
+        '''Rebuild a persistent object from its cached serialize dict without
+        querying the database. Columns missing from the dict are loaded on
+        first access.
+        @param obj_class_name: ORM table class, as a string
+        @param cached: dict returned by obj_to_cache
+        '''
+        obj = class_mapper(self.classes[obj_class_name]).class_manager.\
+            new_instance()
+        for key, value in cached.items():
+            setattr(obj, key, value)
+        make_transient_to_detached(obj)
+        return self.session.merge(obj, load=False)
+
     def get_authorized_pantries(self, user):
         '''Return a list of the pantries this user has access to,
         sorted by pantry id.
@@ -301,28 +1325,616 @@ class DBAccessor(object):
         '''
         return sorted(user.children, key=lambda pantry: pantry.id)
 
+    def user_can_access(self, user_id, pantry_id):
+        '''Return True if the user may access the pantry, using a single
+        EXISTS query on the pantry_access table.
+        @param user_id: int id of the user
+        @param pantry_id: int id of the pantry
+        '''
+        return self.session.query(exists().where(
+            and_(pantry_access.c.user_id == user_id,
+                 pantry_access.c.pantry_id == pantry_id))).scalar()
+
+    def category_in_pantry(self, category_id, pantry_id):
+        '''Return True if the category exists and belongs to the pantry, using
+        a single EXISTS query.
+        '''
+        return self.session.query(exists().where(
+            and_(Category.id == category_id,
+                 Category.parent_id == pantry_id))).scalar()
+
     def add_object(self, class_name, *args):
-        '''Add an object to the database.
+        '''Add an object to the database. The constructor sets the foreign
+        key to the parent, so neither the parent nor its other children are
+        loaded. A new pantry also gets an access row for its owner.
         @param obj: the object to add
         @param args: data for the columns of mapped class
         '''
         obj = self.classes[class_name](*args)
-        if class_name in self.parents:
-            parent_class = self.classes[self.parents[class_name]]
-            parent = self.session.query(parent_class)\
-                     .filter_by(id=obj.parent_id).one()
-            parent.children.append(obj)
         self.session.add(obj)
+        if class_name == 'Pantry':
+            # the pantry id is needed for the access row
+            self.session.flush()
+            self.session.execute(pantry_access.insert()
+                                 .values(user_id=obj.parent_id,
+                                         pantry_id=obj.id))
+            # reload the owner's pantries next time if already loaded
+            owner = self.session.identity_map.get(identity_key(User,
+                                                               obj.parent_id))
+            if owner is not None:
+                self.session.expire(owner, ['children'])
+        return obj
+
+    def add_objects(self, class_name, rows):
+        '''Insert many categories or items. The parent ids are validated with
+        one query and the rows are inserted with a single executemany, without
+        building ORM objects or loading the parents.
+        @param class_name: 'Category' or 'Item'
+        @param rows: list of dicts mapping column names to values
+        '''
+        if class_name not in ('Category', 'Item'):
+            raise ValueError('%s objects cannot be added in bulk.' % class_name)
+        parent_class = self.classes[self.parents[class_name]]
+        parent_ids = set(row['parent_id'] for row in rows)
+        # map each parent to its pantry, a pantry is its own
+        pantry_id = Pantry.id if parent_class is Pantry \
+                    else Category.parent_id
+        pantries = dict(self.session.query(parent_class.id, pantry_id)
+                        .filter(parent_class.id.in_(parent_ids)))
+        missing = sorted(parent_ids - set(pantries))
+        if missing:
+            raise ValueError('No %s with id %s.' % (self.parents[class_name],
+                             ', '.join(str(parent_id) for parent_id
+                                       in missing)))
+        self.bump_versions(pantry_ids=set(pantries.values()))
+        versions = dict(self.session.query(Pantry.id, Pantry.version)
+                        .filter(Pantry.id.in_(set(pantries.values()))))
+        # one counter update per pantry
+        deltas = {}
+        for row in rows:
+            delta = deltas.setdefault(pantries[row['parent_id']],
+                                      {'count' : 0, 'value' : 0})
+            delta['count'] += 1
+            delta['value'] += _value(row.get('quantity'), row.get('price'))
+        stats = PantryStats.__table__
+        for pantry_id, delta in deltas.items():
+            if class_name == 'Category':
+                values = {'category_count' : stats.c.category_count
+                                             + delta['count']}
+            else:
+                values = {'item_count' : stats.c.item_count + delta['count'],
+                          'total_value' : stats.c.total_value
+                                          + delta['value']}
+            self.session.execute(stats.update()
+                                 .where(stats.c.pantry_id == pantry_id)
+                                 .values(**values))
+        now = datetime.datetime.utcnow()
+        # give every row the same columns so they share one INSERT statement
+        columns = self.classes[class_name].__table__.columns.keys()
+        mappings = []
+        for row in rows:
+            mapping = dict((column, row.get(column)) for column in columns
+                           if column != 'id')
+            mapping['version'] = versions[pantries[row['parent_id']]]
+            mapping['updated_at'] = now
+            mappings.append(mapping)
+        self.session.bulk_insert_mappings(self.classes[class_name], mappings,
+                                          render_nulls=True)
+        return len(rows)
 
     def del_object(self, obj):
         '''Delete this object from the database and cascade to all children.
+        The rows are removed with bulk DELETE statements, children first, so
+        no children are loaded and the number of statements does not depend
+        on the number of rows. Deleting a user deletes the pantries the user
+        owns, but not pantries shared with the user.
+        '''
+        # write pending changes before their rows can be deleted
+        self.session.flush()
+        obj_class = type(obj)
+        if obj_class is User:
+            self._bulk_delete_pantries(Pantry.parent_id == obj.id)
+            self.session.execute(pantry_access.delete()
+                                 .where(pantry_access.c.user_id == obj.id))
+        elif obj_class is Pantry:
+            self._bulk_delete_pantries(Pantry.id == obj.id)
+        elif obj_class is Category:
+            self.session.query(Item).filter_by(parent_id=obj.id)\
+                .delete(synchronize_session=False)
+        if obj_class is not Pantry:
+            self.session.query(obj_class).filter_by(id=obj.id)\
+                .delete(synchronize_session=False)
+        # objects and collections loaded before the delete may refer to the
+        # deleted rows, so drop the object and reload the rest on next access
+        self.session.expunge(obj)
+        self.session.expire_all()
+
+    def get_child_ids(self, obj):
+        '''Return the ids of the rows deleted along with obj, by class name,
+        with one column query per class: the pantries a user owns, the
+        categories of a pantry and the items of a category.
+        @param obj: a user, pantry or category
         '''
-        self.session.delete(obj)
-        # relationship user---pantry is many to many so get owned pantries
-        # and delete them
-        if type(obj) is User:
-            child_pantries = filter(lambda pantry: pantry.parent_id == obj.id,
-                                    obj.children)
-            assert child_pantries is not None, "No child pantries found"
-            for child_pantry in child_pantries:
-                self.session.delete(child_pantry)
+        obj_class = type(obj)
+        ids = {}
+        if obj_class is User:
+            pantry_ids = self.session.query(Pantry.id)\
+                         .filter(Pantry.parent_id == obj.id)
+            ids['Pantry'] = [row.id for row in pantry_ids]
+            categories = Category.parent_id.in_(pantry_ids)
+        elif obj_class is Pantry:
+            categories = Category.parent_id == obj.id
+        if obj_class is Category:
+            items = Item.parent_id == obj.id
+        else:
+            category_ids = self.session.query(Category.id).filter(categories)
+            ids['Category'] = [row.id for row in category_ids]
+            items = Item.parent_id.in_(category_ids)
+        ids['Item'] = [row.id for row in
+                       self.session.query(Item.id).filter(items)]
+        return ids
+
+    def schedule_delete(self, obj, user_id):
+        '''Mark the pantry, or the user and the pantries the user owns, as
+        deleted and remove every access row to them and, for a user, the
+        user's access to shared pantries. Creates a pending job to delete the
+        remaining rows.
+        '''
+        obj_class = type(obj)
+        if obj_class is Pantry:
+            pantries = Pantry.id == obj.id
+        elif obj_class is User:
+            pantries = Pantry.parent_id == obj.id
+        else:
+            raise ValueError('%s objects cannot be deleted in the background.'
+                             % obj_class.__name__)
+        self.session.flush()
+        if obj_class is User:
+            self.session.query(User).filter_by(id=obj.id)\
+                .update({'deleted' : True}, synchronize_session=False)
+        self.session.query(Pantry).filter(pantries)\
+            .update({'deleted' : True}, synchronize_session=False)
+        pantry_ids = self.session.query(Pantry.id).filter(pantries)
+        access = pantry_access.c.pantry_id.in_(pantry_ids)
+        if obj_class is User:
+            access = or_(access, pantry_access.c.user_id == obj.id)
+        self.session.execute(pantry_access.delete().where(access))
+        job = Job(obj_class.__name__, obj.id, user_id)
+        self.session.add(job)
+        self.session.flush()
+        # loaded pantries and access collections are now out of date
+        self.session.expire_all()
+        return job
+
+    def claim_next_job(self, lease):
+        '''Mark the oldest pending job, or the oldest running job not heard
+        of for lease seconds, as running and return its id, or None. A job
+        is abandoned when its worker dies, and purge_batch can be run again
+        safely. The claim criteria are repeated in the UPDATE, which makes
+        the claim safe when several workers poll the same table.
+        '''
+        now = datetime.datetime.utcnow()
+        # running jobs claimed before the column existed have no claim time
+        waiting = or_(Job.status == 'pending',
+                      and_(Job.status == 'running',
+                           or_(Job.claimed == None,
+                               Job.claimed <= now - datetime.timedelta(
+                                   seconds=lease))))
+        while True:
+            job_id = self.session.query(Job.id).filter(waiting)\
+                     .order_by(Job.id).limit(1).scalar()
+            if job_id is None:
+                return None
+            claimed = self.session.query(Job)\
+                      .filter(Job.id == job_id, waiting)\
+                      .update({'status' : 'running', 'claimed' : now},
+                              synchronize_session=False)
+            if claimed:
+                return job_id
+
+    def get_job(self, job_id):
+        '''Return the job with this id, or None. Unlike get_obj a missing id
+        is not an error, since job ids come from the request path.
+        '''
+        return self.session.query(Job).filter_by(id=job_id).first()
+
+    def purge_batch(self, job, batch_size):
+        '''Delete up to batch_size rows of the job target, items first, then
+        categories, pantries and finally the user for user jobs. The rows are
+        looked up again by every batch, so rows written since the job was
+        scheduled are deleted too, access rows included.
+        @return: number of rows deleted, 0 once nothing is left
+        '''
+        if job.kind == 'User':
+            pantries = Pantry.parent_id == job.target_id
+        else:
+            pantries = Pantry.id == job.target_id
+        pantry_ids = self.session.query(Pantry.id).filter(pantries)
+        category_ids = self.session.query(Category.id)\
+                       .filter(Category.parent_id.in_(pantry_ids))
+        access = pantry_access.c.pantry_id.in_(pantry_ids)
+        if job.kind == 'User':
+            access = or_(access, pantry_access.c.user_id == job.target_id)
+        steps = [(Item, Item.parent_id.in_(category_ids)),
+                 (Category, Category.parent_id.in_(pantry_ids)),
+                 (Tombstone, Tombstone.pantry_id.in_(pantry_ids)),
+                 (PantryStats, PantryStats.pantry_id.in_(pantry_ids)),
+                 (pantry_access, access),
+                 (Pantry, pantries)]
+        if job.kind == 'User':
+            steps.append((User, User.id == job.target_id))
+        for model, criterion in steps:
+            if model is pantry_access:
+                # access rows are few, so they are not batched
+                deleted = self.session.execute(
+                    pantry_access.delete().where(criterion)).rowcount
+                if deleted:
+                    return deleted
+                continue
+            key = inspect(model).primary_key[0]
+            batch = self.session.query(key).filter(criterion)\
+                    .limit(batch_size)
+            deleted = self.session.query(model).filter(key.in_(batch))\
+                      .delete(synchronize_session=False)
+            if deleted:
+                return deleted
+        return 0
+
+    def _bulk_delete_pantries(self, criterion):
+        '''Delete the pantries matching criterion along with their categories,
+        items and access rows.
+        @param criterion: SQL expression selecting rows of the pantry table
+        '''
+        pantry_ids = self.session.query(Pantry.id).filter(criterion)
+        category_ids = self.session.query(Category.id)\
+                       .filter(Category.parent_id.in_(pantry_ids))
+        self.session.query(Item).filter(Item.parent_id.in_(category_ids))\
+            .delete(synchronize_session=False)
+        self.session.query(Category).filter(Category.parent_id.in_(pantry_ids))\
+            .delete(synchronize_session=False)
+        self.session.query(Tombstone)\
+            .filter(Tombstone.pantry_id.in_(pantry_ids))\
+            .delete(synchronize_session=False)
+        self.session.query(PantryStats)\
+            .filter(PantryStats.pantry_id.in_(pantry_ids))\
+            .delete(synchronize_session=False)
+        self.session.execute(pantry_access.delete()
+                             .where(pantry_access.c.pantry_id.in_(pantry_ids)))
+        self.session.query(Pantry).filter(criterion)\
+            .delete(synchronize_session=False)
+
+    def update_object(self, obj):
+        '''Add changes to this object to the session. Objects loaded by this
+        session are tracked already, so this matters for detached objects.
+        The change is flushed at once, which raises StaleDataError if the row
+        was deleted since obj was loaded or cached.
+        '''
+        self.session.add(obj)
+        self.session.flush()
+
+    def update_pantry_stats(self, obj, change):
+        '''Adjust the counters of the pantry obj belongs to for a change made
+        to obj, with one UPDATE that loads nothing. A new pantry gets a row of
+        zero counters. Must be called before a deleted object is deleted and
+        before an updated object is flushed, since the value an item had is
+        read from its attribute history.
+        @param obj: the pantry, category or item being written
+        @param change: 'add', 'update' or 'delete'
+        '''
+        stats = PantryStats.__table__
+        if isinstance(obj, Pantry):
+            if change == 'add':
+                self.session.add(PantryStats(obj.id))
+            return
+        elif isinstance(obj, Category):
+            if change == 'update':
+                return
+            pantry_id = obj.parent_id
+            if change == 'add':
+                values = {'category_count' : stats.c.category_count + 1}
+            else:
+                # the category's items are deleted with it
+                items = select([func.count(Item.id),
+                                func.coalesce(func.sum(Item.quantity
+                                                       * Item.price), 0)])\
+                        .where(Item.parent_id == obj.id)
+                values = {'category_count' : stats.c.category_count - 1,
+                          'item_count' : stats.c.item_count
+                                         - items.with_only_columns(
+                                           [func.count(Item.id)]).as_scalar(),
+                          'total_value' : stats.c.total_value
+                                          - items.with_only_columns(
+                                            [func.coalesce(func.sum(
+                                             Item.quantity * Item.price), 0)])
+                                          .as_scalar()}
+        elif isinstance(obj, Item):
+            pantry_id = select([Category.parent_id])\
+                        .where(Category.id == obj.parent_id).as_scalar()
+            value = _value(obj.quantity, obj.price)
+            if change == 'add':
+                values = {'item_count' : stats.c.item_count + 1,
+                          'total_value' : stats.c.total_value + value}
+            elif change == 'delete':
+                values = {'item_count' : stats.c.item_count - 1,
+                          'total_value' : stats.c.total_value - value}
+            else:
+                old_value = self._previous_value(obj)
+                if old_value is None:
+                    # the previous value was never loaded, so recompute
+                    self.session.flush()
+                    category_ids = select([Category.id])\
+                                   .where(Category.parent_id == pantry_id)
+                    values = {'total_value' : select([func.coalesce(func.sum(
+                                  Item.quantity * Item.price), 0)])
+                                  .where(Item.parent_id.in_(category_ids))
+                                  .as_scalar()}
+                elif old_value == value:
+                    return
+                else:
+                    values = {'total_value' : stats.c.total_value
+                                              + value - old_value}
+        else:
+            return
+        with self.session.no_autoflush:
+            self.session.execute(stats.update()
+                                 .where(stats.c.pantry_id == pantry_id)
+                                 .values(**values))
+
+    def _previous_value(self, item):
+        '''Return the value an item had when it was loaded, from the history
+        of its quantity and price, or None if a changed attribute was not
+        loaded before being set.
+        '''
+        previous = []
+        for name in ('quantity', 'price'):
+            history = inspect(item).attrs[name].history
+            if history.deleted:
+                previous.append(history.deleted[0])
+            elif history.added:
+                return None
+            else:
+                previous.append(getattr(item, name))
+        return _value(*previous)
+
+    def get_pantry_stats(self, pantry_ids):
+        '''Return the counters of the pantries with one query, see
+        DBInterface.get_pantry_stats.
+        @param pantry_ids: ids of the pantries
+        '''
+        if not pantry_ids:
+            return {}
+        rows = self.session.query(PantryStats.pantry_id,
+                                  PantryStats.category_count,
+                                  PantryStats.item_count,
+                                  PantryStats.total_value)\
+               .filter(PantryStats.pantry_id.in_(pantry_ids))
+        stats = {}
+        for row in rows:
+            stats[row.pantry_id] = {'category_count' : row.category_count,
+                                    'item_count' : row.item_count,
+                                    'total_value' : row.total_value}
+        missing = [pantry_id for pantry_id in pantry_ids
+                   if pantry_id not in stats]
+        if missing:
+            # pantries created before the stats table have no row yet
+            for row in self.session.execute(pantry_counters(missing)):
+                stats[row.pantry_id] = {'category_count' : row.category_count,
+                                        'item_count' : row.item_count,
+                                        'total_value' : row.total_value}
+        return stats
+
+    def rebuild_pantry_stats(self):
+        '''Replace every row of the pantry stats table, see
+        catalog_database_setup.rebuild_pantry_stats.
+        '''
+        self.session.flush()
+        rebuild_pantry_stats(self.session)
+        return self.session.query(func.count(PantryStats.pantry_id)).scalar()
+
+    def get_category_totals(self, pantry_id):
+        '''Return the totals of each category of a pantry with a single GROUP
+        BY over the categories outer joined to their items, so categories
+        without items are included. See DBInterface.get_pantry_summary.
+        @param pantry_id: int id of the pantry
+        '''
+        rows = self.session.query(
+                   Category.id, Category.name,
+                   func.count(Item.id).label('item_count'),
+                   func.coalesce(func.sum(Item.quantity), 0)
+                   .label('total_quantity'),
+                   func.coalesce(func.sum(Item.quantity * Item.price), 0)
+                   .label('total_value'))\
+               .outerjoin(Item, Item.parent_id == Category.id)\
+               .filter(Category.parent_id == pantry_id)\
+               .group_by(Category.id, Category.name)\
+               .order_by(Category.id)
+        return [row._asdict() for row in rows]
+
+    def get_pantry_version(self, pantry_id):
+        '''Return the version and modification time of a pantry, or None if
+        it does not exist or is being deleted. Only the two columns are
+        queried.
+        @param pantry_id: int id of the pantry
+        '''
+        return self.session.query(Pantry.version, Pantry.modified).\
+            filter(Pantry.id == pantry_id, Pantry.deleted == false()).first()
+
+    def bump_versions(self, pantry_ids=(), category_ids=()):
+        '''Increment the version of the given pantries and of the pantries
+        holding the given categories in a single UPDATE, so concurrent
+        requests cannot lose an increment. The pantry objects in the session
+        are not refreshed; versions are always read with get_pantry_version.
+        @param pantry_ids: ids of pantries
+        @param category_ids: ids of categories
+        '''
+        criteria = []
+        if pantry_ids:
+            criteria.append(Pantry.id.in_(pantry_ids))
+        if category_ids:
+            criteria.append(Pantry.id.in_(
+                self.session.query(Category.parent_id).
+                filter(Category.id.in_(category_ids))))
+        if not criteria:
+            return
+        # pending objects are flushed later, so their version can be set in
+        # the same INSERT or UPDATE, see stamp_version
+        with self.session.no_autoflush:
+            self.session.query(Pantry).filter(or_(*criteria)).\
+                update({Pantry.version : Pantry.version + 1,
+                        Pantry.modified : datetime.datetime.utcnow()},
+                       synchronize_session=False)
+
+    def get_pantry_versions(self, pantry_ids=(), category_ids=()):
+        '''Return a dict mapping the ids of the given pantries and of the
+        pantries holding the given categories to their versions, in a single
+        query of two columns. Called after bump_versions, it returns the
+        versions the current transaction wrote.
+        @param pantry_ids: ids of pantries
+        @param category_ids: ids of categories
+        '''
+        criteria = []
+        if pantry_ids:
+            criteria.append(Pantry.id.in_(pantry_ids))
+        if category_ids:
+            criteria.append(Pantry.id.in_(
+                self.session.query(Category.parent_id).
+                filter(Category.id.in_(category_ids))))
+        if not criteria:
+            return {}
+        # a stamped version is an expression flushed with its object later
+        with self.session.no_autoflush:
+            return dict(self.session.query(Pantry.id, Pantry.version).
+                        filter(or_(*criteria)))
+
+    def _pantry_version_of(self, obj):
+        '''Return SQL expressions for the id and the current version of the
+        pantry a category or an item belongs to, so neither is loaded.
+        '''
+        if isinstance(obj, Item):
+            pantry_id = select([Category.parent_id])\
+                        .where(Category.id == obj.parent_id).as_scalar()
+        else:
+            pantry_id = obj.parent_id
+        version = select([Pantry.version])\
+                  .where(Pantry.id == pantry_id).as_scalar()
+        return pantry_id, version
+
+    def stamp_version(self, obj):
+        '''Set the version of a category or an item to its pantry's. The
+        version is evaluated by the database when the object is flushed, after
+        bump_versions has incremented it.
+        '''
+        obj.version = self._pantry_version_of(obj)[1]
+        obj.updated_at = datetime.datetime.utcnow()
+
+    def add_tombstone(self, obj):
+        '''Record the deletion of a category or an item.
+        '''
+        pantry_id, version = self._pantry_version_of(obj)
+        self.session.add(Tombstone(obj.__class__.__name__, obj.id, pantry_id,
+                                   version))
+
+    def get_changes(self, pantry_id, since=None):
+        '''Return the changes to a pantry after a version, see DBInterface.
+        The version and the changes are read with column queries in the same
+        transaction, and the (parent_id, version) indexes serve the filters.
+        @param pantry_id: int id of the pantry
+        @param since: version the client has, or None
+        '''
+        version = self.session.query(Pantry.version)\
+                  .filter(Pantry.id == pantry_id).scalar()
+        categories = self.session.query(Category.name, Category.id,
+                                        Category.parent_id)\
+                     .filter(Category.parent_id == pantry_id)
+        category_ids = self.session.query(Category.id)\
+                       .filter(Category.parent_id == pantry_id)
+        items = self.session.query(Item.name, Item.id, Item.description,
+                                   Item.quantity, Item.price, Item.parent_id)\
+                .filter(Item.parent_id.in_(category_ids))
+        deleted = []
+        if since is not None:
+            categories = categories.filter(Category.version > since)
+            items = items.filter(Item.version > since)
+            deleted = self.session.query(Tombstone.kind,
+                                         Tombstone.object_id.label('id'),
+                                         Tombstone.version)\
+                      .filter(Tombstone.pantry_id == pantry_id,
+                              Tombstone.version > since)\
+                      .order_by(Tombstone.version, Tombstone.id)
+        return {'version' : version,
+                'categories' : [row._asdict() for row
+                                in categories.order_by(Category.id)],
+                'items' : [row._asdict() for row in items.order_by(Item.id)],
+                'deleted' : [row._asdict() for row in deleted]}
+
+    def get_obj_id(self, obj):
+        '''Return the id of an object without loading it, which also works
+        once the session it was added in is committed and closed.
+        '''
+        identity = inspect(obj).identity
+        return identity[0] if identity is not None else None
+
+    def get_previous_name(self, obj):
+        '''Return the name obj had when it was loaded, from its attribute
+        history, or None if it was changed without being loaded.
+        '''
+        history = inspect(obj).attrs.name.history
+        if history.deleted:
+            return history.deleted[0]
+        elif history.added:
+            return None
+        return obj.name
+
+    def get_pantry_names(self, pantry_id):
+        '''Return the names of the categories and items of a pantry with two
+        column queries, which load no objects.
+        @param pantry_id: int id of the pantry
+        @return: tuple of the list of (id, name) of the categories and the
+        list of (category id, name) of the items
+        '''
+        categories = self.session.query(Category.id, Category.name)\
+                     .filter(Category.parent_id == pantry_id)
+        category_ids = self.session.query(Category.id)\
+                       .filter(Category.parent_id == pantry_id)
+        items = self.session.query(Item.parent_id, Item.name)\
+                .filter(Item.parent_id.in_(category_ids))
+        return [tuple(row) for row in categories], [tuple(row) for row in items]
+
+    def search_items(self, pantry_ids, terms, limit, offset):
+        '''Return the ranked items of the pantries matching every term, see
+        DBInterface.search_items. On PostgreSQL the match is done on the GIN
+        index of ITEM_DOCUMENT and ranked with ts_rank, on SQLite on the FTS5
+        table and ranked with bm25. Other databases match with LIKE in id
+        order, reading every item of the pantries.
+        @param pantry_ids: ids of the pantries to search
+        @param terms: list of lower case words
+        @param limit: maximum number of results
+        @param offset: number of results skipped
+        '''
+        query = self.session.query(Item.name, Item.id, Item.description,
+                                   Item.quantity, Item.price, Item.parent_id,
+                                   Category.parent_id.label('pantry_id'))
+        dialect = self.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            document = literal_column(ITEM_DOCUMENT.format('item.'))
+            tsquery = func.plainto_tsquery('english', ' '.join(terms))
+            query = query.filter(document.op('@@')(tsquery))\
+                    .order_by(func.ts_rank(document, tsquery).desc(), Item.id)
+        elif dialect == 'sqlite':
+            search = table('item_search', column('rowid'), column('rank'),
+                           column('item_search'))
+            # quoted, so words like AND or NEAR are not read as operators
+            match = ' '.join('"%s"' % term for term in terms)
+            query = query.select_from(search)\
+                    .join(Item, Item.id == search.c.rowid)\
+                    .filter(search.c.item_search.match(match))\
+                    .order_by(search.c.rank, Item.id)
+        else:
+            for term in terms:
+                pattern = '%' + term + '%'
+                query = query.filter(or_(Item.name.ilike(pattern),
+                                         Item.description.ilike(pattern)))
+            query = query.order_by(Item.id)
+        query = query.join(Category, Category.id == Item.parent_id)\
+                .filter(Category.parent_id.in_(pantry_ids))
+        return [row._asdict() for row in query.limit(limit).offset(offset)]
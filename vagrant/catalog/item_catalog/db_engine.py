@@ -0,0 +1,191 @@
+'''
+This module builds the SQLAlchemy engine used by the application and the
+deployment scripts, and reports connection pool metrics.
+
+The engine is configured from the following environment variables, any of
+which can also be passed to make_engine as keyword arguments:
+CATALOG_DATABASE_URL - production database url
+CATALOG_TEST_DATABASE_URL - database url used when testing
+CATALOG_REPLICA_URL - optional url of a read replica for read-only requests,
+which use the production database if it is not set
+CATALOG_POOL_SIZE - connections kept open in the pool
+CATALOG_MAX_OVERFLOW - connections opened beyond the pool size under load
+CATALOG_POOL_TIMEOUT - seconds to wait for a connection before failing
+CATALOG_POOL_RECYCLE - seconds after which a connection is replaced, -1 never
+CATALOG_POOL_PRE_PING - if true, test connections when they are checked out
+CATALOG_STATEMENT_TIMEOUT - statement timeout in milliseconds (postgres only),
+0 for no timeout
+'''
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc, select
+from sqlalchemy.pool import QueuePool
+
+DATABASE_URL = 'postgresql://catalog:what a drag@localhost/catalog'
+TEST_DATABASE_URL = 'sqlite:///test_item_catalog.db'
+
+# settings and their defaults, keyed by make_engine keyword argument
+DEFAULTS = {'url' : DATABASE_URL,
+            'replica_url' : None,
+            'pool_size' : 5,
+            'max_overflow' : 10,
+            'pool_timeout' : 30,
+            'pool_recycle' : -1,
+            'pool_pre_ping' : False,
+            'statement_timeout' : 0}
+
+# environment variable for each setting
+ENVIRONMENT = {'url' : 'CATALOG_DATABASE_URL',
+               'replica_url' : 'CATALOG_REPLICA_URL',
+               'pool_size' : 'CATALOG_POOL_SIZE',
+               'max_overflow' : 'CATALOG_MAX_OVERFLOW',
+               'pool_timeout' : 'CATALOG_POOL_TIMEOUT',
+               'pool_recycle' : 'CATALOG_POOL_RECYCLE',
+               'pool_pre_ping' : 'CATALOG_POOL_PRE_PING',
+               'statement_timeout' : 'CATALOG_STATEMENT_TIMEOUT'}
+
+
+def engine_settings(testing=False, environ=None, **overrides):
+    '''Return the engine settings as a dict. Keyword arguments take precedence
+    over environment variables, which take precedence over the defaults.
+    @param testing: if true, the test database url is used, and no replica
+    @param environ: mapping to read settings from, defaults to os.environ
+    @param overrides: settings keyed as in DEFAULTS
+    '''
+    if environ is None:
+        environ = os.environ
+    settings = dict(DEFAULTS)
+    if testing:
+        settings['url'] = environ.get('CATALOG_TEST_DATABASE_URL',
+                                      TEST_DATABASE_URL)
+    for name, variable in ENVIRONMENT.items():
+        if testing and name in ('url', 'replica_url'):
+            continue
+        value = environ.get(variable)
+        if value is None:
+            continue
+        if isinstance(DEFAULTS[name], bool):
+            settings[name] = value.lower() in ('1', 'true', 'yes', 'on')
+        elif isinstance(DEFAULTS[name], int):
+            settings[name] = int(value)
+        else:
+            settings[name] = value
+    settings.update(overrides)
+    return settings
+
+
+def make_engine(testing=False, read_only=False, **overrides):
+    '''Create an engine configured by engine_settings. Pool settings only
+    apply to databases that use a connection pool, so they are ignored for
+    SQLite.
+    @param testing: if true, connect to the test database
+    @param read_only: if true, connect to the replica if there is one, and
+    make every transaction read only on postgres
+    @param overrides: settings keyed as in DEFAULTS
+    '''
+    settings = engine_settings(testing, **overrides)
+    url = settings['url']
+    if read_only and settings['replica_url']:
+        url = settings['replica_url']
+    if url.startswith('sqlite'):
+        engine = create_engine(url)
+        event.listen(engine, 'connect', _enable_foreign_keys)
+    else:
+        connect_args = {}
+        options = []
+        if url.startswith('postgresql'):
+            if settings['statement_timeout']:
+                options.append('-c statement_timeout=%d'
+                               % settings['statement_timeout'])
+            if read_only:
+                options.append('-c default_transaction_read_only=on')
+        if options:
+            connect_args['options'] = ' '.join(options)
+        engine = create_engine(url,
+                               poolclass=TimedQueuePool,
+                               pool_size=settings['pool_size'],
+                               max_overflow=settings['max_overflow'],
+                               pool_timeout=settings['pool_timeout'],
+                               pool_recycle=settings['pool_recycle'],
+                               connect_args=connect_args)
+    if settings['pool_pre_ping']:
+        event.listen(engine, 'engine_connect', _ping_connection)
+    return engine
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    '''SQLite only enforces foreign keys when asked to on each connection,
+    without which a row naming a missing parent is inserted as an orphan.
+    '''
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+def _ping_connection(connection, branch):
+    '''Test a connection when it is checked out and transparently reconnect
+    if the database has dropped it. This is the pessimistic disconnect
+    handling recipe for SQLAlchemy versions without pool_pre_ping.
+    '''
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        # the pool is invalidated when the error is a disconnect, so trying
+        # again opens a new connection
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool that records how long callers wait to check out a
+    connection, including the time taken to open overflow connections.
+    '''
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self._metrics_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            waited = time.time() - start
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.checkout_wait_total += waited
+                self.checkout_wait_max = max(self.checkout_wait_max, waited)
+
+
+def pool_metrics(engine):
+    '''Return a dict of connection pool metrics for this engine. Pools that do
+    not keep connections open, like the one used for SQLite, only report
+    their class.
+    @param engine: an engine created by make_engine
+    '''
+    pool = engine.pool
+    metrics = {'pool_class' : pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        metrics.update({'pool_size' : pool.size(),
+                        'checked_in' : pool.checkedin(),
+                        'checked_out' : pool.checkedout(),
+                        'overflow' : max(pool.overflow(), 0)})
+    if isinstance(pool, TimedQueuePool):
+        average = pool.checkout_wait_total / pool.checkouts \
+                  if pool.checkouts else 0.0
+        metrics.update({'checkouts' : pool.checkouts,
+                        'checkout_wait_avg_ms' : average * 1000,
+                        'checkout_wait_max_ms' : pool.checkout_wait_max * 1000})
+    return metrics
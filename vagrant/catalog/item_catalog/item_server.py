@@ -3,18 +3,28 @@ Created on Jul 8, 2017
 
 @author: kennethalamantia
 '''
+import csv
+import inspect
 import os
 import random, string
+import re
 from functools import wraps
 import json
+import zlib
 from flask import Flask, url_for, render_template, g, request, redirect, \
-abort, jsonify, session as flask_session, make_response, flash
+abort, jsonify, session as flask_session, make_response, flash, Response, \
+stream_with_context, Markup, has_request_context
 
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
 import httplib2
 import requests
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import NotFound
 from item_catalog.db_API import DBInterface
+from item_catalog.cache import AuthCache, LRUCache, NameIndex, ObjectCache
+from item_catalog.db_engine import engine_settings, pool_metrics
+from item_catalog.jobs import JobWorker
 app = Flask(__name__)
 
 CLIENT_SECRETS_PATH = os.path.abspath('client_secrets.json')
@@ -26,12 +36,19 @@ APPLICATION_NAME = 'Web client 1'
 # hooks into test code
 mock_database = None
 
+# users allowed to read the metrics endpoints, a comma separated list of
+# email addresses
+ADMIN_EMAILS = frozenset(email.strip() for email
+                         in os.environ.get('CATALOG_ADMIN_EMAILS', '')
+                         .split(',') if email.strip())
+
 # Routes
 
 # base
 EDIT = 'edit/'
 DEL = 'delete/'
 ADD = 'add/'
+STREAM = 'stream/'
 
 # actual
 HOME = '/'
@@ -41,12 +58,22 @@ JSON = 'json/'
 LOGIN = HOME + 'login/'
 LOGOUT = HOME + 'logout/'
 GCONNECT = '/gconnect'
+POOL_METRICS_JSON = '/metrics/pool/' + JSON
+CACHE_METRICS_JSON = '/metrics/cache/' + JSON
+JOB_JSON = '/job/<int:job_id>/' + JSON
+SEARCH = HOME + 'search/'
+SEARCH_JSON = SEARCH + JSON
 
 PANTRY = '/pantry/<int:pantry_id>/'
 EDIT_PANTRY = PANTRY + EDIT
 DEL_PANTRY = PANTRY + DEL
 ADD_PANTRY = '/pantry/' + ADD
 PANTRY_JSON = PANTRY + JSON
+PANTRY_JSON_STREAM = PANTRY_JSON + STREAM
+PANTRY_TREE_JSON = PANTRY + 'tree/' + JSON
+PANTRY_CHANGES_JSON = PANTRY + 'changes/' + JSON
+PANTRY_SUMMARY_JSON = PANTRY + 'summary/' + JSON
+PANTRY_COMPLETE_JSON = PANTRY + 'complete/' + JSON
 
 CATEGORY = PANTRY + 'category/<int:category_id>/'
 EDIT_CATEGORY = CATEGORY + EDIT
@@ -57,9 +84,12 @@ ITEM = CATEGORY + 'item/<int:item_id>/'
 EDIT_ITEM = ITEM + EDIT
 DEL_ITEM = ITEM + DEL
 ADD_ITEM = CATEGORY + 'item/' + ADD
+UPLOAD_ITEMS = ADD_ITEM + 'upload/'
 
 ALL_CATEGORIES_JSON = HOME + JSON
+ALL_CATEGORIES_JSON_STREAM = PANTRY + 'category/' + JSON + STREAM
 CATEGORY_JSON = CATEGORY + JSON
+CATEGORY_JSON_STREAM = CATEGORY_JSON + STREAM
 ITEM_JSON = ITEM + JSON
 
 # templates
@@ -67,9 +97,11 @@ ITEM_JSON = ITEM + JSON
 # general
 LOGIN_TEMPLATE = "login.html"
 LOGOUT_TEMPALTE = "logout.html"
+SEARCH_TMPLT = "search.html"
 
 # pantry
 P_INDEX_TMPLT = "pantry_index.html"
+P_TABLE_TMPLT = "pantry_table.html"
 P_ADD_TMPLT = "add_pantry.html"
 P_DEL_TMPLT = "del_pantry.html"
 P_EDIT_TMPLT = "edit_pantry.html"
@@ -77,6 +109,7 @@ P_EDIT_TMPLT = "edit_pantry.html"
 # category
 C_INDEX_TMPLT = "category_overview.html"
 C_DISP_TMPLT = "display_category.html"
+C_TABLE_TMPLT = "category_table.html"
 C_ADD_TMPLT = "add_category.html"
 C_DEL_TMPLT = "del_category.html"
 C_EDIT_TMPLT = "edit_category.html"
@@ -86,23 +119,138 @@ I_ADD_TMPLT = "add_item.html"
 I_DISP_TMPLT = "display_item.html"
 I_DEL_TMPLT = "del_item.html"
 I_EDIT_TMPLT = "edit_item.html"
+I_UPLOAD_TMPLT = "upload_items.html"
+I_TABLE_TMPLT = "item_table.html"
+
+# pagination
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# longest text allowed in uploaded items, the column sizes of the item table
+ITEM_FIELD_LENGTHS = (('name', 80), ('description', 250))
+
+# range filters of item listings, see DBInterface.get_item_page
+ITEM_FILTERS = ('min_price', 'max_price', 'quantity_below')
+
+# names returned by a type-ahead lookup, see complete_names_json
+DEFAULT_COMPLETE_SIZE = 10
+MAX_COMPLETE_SIZE = 50
+COMPLETE_KINDS = {'category' : 'Category', 'item' : 'Item'}
+
+# rows fetched per database round trip and written per chunk when streaming
+STREAM_BATCH_SIZE = 500
+
+# SQL Alchemy Globals, created on first use by get_session_maker and
+# get_read_session_maker
+session_maker = None
+read_session_maker = None
+
+# requests with these methods do not write and use read only sessions
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+# read only sessions connect to the replica if there is one. It may lag
+# behind the writes that invalidate the shared caches, so what is read from it
+# is not stored in them
+READ_FROM_REPLICA = bool(engine_settings()['replica_url'])
+
+# background job worker thread, started by get_job_worker
+JOB_POLL_INTERVAL = 5 # seconds
+job_worker = None
+
+# users and pantry access checks shared by all requests in this process
+AUTH_CACHE_SIZE = 4096
+AUTH_CACHE_TTL = 300 # seconds
+auth_cache = AuthCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+# pantries, categories and items looked up by id, shared by all requests in
+# this process. A memcached client can be passed to ObjectCache instead of the
+# LRUCache to share the cache between processes.
+OBJECT_CACHE_SIZE = 10000
+OBJECT_CACHE_TTL = 300 # seconds
+object_cache = ObjectCache(LRUCache(OBJECT_CACHE_SIZE, OBJECT_CACHE_TTL))
+
+# sorted category and item names of recently used pantries, for type-ahead
+NAME_INDEX_SIZE = 256
+name_index = NameIndex(NAME_INDEX_SIZE)
+
+# url format strings of views, built from the url map on first use by row_url
+url_formats = {}
+RULE_ARGUMENT = re.compile(r'<(?:[^<>:]+:)?([^<>]+)>')
+
+# rendered tables of pantries, categories and items, see render_fragment
+FRAGMENT_CACHE_SIZE = 1024
+FRAGMENT_CACHE_TTL = 300 # seconds
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+
+def get_session_maker():
+    '''Returns the global sessionmaker, creating it and its engine the first
+    time it is needed, so importing this module does not connect to the
+    database.
+    '''
+    global session_maker
+    if session_maker is None:
+        session_maker = DBInterface.make_session_factory()
+    return session_maker
+
+
+def get_read_session_maker():
+    '''Returns the global sessionmaker for read only requests, creating it
+    and its engine the first time it is needed.
+    '''
+    global read_session_maker
+    if read_session_maker is None:
+        read_session_maker = DBInterface.make_session_factory(read_only=True)
+    return read_session_maker
+
+
+def get_job_worker():
+    '''Returns the background job worker of this process, starting it the
+    first time it is needed.
+    '''
+    global job_worker
+    if job_worker is None:
+        job_worker = JobWorker(get_session_maker(), JOB_POLL_INTERVAL)
+        job_worker.start()
+    return job_worker
+
+
+@app.before_first_request
+def start_job_worker():
+    '''Start the job worker with the server so jobs left pending by a
+    previous run are picked up, and jobs it left running are claimed again
+    once their lease expires.
+    '''
+    if not app.testing:
+        get_job_worker()
 
-# SQL Alchemy Globals
-session_maker = DBInterface.make_session_factory()
 
 def get_db_api():
     '''Creates a new SQL Alchemy session from the global sessionmaker
-    factory object, if none exists.
+    factory object, if none exists. GET and HEAD requests get a session from
+    the read only sessionmaker, which is never committed; views must not
+    write in response to them.
     @return: SQLAlchemy Session, new or pre-existing for this app context.
     '''
     db_api = getattr(g, '_database', None)
     if db_api is None:
         if app.testing:
             assert mock_database is not None, "mock database not initialized"
-            g._database = DBInterface(mock_database, testing=True)
+            g._database = DBInterface(mock_database, testing=True,
+                                      auth_cache=auth_cache,
+                                      object_cache=object_cache,
+                                      name_index=name_index)
+        elif has_request_context() and request.method in READ_ONLY_METHODS:
+            session = get_read_session_maker()()
+            g._database = DBInterface(session=session, auth_cache=auth_cache,
+                                      object_cache=object_cache,
+                                      name_index=name_index,
+                                      read_only=True,
+                                      fill_caches=not READ_FROM_REPLICA)
         else:
-            session = session_maker()
-            g._database = DBInterface(session=session)
+            session = get_session_maker()()
+            g._database = DBInterface(session=session, auth_cache=auth_cache,
+                                      object_cache=object_cache,
+                                      name_index=name_index)
     return g._database
 
 
@@ -114,19 +262,189 @@ def teardown_session(exception):
     if not app.testing:
         db_interface = getattr(g, '_database', None)
         if db_interface:
-            if exception:
+            if db_interface.read_only:
+                # nothing to commit, closing ends the transaction
+                db_interface.db.session.close()
+            elif exception:
                 db_interface.db.session.rollback()
             else:
                 try:
                     db_interface.db.session.commit()
                 finally:
                     db_interface.db.session.close()
+                db_interface.invalidate_written()
+                # jobs are only visible to the worker once committed
+                if getattr(g, '_job_scheduled', False):
+                    get_job_worker().wake()
+
+
+@app.errorhandler(StaleDataError)
+def stale_object(error):
+    '''An object rebuilt from the object cache was deleted by another request
+    since it was cached, and a write to it matched no row. Its entry has been
+    dropped, so this is answered like the cache miss that finds it gone.
+    '''
+    get_db_api().db.session.rollback()
+    return NotFound()
+
+
+def render_fragment(template, key, load):
+    '''Render a template fragment, or return it from the fragment cache. The
+    key must change whenever the data shown does. Keys holding a pantry
+    version do, since every write made through DBInterface increments it, so
+    stale fragments are never served and simply age out of the cache.
+    Fragments rendered from a replica are not stored, see READ_FROM_REPLICA.
+    @param template: file name of the fragment template
+    @param key: tuple of values identifying the data shown
+    @param load: function returning the template context, only called when
+    the fragment is not cached
+    @return: the rendered fragment, safe to insert into another template
+    '''
+    cache_key = ':'.join(str(part) for part in (template,) + key)
+    fragment = fragment_cache.get(cache_key)
+    if fragment is None:
+        fragment = render_template(template, **load())
+        if get_db_api().fill_caches:
+            fragment_cache.set(cache_key, fragment)
+    return Markup(fragment)
+
+
+@app.template_global()
+def row_url(endpoint, **values):
+    '''Build the url of a view from its ids. Listing templates call this for
+    the links of every row, where url_for is the main cost of rendering
+    large pages. The rule of each endpoint, built from the route constants
+    above, is turned into a format string once, so a call only formats the
+    ids in. Unlike url_for, arguments are not converted or validated and
+    extra values are not added to the query string, so use it only for
+    views whose arguments are ids.
+    @param endpoint: name of the view function
+    @param values: the arguments of the route
+    '''
+    url_format = url_formats.get(endpoint)
+    if url_format is None:
+        rule = next(app.url_map.iter_rules(endpoint))
+        url_format = RULE_ARGUMENT.sub(r'{\1}', rule.rule)
+        url_formats[endpoint] = url_format
+    return request.script_root + url_format.format(**values)
+
+
+def get_page_args():
+    '''Read the keyset pagination arguments, limit and after, from the query
+    string of this request.
+    @return: tuple of the page size and the id after which the page starts
+    '''
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    after = request.args.get('after', None, type=int)
+    return min(max(limit, 1), MAX_PAGE_SIZE), after
+
+
+def get_item_page_args():
+    '''Read the sort, range filter and keyset pagination arguments of an item
+    listing from the query string of this request. The page starts after the
+    item with the id in after, whose value in the sort column is in
+    after_value, or absent if it has none.
+    @return: tuple of the page size, the sort column, the after tuple for
+    DBInterface.get_item_page and the dict of filters, or None if an
+    argument is invalid
+    '''
+    limit, after_id = get_page_args()
+    sort = request.args.get('sort', 'id')
+    if sort not in DBInterface.ITEM_SORTS:
+        return None
+    after = None
+    if after_id is not None:
+        value = request.args.get('after_value', None,
+                                 type=unicode if sort == 'name' else int)
+        after = (after_id if sort == 'id' else value, after_id)
+    filters = dict((name, request.args.get(name, None, type=int))
+                   for name in ITEM_FILTERS)
+    return limit, sort, after, filters
+
+
+def item_page_url(next_after, limit, sort, filters):
+    '''Build the url of the next page of the current item listing, keeping
+    its sort and filters.
+    @param next_after: tuple returned by DBInterface.get_item_page
+    @param limit: page size
+    @param sort: the sort column
+    @param filters: dict of the filters
+    @return: the url, or None if there is no next page
+    '''
+    if next_after is None:
+        return None
+    value, after = next_after
+    args = dict((name, filters[name]) for name in filters
+                if filters[name] is not None)
+    if sort != 'id':
+        args['sort'] = sort
+        if value is not None:
+            args['after_value'] = value
+    return url_for(request.endpoint, after=after, limit=limit,
+                   **dict(args, **request.view_args))
+
+
+def get_search_args():
+    '''Read the search query and the offset pagination arguments, limit and
+    offset, from the query string of this request.
+    @return: tuple of the query, the page size and the number of results
+    skipped
+    '''
+    query = request.args.get('q', '')
+    limit, _ = get_page_args()
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    return query, limit, offset
+
+
+def next_page_url(next_after, limit):
+    '''Build the url of the next page of the current view.
+    @param next_after: id returned by DBInterface.get_page for the next page
+    @param limit: page size
+    @return: the url, or None if there is no next page
+    '''
+    if next_after is None:
+        return None
+    return url_for(request.endpoint, after=next_after, limit=limit,
+                   **request.view_args)
+
+
+def stream_json(key, objects):
+    '''Build a chunked response serializing the objects as they are read, so
+    memory use does not grow with the number of objects. The response is a
+    JSON object holding the list under key, or newline delimited JSON if the
+    query string has format=ndjson.
+    @param key: name of the list in the JSON object
+    @param objects: iterable of model objects with a serialize property
+    '''
+    if request.args.get('format') == 'ndjson':
+        head, separator, line_end, tail = '', '', '\n', ''
+        mimetype = 'application/x-ndjson'
+    else:
+        head, separator, line_end, tail = '{"%s": [' % key, ', ', '', ']}'
+        mimetype = 'application/json'
+
+    def generate():
+        chunk = [head]
+        count = 0
+        for obj in objects:
+            if count:
+                chunk.append(separator)
+            chunk.append(json.dumps(obj.serialize) + line_end)
+            count += 1
+            if count % STREAM_BATCH_SIZE == 0:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(tail)
+        yield ''.join(chunk)
+    return Response(stream_with_context(generate()), mimetype=mimetype)
 
 
 def is_logged_in(fun):
     '''Checks to see if a user is logged in.
     This function will add a keyword argument 'user' for the user model object
-    that is authorized before returning the wrapped view function.
+    that is authorized before returning the wrapped view function. The user is
+    looked up through the auth cache. Users waiting to be deleted by a
+    background job are treated as unknown, so they cannot write any more.
     '''
     @wraps(fun)
     def wrapper(*args, **kwargs):
@@ -134,7 +452,7 @@ def is_logged_in(fun):
         if user_email is not None:
             db_api = get_db_api()
             user = db_api.get_user_by_email(user_email)
-            if user is not None:
+            if user is not None and not user.deleted:
                 kwargs['user'] = user
                 return fun(*args, **kwargs)
             else:
@@ -145,25 +463,46 @@ def is_logged_in(fun):
     return wrapper
 
 
+def is_admin(fun):
+    '''Checks whether a user is logged in and is an administrator, listed in
+    ADMIN_EMAILS. Other users get a 403 response.
+    This function will add a keyword argument 'user' for the user model object
+    before returning the wrapped view function.
+    '''
+    @wraps(fun)
+    @is_logged_in
+    def wrapper(*args, **kwargs):
+        if kwargs['user'].email not in ADMIN_EMAILS:
+            return abort(403)
+        return fun(*args, **kwargs)
+    return wrapper
+
+
 def is_authorized(fun):
     '''Checks whether a user is logged in and authorized to view a page. This
     wrapper cannot be used on view functions that do not take a pantry id as
     a keyword argument.
     This function will add a keyword argument 'user' for the user model object
-    that is authorized before returning the wrapped view function.
+    that is authorized before returning the wrapped view function. If the view
+    function takes a 'pantry' argument, the pantry model object is passed too,
+    so the view does not look it up again.
     '''
+    wants_pantry = 'pantry' in inspect.getargspec(fun).args
+
     @wraps(fun)
     def wrapper(*args, **kwargs):
         user_email = flask_session.get('email')
         if user_email is not None:
             db_api = get_db_api()
             user = db_api.get_user_by_email(user_email)
-            if user is not None:
+            if user is not None and not user.deleted:
                 pantry_id = kwargs.get('pantry_id')
                 assert pantry_id, "This function requires a pantry id."
-                pantry = db_api.get_db_object_by_id('Pantry', pantry_id)
-                if pantry in db_api.get_authorized_pantries(user):
+                if db_api.user_can_access(user.id, pantry_id):
                     kwargs['user'] = user
+                    if wants_pantry:
+                        kwargs['pantry'] = db_api.get_db_object_by_id(
+                            'Pantry', pantry_id)
                     return fun(*args, **kwargs)
                 else:
                     flash('You do not have access to that page.')
@@ -176,6 +515,44 @@ def is_authorized(fun):
     return wrapper
 
 
+def conditional(fun):
+    '''Answer conditional GET requests for a view of pantry data. The ETag
+    is built from the pantry version and the request path, so a request whose
+    If-None-Match or If-Modified-Since header is still current gets a 304
+    response without loading any rows. Use this below is_authorized, which
+    supplies the pantry id.
+    '''
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        pantry_id = kwargs.get('pantry_id')
+        assert pantry_id, "This function requires a pantry id."
+        pantry_version = get_db_api().get_pantry_version(pantry_id)
+        if pantry_version is None:
+            return abort(404)
+        version, modified = pantry_version
+        # each page and format of a listing is a separate representation
+        etag = '%d-%d-%x' % (pantry_id, version,
+                             zlib.crc32(request.full_path) & 0xffffffff)
+        if modified is not None:
+            # HTTP dates have a resolution of one second
+            modified = modified.replace(microsecond=0)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = modified is not None and \
+                           request.if_modified_since is not None and \
+                           modified <= request.if_modified_since
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(fun(*args, **kwargs))
+        response.set_etag(etag)
+        if modified is not None:
+            response.last_modified = modified
+        return response
+    return wrapper
+
+
 @app.route(HOME)
 def home():
     '''Reidirects to the home page, which is the pantry index page.
@@ -189,8 +566,15 @@ def pantry_index(user, **kwargs):
     '''
     db_api = get_db_api()
     all_pantries = db_api.get_authorized_pantries(user)
-    return render_template(P_INDEX_TMPLT,
-                           pantries=all_pantries)
+    versions = tuple('%d-%d' % (pantry.id, pantry.version)
+                     for pantry in all_pantries)
+    # the counters change with the version, so they are read on a miss only
+    table = render_fragment(P_TABLE_TMPLT, versions,
+                            lambda: {'pantries' : all_pantries,
+                                     'stats' : db_api.get_pantry_stats(
+                                         [pantry.id for pantry
+                                          in all_pantries])})
+    return render_template(P_INDEX_TMPLT, table=table)
 
 @app.route(ADD_PANTRY, methods=['GET', 'POST'])
 @is_logged_in
@@ -218,39 +602,40 @@ def add_pantry(user, **kwargs):
 
 @app.route(DEL_PANTRY, methods=['GET', 'POST'])
 @is_authorized
-def del_pantry(user, pantry_id, **kwargs):
+def del_pantry(user, pantry, pantry_id, **kwargs):
     '''Delete a pantry
     '''
     db_api = get_db_api()
-    this_pantry = db_api.get_db_object_by_id('Pantry', user.id)
-    all_categories = db_api.get_all_objects('Category', pantry_id)
     if request.method == 'POST' and request.form['confirm_del']:
-        db_api.del_object(this_pantry)
+        job = db_api.schedule_delete(pantry, user.id)
+        g._job_scheduled = True
+        flash('The pantry is being deleted. Progress: %s'
+              % url_for('get_job_json', job_id=job.id))
         return redirect(url_for('pantry_index'))
     else:
         return render_template(P_DEL_TMPLT,
-                               pantry=this_pantry,
-                               categories=all_categories)
+                               pantry=pantry,
+                               categories=db_api.get_all_objects('Category',
+                                                                 pantry_id))
 
 
 @app.route(EDIT_PANTRY, methods=['GET', 'POST'])
-@is_logged_in
-def edit_pantry(user, pantry_id, **kwargs):
+@is_authorized
+def edit_pantry(pantry, **kwargs):
     '''Edit a pantry.
     '''
-    db_api = get_db_api()
-    this_pantry = db_api.get_db_object_by_id('Pantry', pantry_id)
     if request.method == 'POST':
         edited_name = request.form.get('updated_name')
         if edited_name:
-            this_pantry.name = edited_name
+            pantry.name = edited_name
+            get_db_api().update_object(pantry)
             return redirect(url_for('pantry_index'))
         else:
             error = 'The pantry name cannot be blank.'
-            return render_template(P_EDIT_TMPLT, pantry=this_pantry,
+            return render_template(P_EDIT_TMPLT, pantry=pantry,
                                    form_error=error)
     else:
-        return render_template(P_EDIT_TMPLT, pantry=this_pantry)
+        return render_template(P_EDIT_TMPLT, pantry=pantry)
 
 
 @app.route(PANTRY_JSON)
@@ -259,8 +644,22 @@ def get_pantries_json(user, **kwargs):
     '''Display JSON for this user's pantries. Does not display shared pantries.
     '''
     db_api = get_db_api()
-    all_pantries = db_api.get_all_objects("Pantry", user.id)
-    return jsonify(all_pantries=[pantry.serialize for pantry in all_pantries])
+    limit, after = get_page_args()
+    all_pantries, next_after = db_api.get_page("Pantry", user.id, limit, after)
+    return jsonify(all_pantries=[pantry.serialize for pantry in all_pantries],
+                   next=next_page_url(next_after, limit))
+
+
+@app.route(PANTRY_JSON_STREAM)
+@is_logged_in
+def stream_pantries_json(user, **kwargs):
+    '''Stream JSON for all of this user's pantries. Does not include shared
+    pantries.
+    '''
+    db_api = get_db_api()
+    return stream_json('all_pantries',
+                       db_api.iter_all_objects('Pantry', user.id,
+                                               STREAM_BATCH_SIZE))
 
 
 @app.route(PANTRY, methods=['GET', 'POST'])
@@ -269,38 +668,163 @@ def category_index(pantry_id, **kwargs):
     '''Display the category index page.
     '''
     db_api = get_db_api()
-    all_categories = db_api.get_all_objects('Category', pantry_id)
-    return render_template(C_INDEX_TMPLT,
-                           categories=all_categories,
-                           pantry_id=pantry_id)
+    limit, after = get_page_args()
+    pantry_version = db_api.get_pantry_version(pantry_id)
+    if pantry_version is None:
+        # deleted since the access check
+        return abort(404)
+    version, _ = pantry_version
+
+    def load():
+        all_categories, next_after = db_api.get_page('Category', pantry_id,
+                                                     limit, after)
+        summary = db_api.get_pantry_summary(pantry_id)
+        return {'categories' : all_categories,
+                'pantry_id' : pantry_id,
+                'next_page' : next_page_url(next_after, limit),
+                'summary' : summary,
+                'totals' : dict((category['id'], category) for category
+                                in summary['categories'])}
+    table = render_fragment(C_TABLE_TMPLT, (pantry_id, version, limit, after),
+                            load)
+    return render_template(C_INDEX_TMPLT, table=table)
 
 @app.route(ALL_CATEGORIES_JSON)
 @is_authorized
+@conditional
 def get_categories_json(pantry_id, **kwargs):
     '''Provides a JSON representation of the current categories in the pantry.
     '''
     db_api = get_db_api()
-    all_categories = db_api.get_all_objects('Category', pantry_id)
+    limit, after = get_page_args()
+    all_categories, next_after = db_api.get_page('Category', pantry_id, limit,
+                                                 after)
     return jsonify(all_categories=[category.serialize for category
-                                   in all_categories])
+                                   in all_categories],
+                   next=next_page_url(next_after, limit))
+
+@app.route(PANTRY_TREE_JSON)
+@is_authorized
+@conditional
+def get_pantry_tree_json(pantry_id, **kwargs):
+    '''Provides a JSON representation of every category in the pantry with
+    its items, for clients that synchronize a whole pantry at once.
+    '''
+    db_api = get_db_api()
+    return jsonify(pantry_id=pantry_id,
+                   categories=db_api.get_pantry_tree(pantry_id))
+
+@app.route(PANTRY_CHANGES_JSON)
+@is_authorized
+@conditional
+def get_pantry_changes_json(pantry_id, **kwargs):
+    '''Provides the categories and items of the pantry written since the
+    version in the since argument, and the ids of those deleted since, for
+    clients that keep a copy of the pantry. Without since, every category and
+    item is returned. Items of a deleted category are not listed separately.
+    Clients pass the returned version as since on their next sync.
+    '''
+    db_api = get_db_api()
+    since = request.args.get('since', None, type=int)
+    changes = db_api.get_changes(pantry_id, since)
+    return jsonify(pantry_id=pantry_id, since=since, **changes)
+
+@app.route(PANTRY_SUMMARY_JSON)
+@is_authorized
+@conditional
+def get_pantry_summary_json(pantry_id, **kwargs):
+    '''Provides the item count, total quantity and total value of the pantry
+    and of each of its categories.
+    '''
+    db_api = get_db_api()
+    return jsonify(pantry_id=pantry_id, **db_api.get_pantry_summary(pantry_id))
+
+@app.route(PANTRY_COMPLETE_JSON)
+@is_authorized
+def complete_names_json(pantry_id, **kwargs):
+    '''Provides the names of the categories or items of the pantry starting
+    with the q argument, for type-ahead in the add forms. The kind argument
+    is category or item.
+    '''
+    kind = COMPLETE_KINDS.get(request.args.get('kind', 'item'))
+    if kind is None:
+        return abort(400)
+    limit = request.args.get('limit', DEFAULT_COMPLETE_SIZE, type=int)
+    names = get_db_api().complete_name(pantry_id, kind,
+                                       request.args.get('q', ''),
+                                       min(max(limit, 1), MAX_COMPLETE_SIZE))
+    if names is None:
+        return abort(404)
+    return jsonify(names=names)
+
+@app.route(ALL_CATEGORIES_JSON_STREAM)
+@is_authorized
+@conditional
+def stream_categories_json(pantry_id, **kwargs):
+    '''Stream JSON for all the categories in the pantry.
+    '''
+    db_api = get_db_api()
+    return stream_json('all_categories',
+                       db_api.iter_all_objects('Category', pantry_id,
+                                               STREAM_BATCH_SIZE))
+
 @app.route(CATEGORY)
 @is_authorized
 def display_category(pantry_id, category_id, **kwargs):
     '''Display individual category page.
     '''
     db_api = get_db_api()
-    this_category = db_api.get_db_object_by_id('Category', category_id)
-    all_items = db_api.get_all_objects('Item', category_id)
-    return render_template(C_DISP_TMPLT, category=this_category, items=all_items,
-                           pantry_id=pantry_id)
+    page_args = get_item_page_args()
+    if page_args is None:
+        return abort(400)
+    limit, sort, after, filters = page_args
+    pantry_version = db_api.get_pantry_version(pantry_id)
+    if pantry_version is None:
+        return abort(404)
+    version, _ = pantry_version
+
+    def load():
+        this_category = db_api.get_db_object_by_id('Category', category_id)
+        all_items, next_after = db_api.get_item_page(category_id, limit, sort,
+                                                     after, filters)
+        return {'category' : this_category,
+                'items' : all_items,
+                'pantry_id' : pantry_id,
+                'sort' : sort,
+                'filters' : filters,
+                'next_page' : item_page_url(next_after, limit, sort,
+                                            filters)}
+    key = (pantry_id, category_id, version, limit, sort, after) + \
+          tuple(filters[name] for name in ITEM_FILTERS)
+    table = render_fragment(I_TABLE_TMPLT, key, load)
+    return render_template(C_DISP_TMPLT, table=table)
 @app.route(CATEGORY_JSON)
 @is_authorized
+@conditional
 def get_category_json(pantry_id, category_id, **kwargs):
-    '''Return JSON for individual category.
+    '''Return JSON for individual category. The items can be sorted and
+    filtered like on the category page.
+    '''
+    db_api = get_db_api()
+    page_args = get_item_page_args()
+    if page_args is None:
+        return abort(400)
+    limit, sort, after, filters = page_args
+    all_items, next_after = db_api.get_item_page(category_id, limit, sort,
+                                                 after, filters)
+    return jsonify(all_items=[item.serialize for item in all_items],
+                   next=item_page_url(next_after, limit, sort, filters))
+
+@app.route(CATEGORY_JSON_STREAM)
+@is_authorized
+@conditional
+def stream_category_json(pantry_id, category_id, **kwargs):
+    '''Stream JSON for all the items in a category.
     '''
     db_api = get_db_api()
-    all_items = db_api.get_all_objects('Item', category_id)
-    return jsonify(all_items=[item.serialize for item in all_items])
+    return stream_json('all_items',
+                       db_api.iter_all_objects('Item', category_id,
+                                               STREAM_BATCH_SIZE))
 
 @app.route(EDIT_CATEGORY, methods=['GET', 'POST'])
 @is_authorized
@@ -312,6 +836,7 @@ def edit_category(pantry_id, category_id, **kwargs):
     if request.method == "POST":
         if request.form["updated_name"]:
             this_category.name = request.form["updated_name"]
+            db_api.update_object(this_category)
             return redirect(url_for("category_index", pantry_id=pantry_id))
         else:
             error = "You must type a new category name."
@@ -327,8 +852,7 @@ def del_category(pantry_id, category_id, **kwargs):
     '''Delete a category.
     '''
     db_api = get_db_api()
-    this_category = db_api.get_db_object_by_id('Category', category_id)
-    all_items = db_api.get_all_objects('Item', category_id)
+    this_category, all_items = db_api.get_category_with_items(category_id)
     if request.method == 'POST' and request.form['confirm_del']:
         db_api.del_object(this_category)
         return redirect(url_for('category_index', pantry_id=pantry_id))
@@ -366,14 +890,14 @@ def display_item(pantry_id, category_id, item_id, **kwargs):
     '''Display an item.
     '''
     db_api = get_db_api()
-    this_category = db_api.get_db_object_by_id('Category', category_id)
-    this_item = db_api.get_db_object_by_id('Item', item_id)
+    this_item, this_category = db_api.get_item_with_category(item_id)
     return render_template(I_DISP_TMPLT,
                            pantry_id=pantry_id,
                            category=this_category, item=this_item)
 
 @app.route(ITEM_JSON)
 @is_authorized
+@conditional
 def get_item_json(pantry_id, category_id, item_id, **kwargs):
     '''Return JSON for individual item.
     '''
@@ -389,8 +913,7 @@ def del_item(pantry_id, category_id, item_id, **kwargs):
     from form.
     '''
     db_api = get_db_api()
-    this_category = db_api.get_db_object_by_id('Category', category_id)
-    this_item = db_api.get_db_object_by_id('Item', item_id)
+    this_item, this_category = db_api.get_item_with_category(item_id)
     if request.method == 'POST' and request.form['confirm_del']:
         db_api.del_object(this_item)
         return redirect(url_for('display_category',
@@ -405,14 +928,14 @@ def edit_item(pantry_id, category_id, item_id, **kwargs):
     '''Display the page to edit an item and handle related post requests.
     '''
     db_api = get_db_api()
-    this_category = db_api.get_db_object_by_id('Category', category_id)
-    this_item = db_api.get_db_object_by_id('Item', item_id)
+    this_item, this_category = db_api.get_item_with_category(item_id)
     if request.method == 'POST':
         if request.form['item_name']:
             this_item.name = request.form['item_name']
-            this_item.quantity = request.form['quantity']
-            this_item.price = request.form['price']
+            this_item.quantity = request.form.get('quantity', type=int)
+            this_item.price = request.form.get('price', type=int)
             this_item.description = request.form['description']
+            db_api.update_object(this_item)
             return redirect(url_for('display_item', pantry_id=pantry_id,
                                     category_id=category_id, item_id=item_id))
         else:
@@ -434,22 +957,206 @@ def add_item(pantry_id, category_id, **kwargs):
     item.
     '''
     if request.method == 'POST':
+        db_api = get_db_api()
+        if not db_api.category_in_pantry(category_id, pantry_id):
+            return abort(404)
         if request.form["new_item_name"]:
-            db_api = get_db_api()
             db_api.add_object('Item',
-                         request.form["new_item_name"],
-                         request.form["quantity"],
-                         request.form["price"],
-                         request.form["description"],
-                         category_id)
+                              request.form["new_item_name"],
+                              request.form["description"],
+                              request.form.get("quantity", type=int),
+                              request.form.get("price", type=int),
+                              category_id)
             return redirect(url_for("display_category",
                                     pantry_id=pantry_id,
                                     category_id=category_id))
         else:
             return render_template(I_ADD_TMPLT, category=category_id,
+                                   pantry_id=pantry_id,
                                    name_error="A name is required.")
     else:
-        return render_template(I_ADD_TMPLT, category=category_id)
+        return render_template(I_ADD_TMPLT, category=category_id,
+                               pantry_id=pantry_id)
+
+
+def parse_item_number(value, number, field):
+    '''Convert the quantity or the price of an uploaded item to an int. CSV
+    files hold strings, JSON files may hold numbers too, which must be whole.
+    @param value: the value read from the file
+    @param number: position of the item in the file, for the error message
+    @param field: name of the field, for the error message
+    @raise ValueError: if the value is not a whole number
+    @return: the int value, or None if value is empty
+    '''
+    if value in (None, ''):
+        return None
+    if isinstance(value, bool) or \
+       (isinstance(value, float) and not value.is_integer()):
+        raise ValueError('Item %d has an invalid %s.' % (number, field))
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Item %d has an invalid %s.' % (number, field))
+
+
+def decode_csv_cell(value):
+    '''Decode a cell read by the csv module, which reads byte strings under
+    Python 2. Missing cells are None and extra cells a list; both are left
+    as they are.
+    '''
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+
+def parse_item_rows(upload, category_id):
+    '''Read the items in an uploaded CSV or JSON file. A CSV file needs a
+    header row and must be encoded in UTF-8, a JSON file must hold a list of
+    objects. Both use the fields name, description, quantity and price.
+    @param upload: the uploaded file from request.files
+    @param category_id: id of the category the items are added to
+    @raise ValueError: with a message for the user if the file is invalid
+    @return: list of dicts ready for DBInterface.add_objects
+    '''
+    if upload.filename.lower().endswith('.json'):
+        try:
+            records = json.load(upload.stream)
+        except ValueError:
+            raise ValueError('The file is not valid JSON.')
+        if not isinstance(records, list):
+            raise ValueError('The JSON file must contain a list of items.')
+    else:
+        try:
+            records = [dict((decode_csv_cell(key), decode_csv_cell(value))
+                            for key, value in record.iteritems())
+                       for record in csv.DictReader(upload.stream)]
+        except UnicodeDecodeError:
+            raise ValueError('The file is not valid UTF-8.')
+        except csv.Error:
+            raise ValueError('The file is not valid CSV.')
+    rows = []
+    for number, record in enumerate(records, 1):
+        if not isinstance(record, dict) or not record.get('name'):
+            raise ValueError('Item %d has no name.' % number)
+        row = {'name' : record['name'],
+               'description' : record.get('description'),
+               'parent_id' : category_id}
+        for field, length in ITEM_FIELD_LENGTHS:
+            value = row[field]
+            if value is not None and not isinstance(value, basestring):
+                raise ValueError('Item %d has an invalid %s.' % (number, field))
+            if value is not None and len(value) > length:
+                raise ValueError('Item %d has a %s longer than %d characters.'
+                                 % (number, field, length))
+        for field in ('quantity', 'price'):
+            row[field] = parse_item_number(record.get(field), number, field)
+        rows.append(row)
+    if not rows:
+        raise ValueError('The file contains no items.')
+    return rows
+
+
+@app.route(UPLOAD_ITEMS, methods=['GET', 'POST'])
+@is_authorized
+def upload_items(pantry_id, category_id, **kwargs):
+    '''Displays the page to upload a file of items and adds all the items in
+    the uploaded file with a single bulk insert.
+    '''
+    if request.method == 'POST':
+        if not get_db_api().category_in_pantry(category_id, pantry_id):
+            return abort(404)
+        upload = request.files.get('items_file')
+        if upload is None or not upload.filename:
+            return render_template(I_UPLOAD_TMPLT, pantry_id=pantry_id,
+                                   category_id=category_id,
+                                   form_error='Choose a file to upload.')
+        try:
+            rows = parse_item_rows(upload, category_id)
+            get_db_api().add_objects('Item', rows)
+        except ValueError as error:
+            return render_template(I_UPLOAD_TMPLT, pantry_id=pantry_id,
+                                   category_id=category_id,
+                                   form_error=str(error))
+        return redirect(url_for('display_category',
+                                pantry_id=pantry_id,
+                                category_id=category_id))
+    else:
+        return render_template(I_UPLOAD_TMPLT, pantry_id=pantry_id,
+                               category_id=category_id)
+
+
+def search_pantries(user):
+    '''Search the items of every pantry the user can access with the
+    arguments of this request.
+    @param user: the logged in user
+    @return: tuple of the query, the list of results as returned by
+    DBInterface.search_items and the url of the next page, or None
+    '''
+    db_api = get_db_api()
+    query, limit, offset = get_search_args()
+    pantry_ids = [pantry.id for pantry
+                  in db_api.get_authorized_pantries(user)]
+    results, more = db_api.search_items(pantry_ids, query, limit, offset)
+    next_page = None
+    if more:
+        next_page = url_for(request.endpoint, q=query, limit=limit,
+                            offset=offset + limit)
+    return query, results, next_page
+
+
+@app.route(SEARCH)
+@is_logged_in
+def search_items(user, **kwargs):
+    '''Display the items of the user's pantries matching a search, best
+    matches first.
+    '''
+    query, results, next_page = search_pantries(user)
+    return render_template(SEARCH_TMPLT, query=query, results=results,
+                           next_page=next_page)
+
+
+@app.route(SEARCH_JSON)
+@is_logged_in
+def search_items_json(user, **kwargs):
+    '''Return JSON for the items of the user's pantries matching a search.
+    '''
+    query, results, next_page = search_pantries(user)
+    return jsonify(query=query, results=results, next=next_page)
+
+
+@app.route(JOB_JSON)
+@is_logged_in
+def get_job_json(user, job_id, **kwargs):
+    '''Report the status and progress of a background job requested by this
+    user.
+    '''
+    db_api = get_db_api()
+    job = db_api.get_job(job_id)
+    if job is None or job.user_id != user.id:
+        return abort(404)
+    return jsonify(job=job.serialize)
+
+
+@app.route(POOL_METRICS_JSON)
+@is_admin
+def get_pool_metrics_json(**kwargs):
+    '''Report connection pool metrics, used to size the pool against the
+    number of server workers. The pool used by read only requests is
+    reported as read_pool. Each is empty until its first database request.
+    Only administrators may read them.
+    '''
+    pools = {}
+    for name, maker in (('pool', session_maker),
+                        ('read_pool', read_session_maker)):
+        pools[name] = pool_metrics(maker.kw['bind']) if maker else {}
+    return jsonify(**pools)
+
+
+@app.route(CACHE_METRICS_JSON)
+@is_admin
+def get_cache_metrics_json(**kwargs):
+    '''Report the hit and miss counters of the object cache. Only
+    administrators may read them.
+    '''
+    return jsonify(objects=object_cache.stats())
 
 
 @app.route(LOGIN)
@@ -501,8 +1208,12 @@ def checkUser():
     db_api = get_db_api()
     user = db_api.get_user_by_email(flask_session['email'])
     if user is not None:
+        if user.deleted:
+            # the user is being deleted, see is_logged_in
+            return
         if user.name != flask_session['username']:
             user.name = flask_session['username']
+            db_api.update_object(user)
     else:
         user = db_api.add_object('User', flask_session['username'],
                             flask_session['email'])
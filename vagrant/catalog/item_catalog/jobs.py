@@ -0,0 +1,123 @@
+'''
+This module runs the background jobs created by DBInterface.schedule_delete.
+A job deletes a large pantry, or a user and the pantries the user owns, in
+batches, committing after each batch so that locks are held briefly and the
+progress of the job can be read from the job table while it runs.
+
+Jobs are stored in the database, so they survive a restart and any number of
+workers can share them. A worker records the time of every batch on its job;
+a running job not heard of for JOB_LEASE seconds, because its worker died or
+was restarted, is claimed again by another worker. The application starts a
+JobWorker thread in each server process; a worker can also be run as a
+separate process with
+    python -m item_catalog.jobs
+'''
+import datetime
+import logging
+import threading
+
+from item_catalog.db_API import DBInterface
+
+# rows deleted per statement and per commit
+PURGE_BATCH_SIZE = 1000
+# seconds without progress after which a running job is claimed again, much
+# longer than a batch takes
+JOB_LEASE = 300
+
+logger = logging.getLogger(__name__)
+
+
+def run_job(session_maker, job_id, batch_size=PURGE_BATCH_SIZE):
+    '''Run a claimed job until its target is deleted. If an error occurs the
+    job is marked failed with the error message. If even that fails the job
+    is left running and is claimed again once its lease expires.
+    @param session_maker: SQLAlchemy session factory
+    @param job_id: id of a job returned by DBInterface.claim_next_job
+    @param batch_size: rows deleted per statement and per commit
+    '''
+    session = session_maker()
+    db_api = DBInterface(session)
+    try:
+        job = db_api.get_db_object_by_id('Job', job_id)
+        while True:
+            deleted = db_api.purge_batch(job, batch_size)
+            if not deleted:
+                break
+            job.progress += deleted
+            # renew the lease
+            job.claimed = datetime.datetime.utcnow()
+            session.commit()
+        job.status = 'done'
+        session.commit()
+    except Exception as error:
+        logger.exception('Job %d failed.', job_id)
+        session.rollback()
+        try:
+            job = db_api.get_db_object_by_id('Job', job_id)
+            job.status = 'failed'
+            job.error = str(error)[:250]
+            session.commit()
+        except Exception:
+            logger.exception('Job %d could not be marked failed.', job_id)
+            session.rollback()
+    finally:
+        session.close()
+
+
+def run_pending_jobs(session_maker, batch_size=PURGE_BATCH_SIZE,
+                     lease=JOB_LEASE):
+    '''Run pending and abandoned jobs one after another, oldest first, until
+    none are left.
+    @param session_maker: SQLAlchemy session factory
+    @param batch_size: rows deleted per statement and per commit
+    @param lease: seconds after which a running job is deemed abandoned
+    @return: the number of jobs run
+    '''
+    count = 0
+    while True:
+        session = session_maker()
+        try:
+            job_id = DBInterface(session).claim_next_job(lease)
+            session.commit()
+        finally:
+            session.close()
+        if job_id is None:
+            return count
+        run_job(session_maker, job_id, batch_size)
+        count += 1
+
+
+class JobWorker(threading.Thread):
+    '''Daemon thread that runs pending and abandoned jobs. It checks for
+    jobs every poll_interval seconds, or at once when woken after a job is
+    scheduled.
+    '''
+    def __init__(self, session_maker, poll_interval=5,
+                 batch_size=PURGE_BATCH_SIZE, lease=JOB_LEASE):
+        threading.Thread.__init__(self, name='job-worker')
+        self.daemon = True
+        self.session_maker = session_maker
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease = lease
+        self._wake = threading.Event()
+
+    def wake(self):
+        '''Check for pending jobs now instead of at the next poll.
+        '''
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                run_pending_jobs(self.session_maker, self.batch_size,
+                                 self.lease)
+            except Exception:
+                logger.exception('Error while looking for pending jobs.')
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    JobWorker(DBInterface.make_session_factory()).run()
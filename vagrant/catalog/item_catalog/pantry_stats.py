@@ -0,0 +1,28 @@
+'''
+This module rebuilds the pantry_stats table, which holds the category count,
+item count and total value of each pantry shown by the pantry index. The
+counters are kept up to date by DBInterface as categories and items are
+written, and create_db(migrate=True) rebuilds them. Rebuilding them again
+repairs any drift caused by rows written without DBInterface. Run it with
+    python -m item_catalog.pantry_stats
+'''
+from item_catalog.db_API import DBInterface
+
+
+def rebuild(session_maker):
+    '''Recompute the counters of every pantry in one transaction.
+    @param session_maker: SQLAlchemy session factory
+    @return: the number of pantries
+    '''
+    session = session_maker()
+    try:
+        count = DBInterface(session).rebuild_pantry_stats()
+        session.commit()
+        return count
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    print 'Rebuilt the counters of %d pantries.' % rebuild(
+        DBInterface.make_session_factory())
@@ -7,24 +7,161 @@ This module is a mock implementation of the database schema model implemented
 in the catalog_database_setup module. This is for testing purposes. The MockDB
 class is used in the db_API module only. Refer this this module when testing
 without the actual database.
+
+Each model class is stored in a MockTable, which indexes its rows so that
+lookups by id, parent, name and email take constant time however many rows
+the mock database holds.
 '''
+from collections import OrderedDict
+
+
+class MockTable(object):
+    '''The rows of one mock model class. Rows are indexed by id, by parent id,
+    by (parent id, name) and, if they have one, by email. Iterating over the
+    table yields the rows in the order they were added, which is id order.
+    Rows must be added with increasing ids.
+    '''
+    def __init__(self, rows=()):
+        self.by_id = OrderedDict()
+        # parent id -> OrderedDict of id -> row
+        self.by_parent = {}
+        # (parent id, name) -> OrderedDict of id -> row, names are not unique
+        self.by_name = {}
+        self.by_email = {}
+        self.last_id = 0
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        '''Add a row and index it.
+        '''
+        self.by_id[row.id] = row
+        self.last_id = max(self.last_id, row.id)
+        self._index(row)
+        row._table = self
+
+    def remove(self, row):
+        '''Remove a row and its index entries. Raises ValueError if the row
+        is not in the table, like list.remove.
+        '''
+        if row not in self:
+            raise ValueError('%r is not in the table' % row)
+        row._table = None
+        self._unindex(row)
+        del self.by_id[row.id]
+
+    def get(self, row_id):
+        '''Return the row with this id, or None.
+        '''
+        return self.by_id.get(row_id)
+
+    def next_id(self):
+        return self.last_id + 1
+
+    def children(self, parent_id):
+        '''Return the rows with this parent id in id order.
+        '''
+        return self.by_parent.get(parent_id, {}).values()
+
+    def first_by_name(self, name, parent_id):
+        '''Return the first row with this name and parent id, or None.
+        '''
+        rows = self.by_name.get((parent_id, name))
+        return rows.itervalues().next() if rows else None
+
+    def _keys(self, row, changed):
+        '''Return the (index, key) pairs of row affected by a change to the
+        attribute changed, or to every attribute if changed is None.
+        '''
+        parent_id = getattr(row, 'parent_id', None)
+        name = getattr(row, 'name', None)
+        keys = []
+        if changed in (None, 'parent_id'):
+            keys.append((self.by_parent, parent_id))
+        if changed in (None, 'parent_id', 'name'):
+            keys.append((self.by_name, (parent_id, name)))
+        return keys
+
+    def _index(self, row, changed=None):
+        for index, key in self._keys(row, changed):
+            rows = index.setdefault(key, OrderedDict())
+            if rows and next(reversed(rows)) > row.id:
+                # a row moved here from another key, keep id order
+                items = rows.items() + [(row.id, row)]
+                rows.clear()
+                rows.update(sorted(items))
+            else:
+                rows[row.id] = row
+        email = getattr(row, 'email', None)
+        if changed in (None, 'email') and email is not None:
+            self.by_email[email] = row
+
+    def _unindex(self, row, changed=None):
+        for index, key in self._keys(row, changed):
+            rows = index[key]
+            del rows[row.id]
+            if not rows:
+                del index[key]
+        if changed in (None, 'email') and \
+           getattr(row, 'email', None) is not None:
+            del self.by_email[row.email]
+
+    def __iter__(self):
+        return self.by_id.itervalues()
+
+    def __len__(self):
+        return len(self.by_id)
 
-class User(object):
+    def __contains__(self, row):
+        return self.by_id.get(row.id) is row
+
+    def __getitem__(self, position):
+        '''Return the row at this position in id order. This takes linear
+        time and is meant for tests.
+        '''
+        return self.by_id.values()[position]
+
+
+class MockModel(object):
+    '''Base class of the mock models. Changing an indexed attribute of a row
+    in a MockTable updates the indexes holding that attribute, just as editing
+    a mapped object is seen by later queries.
+    '''
+    INDEXED = ('parent_id', 'name', 'email')
+    _table = None
+
+    def __setattr__(self, name, value):
+        table = self._table
+        if table is not None and name in self.INDEXED and \
+           getattr(self, name, None) != value:
+            table._unindex(self, name)
+            object.__setattr__(self, name, value)
+            table._index(self, name)
+        else:
+            object.__setattr__(self, name, value)
+
+
+class User(MockModel):
     def __init__(self, id, name, email, picture, pantries):
         self.id = id
         self.name = name
         self.email = email
         self.picture = picture
-        self.pantries = pantries
+        # ids of the pantries this user can access
+        self.pantries = set(pantries)
+        self.deleted = False
         
     def __repr__(self):
         return self.name
         
-class Pantry(object):
+class Pantry(MockModel):
     def __init__(self, id, name, parent_id):
         self.id = id
         self.name = name
         self.parent_id = parent_id
+        self.deleted = False
+        self.version = 0
+        self.modified = None
         
     def __repr__(self):
         return self.name
@@ -37,11 +174,12 @@ class Pantry(object):
                 'id' : self.id,
                 'parent_id' : self.parent_id}
         
-class Category(object):
+class Category(MockModel):
     def __init__(self, id, name, parent_id):
         self.id = id
         self.name = name
         self.parent_id = parent_id
+        self.version = 0
         
     def __repr__(self):
         return self.name
@@ -56,7 +194,7 @@ class Category(object):
                 'parent_id' : self.parent_id
                 }
 
-class Item(object):
+class Item(MockModel):
     def __init__(self, id, name, description, quantity, price, category_id):
         self.id = id
         self.name = name
@@ -64,6 +202,7 @@ class Item(object):
         self.quantity = quantity
         self.price = price
         self.parent_id = category_id
+        self.version = 0
     
     def __repr__(self):
         return self.name
@@ -78,21 +217,56 @@ class Item(object):
                 'parent_id' : self.parent_id,
                 }
 
+class Tombstone(MockModel):
+    def __init__(self, id, kind, object_id, pantry_id, version):
+        self.id = id
+        self.kind = kind
+        self.object_id = object_id
+        self.pantry_id = pantry_id
+        self.version = version
+
+    @property
+    def serialize(self):
+        return {'kind' : self.kind,
+                'id' : self.object_id,
+                'version' : self.version
+                }
+
+class Job(MockModel):
+    def __init__(self, id, kind, target_id, user_id):
+        self.id = id
+        self.kind = kind
+        self.target_id = target_id
+        self.user_id = user_id
+        self.status = 'pending'
+        self.progress = 0
+        self.error = None
+
+    @property
+    def serialize(self):
+        return {'id' : self.id,
+                'kind' : self.kind,
+                'target_id' : self.target_id,
+                'status' : self.status,
+                'progress' : self.progress,
+                'error' : self.error
+                }
+
 class MockDB(object):
 
     def __init__(self):
         '''Creates entities to populate the mock database.
         '''
-        self.mock_users = (User(1, 'A', 'A@aaa.com', 'A_picture', [1,2,4]),
+        self.mock_users = MockTable((User(1, 'A', 'A@aaa.com', 'A_picture', [1,2,4]),
                            User(2, 'B', 'B@bbb.com', 'B_pic', [2,3]),
-                           User(3, 'C', 'C@ccc.com', 'C_pic', [3]))
+                           User(3, 'C', 'C@ccc.com', 'C_pic', [3])))
         
-        self.pantries = [Pantry(1, 'Pantry_A', 1),
+        self.pantries = MockTable([Pantry(1, 'Pantry_A', 1),
                          Pantry(2, 'Pantry_B', 2),
                          Pantry(3, 'Pantry_C', 3),
-                         Pantry(4, 'Pantry_D', 1)]
+                         Pantry(4, 'Pantry_D', 1)])
         
-        self.categories = [Category(1, 'vegetables', 1),
+        self.categories = MockTable([Category(1, 'vegetables', 1),
                            Category(2, 'starches', 1),
                            Category(3, 'desserts', 1),
                            Category(4, 'veggies', 2),
@@ -100,22 +274,32 @@ class MockDB(object):
                            Category(6, 'meat', 2),
                            Category(7, 'fruit', 3),
                            Category(8, 'meat', 3),
-                           Category(9, 'drinks', 3)]
+                           Category(9, 'drinks', 3)])
         
-        self.items = [Item(1, 'apple', 'shiny and red', 5, 1.0, 1),  # 0
+        self.items = MockTable([Item(1, 'apple', 'shiny and red', 5, 1.0, 1),
                       Item(2, 'broccoli', 'small tree', 10, 0.5, 1), # 1
                       Item(3, 'chips', 'crispy', 4, 5.0, 5),         # 2
                       Item(4, 'steak', 'high in protein', 1, 20.0, 8),
                       Item(5, 'seltzer', 'fizzy', 15, 1.0, 3),
                       Item(6, 'cake', 'moist', 1, 15.0, 3),
-                      Item(7, 'potato', 'high in carbs', 50, 0.20, 2)]
+                      Item(7, 'potato', 'high in carbs', 50, 0.20, 2)])
+
+        self.jobs = MockTable()
+        self.tombstones = MockTable()
+        # pantry id -> counters kept by MockDBAccessor.update_pantry_stats,
+        # pantries without counters have them computed when read
+        self.pantry_stats = {}
         
         self.mock_db = {'User' : self.mock_users,
                         'Pantry' : self.pantries,
                         'Category' : self.categories,
-                        'Item' : self.items}
+                        'Item' : self.items,
+                        'Job' : self.jobs,
+                        'Tombstone' : self.tombstones}
         
         self.constructor = {'User' : User,
                             'Pantry' : Pantry,
                             'Category' : Category,
-                            'Item' : Item}
+                            'Item' : Item,
+                            'Job' : Job,
+                            'Tombstone' : Tombstone}
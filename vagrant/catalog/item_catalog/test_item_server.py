@@ -5,11 +5,42 @@ Created on Aug 5, 2017
 
 This module contains a test suite for the item_server and db_API modules.
 '''
+import json
 import unittest
+from StringIO import StringIO
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.datastructures import FileStorage
 import item_server
 from item_catalog.test_db_populator import MockDB
 from item_catalog.db_API import DBInterface
 from item_catalog.actual_db_populator import MockDB as Mock
+from item_catalog.catalog_database_setup import Category, Item, \
+                                                PantryStats, create_db
+from item_catalog import cache as cache_module
+from item_catalog.cache import AuthCache, LRUCache, NameIndex, ObjectCache
+from item_catalog.db_engine import TimedQueuePool, engine_settings, \
+                                   make_engine, pool_metrics
+from item_catalog.jobs import run_pending_jobs
+
+
+class StatementRecorder(object):
+    '''Context manager that records the SQL statements executed on an engine.
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self.statements
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
 
 
 class TestMockDatabase(unittest.TestCase):
@@ -45,6 +76,75 @@ class TestMockDatabase(unittest.TestCase):
         # check getting object that does not exist
         self.assertEqual(self.db.get_db_object_by_id('Category', 17), None)
         self.assertEqual(self.db.get_user_by_email('A@aaa.com').name, 'A')
+
+    def testGetAllObjectsPaged(self):
+        '''Test keyset pagination on the mock db.
+        '''
+        self.assertListEqual(self.db.get_all_objects('Category', 1, limit=2),
+                             self.mDB.categories[0:2])
+        self.assertListEqual(self.db.get_all_objects('Category', 1, after=1),
+                             self.mDB.categories[1:3])
+        page, next_after = self.db.get_page('Category', 1, 2, after=1)
+        self.assertListEqual(page, self.mDB.categories[1:3])
+        self.assertEqual(next_after, None)
+
+    def testPantryStats(self):
+        '''Test that the mock keeps the counters as objects are written, and
+        that they match the counters rebuilt from the rows.
+        '''
+        self.assertEqual(self.db.rebuild_pantry_stats(), 4)
+        self.db.add_object('Item', 'grub', 'a great food', 3, 4, 1)
+        item = self.db.get_dbobject_by_name('Item', 'apple', 1)
+        item.quantity = 10
+        self.db.update_object(item)
+        self.db.del_object(self.db.get_db_object_by_id('Category', 3))
+        self.db.add_objects('Item', [{'name' : 'pear', 'quantity' : 2,
+                                      'price' : 5, 'parent_id' : 2}])
+        self.db.add_object('Pantry', 'Pantry_E', 1)
+        stats = self.db.get_pantry_stats([1, 2, 3, 5])
+        self.assertEqual(stats[1], {'category_count' : 2, 'item_count' : 5,
+                                    'total_value' : 47})
+        self.assertEqual(stats[5], {'category_count' : 0, 'item_count' : 0,
+                                    'total_value' : 0})
+        self.mDB.pantry_stats.clear()
+        self.assertEqual(self.db.get_pantry_stats([1, 2, 3, 5]), stats)
+
+    def testGetAllObjectsPagedRenamed(self):
+        '''Test that renaming or moving a row keeps the mock db's id order.
+        '''
+        first = self.mDB.categories[0]
+        first.name = 'greens'
+        self.db.update_object(first)
+        page, next_after = self.db.get_page('Category', 1, 2)
+        self.assertListEqual(page, self.mDB.categories[0:2])
+        self.assertEqual(next_after, 2)
+        self.assertEqual(self.db.get_dbobject_by_name('Category', 'greens', 1),
+                         first)
+        moved = self.mDB.categories[3]
+        moved.parent_id = 1
+        self.assertListEqual(self.db.get_all_objects('Category', 1, after=2),
+                             [self.mDB.categories[2], moved])
+        first.parent_id = 2
+        self.assertListEqual(self.db.get_all_objects('Category', 2),
+                             [first] + self.mDB.categories[4:6])
+
+    def testCompositeLoaders(self):
+        '''Test loading a category with its items and an item with its
+        category on the mock db.
+        '''
+        category, items = self.db.get_category_with_items(3)
+        self.assertEqual(category.name, 'desserts')
+        self.assertListEqual(items, [self.mDB.items[4], self.mDB.items[5]])
+        item, category = self.db.get_item_with_category(4)
+        self.assertEqual((item.name, category.name), ('steak', 'meat'))
+        self.assertEqual(self.db.get_item_with_category(17), (None, None))
+
+    def testUserCanAccess(self):
+        '''Test pantry access checks on the mock db.
+        '''
+        self.assertTrue(self.db.user_can_access(1, 2))
+        self.assertFalse(self.db.user_can_access(2, 1))
+        self.assertFalse(self.db.user_can_access(1, 17))
         
     def testAdd(self):
         '''Test add operations on mock db
@@ -56,6 +156,17 @@ class TestMockDatabase(unittest.TestCase):
                          'pear')
         self.assertEqual(self.db.get_db_object_by_id('Item', 8).id, 8)
         
+    def testAddObjects(self):
+        '''Test bulk add operations on mock db
+        '''
+        rows = [{'name' : 'pear', 'quantity' : 1, 'parent_id' : 1},
+                {'name' : 'plum', 'quantity' : 2, 'parent_id' : 2}]
+        self.assertEqual(self.db.add_objects('Item', rows), 2)
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'plum', 2).id, 9)
+        self.assertRaises(ValueError, self.db.add_objects, 'Item',
+                          [{'name' : 'fig', 'parent_id' : 17}])
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'fig', 17), None)
+
     def testDelete(self):
         '''Test delete operations on mock db
         '''
@@ -73,12 +184,42 @@ class TestMockDatabase(unittest.TestCase):
         self.assertTrue(self.db.get_dbobject_by_name('Category', "meats", 2), 
                         "update to meats failed")
 
+    def testIndexesFollowEdits(self):
+        '''Test that moving and renaming a row updates the mock db indexes,
+        and that deleted rows leave them.
+        '''
+        item = self.db.get_db_object_by_id('Item', 5)
+        item.parent_id = 1
+        item.name = 'sorbet'
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'sorbet', 1),
+                         item)
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'seltzer', 3),
+                         None)
+        self.assertNotIn(item, self.db.get_all_objects('Item', 3))
+        self.assertEqual(self.db.get_all_objects('Item', 1)[-1], item)
+        self.db.del_object(item)
+        self.assertNotIn(item, self.db.get_all_objects('Item', 1))
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'sorbet', 1),
+                         None)
+        self.assertRaises(ValueError, self.mDB.items.remove, item)
+
+    def testIdsNotReused(self):
+        '''Test that deleting the last row does not free its id.
+        '''
+        self.db.del_object(self.db.get_db_object_by_id('Item', 7))
+        self.assertEqual(self.db.add_object('Item', 'pear', 'pear-shaped',
+                                            1, 1.0, 1).id, 8)
+
 class TestServer(unittest.TestCase):
     def setUp(self):
         item_server.app.testing = True
         self.app = item_server.app.test_client()
         self.mDB = MockDB()
         item_server.mock_database = self.mDB
+        item_server.auth_cache.clear()
+        item_server.object_cache.clear()
+        item_server.fragment_cache.clear()
+        item_server.name_index.clear()
         
     def tearDown(self):
         item_server.mock_database = None
@@ -130,6 +271,30 @@ class TestServer(unittest.TestCase):
                                 new_pantry_name='grub')
         self.assertTrue('grub' in r.data, r.data)
         
+    def testAddPantryDeletedUser(self):
+        '''Test that a user waiting to be deleted can no longer add a pantry
+        or view one.
+        '''
+        self.mDB.mock_db.get('User').by_email['A@aaa.com'].deleted = True
+        self.setSession('A@aaa.com')
+        r = self.setPostRequest('/pantry/add/', new_pantry_name='grub')
+        self.assertEqual(r.status_code, 404)
+        r = self.setGetRequest('/pantry/1/')
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(self.mDB.pantries.first_by_name('grub', 1), None)
+
+    def testPantryDeletedAfterAccessCheck(self):
+        '''Test that pages of a pantry that is gone when its version is read
+        are not found.
+        '''
+        self.setSession('A@aaa.com')
+        # user A still has access, but the pantry row is gone
+        self.mDB.pantries.remove(self.mDB.pantries.get(1))
+        r = self.setGetRequest('/pantry/1/')
+        self.assertEqual(r.status_code, 404)
+        r = self.setGetRequest('/pantry/1/category/1/')
+        self.assertEqual(r.status_code, 404)
+
     def testAddPantryDuplicate(self):
         '''Test adding pantry with duplicate name.
         '''
@@ -155,6 +320,30 @@ class TestServer(unittest.TestCase):
         r = self.setPostRequest('/pantry/1/delete/', confirm_del=1)
         self.assertFalse('Pantry_A' in r.data, r.data)
         
+    def testDelPantryNotFirst(self):
+        '''Test that the pantry in the url is deleted, not the pantry whose
+        id is the user's.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setPostRequest('/pantry/4/delete/', confirm_del=1)
+        self.assertTrue('Pantry_A' in r.data, r.data)
+        self.assertFalse('Pantry_D' in r.data, r.data)
+
+    def testDelPantryJob(self):
+        '''Test that the job deleting a pantry is visible to its requester
+        only.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setPostRequest('/pantry/1/delete/', confirm_del=1)
+        self.assertTrue('/job/1/json/' in r.data, r.data)
+        r = self.setGetRequest('/job/1/json/')
+        self.assertEqual(json.loads(r.data)['job']['status'], 'done')
+        self.setSession('B@bbb.com')
+        r = self.setGetRequest('/job/1/json/')
+        self.assertEqual(r.status_code, 404)
+        r = self.setGetRequest('/job/999/json/')
+        self.assertEqual(r.status_code, 404)
+
     def testDelPantryForm(self):
         self.setSession('A@aaa.com')
         r = self.setGetRequest('/pantry/1/delete/')
@@ -171,6 +360,14 @@ class TestServer(unittest.TestCase):
         self.assertTrue('B_Pantry' in pr.data, pr.data)
         self.assertTrue('Pantry_B' not in pr.data, pr.data)
         
+    def testEditPantryWrongUser(self):
+        '''Test that a user cannot rename a pantry they cannot access.
+        '''
+        self.setSession('C@ccc.com')
+        r = self.setPostRequest('/pantry/2/edit/', updated_name='C_Pantry')
+        self.assertTrue('You do not have access' in r.data, r.data)
+        self.assertEqual(self.mDB.pantries.get(2).name, 'Pantry_B')
+
     def testEditPantryNoName(self):
         self.setSession('B@bbb.com')
         r = self.setPostRequest('/pantry/2/edit/', updated_name = '')
@@ -262,6 +459,34 @@ class TestServer(unittest.TestCase):
         self.assertTrue('veggies' not in r.data)
         self.assertTrue('grub' in r.data, r.data)
 
+    def testCategoryIndexFragmentCache(self):
+        '''Test that the category table is rendered once and rendered again
+        after a category is renamed.
+        '''
+        self.setSession('B@bbb.com')
+        self.setGetRequest('/pantry/2/')
+        r = self.setGetRequest('/pantry/2/')
+        self.assertTrue('veggies' in r.data, r.data)
+        self.assertEqual(item_server.fragment_cache.hits, 1)
+        r = self.setPostRequest('pantry/2/category/4/edit/',
+                                updated_name='grub')
+        self.assertTrue('veggies' not in r.data)
+        self.assertTrue('grub' in r.data, r.data)
+        self.assertEqual(item_server.fragment_cache.hits, 1)
+
+    def testRowUrl(self):
+        '''Test that row_url builds the same links as url_for.
+        '''
+        with item_server.app.test_request_context():
+            for endpoint, values in (('edit_pantry', {'pantry_id' : 12}),
+                                     ('display_category',
+                                      {'pantry_id' : 1, 'category_id' : 3}),
+                                     ('del_item', {'pantry_id' : 1,
+                                                   'category_id' : 3,
+                                                   'item_id' : 104})):
+                self.assertEqual(item_server.row_url(endpoint, **values),
+                                 item_server.url_for(endpoint, **values))
+
     def testEditCategoryError(self):
         '''Test editing a category to have no name
         '''
@@ -277,6 +502,245 @@ class TestServer(unittest.TestCase):
         r = self.setGetRequest('/pantry/1/category/1/json')
         self.assertTrue('apple' and 'broccoli' in r.data, r.data)
         
+    def testCategoryJSONNotModified(self):
+        '''Test that a current ETag gets a 304 response, and that adding an
+        item to the pantry changes the ETag.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.app.get('/pantry/1/category/1/json/')
+        etag = r.headers['ETag']
+        r = self.app.get('/pantry/1/category/1/json/',
+                         headers={'If-None-Match' : etag})
+        self.assertEqual((r.status_code, r.data), (304, ''))
+        # another page of the listing is another representation
+        r = self.app.get('/pantry/1/category/1/json/?limit=1',
+                         headers={'If-None-Match' : etag})
+        self.assertEqual(r.status_code, 200)
+        self.setPostRequest('pantry/1/category/2/item/add/',
+                            new_item_name='grub', quantity=1, price=1,
+                            description='food')
+        r = self.app.get('/pantry/1/category/1/json/',
+                         headers={'If-None-Match' : etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+        r = self.app.get('/pantry/1/category/1/json/',
+                         headers={'If-Modified-Since' :
+                                  r.headers['Last-Modified']})
+        self.assertEqual(r.status_code, 304)
+
+    def testPantryChangesJSON(self):
+        '''Test syncing a pantry from the version of an earlier sync.
+        '''
+        self.setSession('A@aaa.com')
+        r = json.loads(self.setGetRequest('/pantry/1/changes/json/').data)
+        self.assertEqual(len(r['categories']), 3)
+        self.setPostRequest('pantry/1/category/2/item/add/',
+                            new_item_name='grub', quantity=1, price=1,
+                            description='food')
+        self.setPostRequest('/pantry/1/category/1/item/1/delete/',
+                            confirm_del=1)
+        r = json.loads(self.setGetRequest('/pantry/1/changes/json/?since=%d'
+                                          % r['version']).data)
+        self.assertEqual((r['categories'], [item['name'] for item
+                                            in r['items']]), ([], ['grub']))
+        self.assertEqual([(tombstone['kind'], tombstone['id']) for tombstone
+                          in r['deleted']], [('Item', 1)])
+
+    def testPantrySummaryJSON(self):
+        '''Test the pantry totals, including an item added through the form,
+        and their display on the category index.
+        '''
+        self.setSession('A@aaa.com')
+        self.setPostRequest('pantry/1/category/1/item/add/',
+                            new_item_name='grub', quantity=3, price=2,
+                            description='food')
+        r = json.loads(self.setGetRequest('/pantry/1/summary/json/').data)
+        self.assertEqual(r['categories'][0],
+                         {'id' : 1, 'name' : 'vegetables', 'item_count' : 3,
+                          'total_quantity' : 18, 'total_value' : 16})
+        self.assertEqual((r['item_count'], r['total_quantity']), (6, 84))
+        r = self.setGetRequest('/pantry/1/')
+        self.assertTrue('6 items, total quantity 84' in r.data, r.data)
+
+    def testPantryIndexStats(self):
+        '''Test that the pantry index shows the counters of each pantry.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setGetRequest('/pantry/')
+        self.assertTrue('3 categories, 5 items' in r.data, r.data)
+        self.setPostRequest('pantry/1/category/1/item/add/',
+                            new_item_name='grub', quantity=3, price=2,
+                            description='food')
+        r = self.setGetRequest('/pantry/')
+        self.assertTrue('3 categories, 6 items' in r.data, r.data)
+
+    def testCompleteNamesJSON(self):
+        '''Test type-ahead on the names of a pantry, including an item added
+        after the names were indexed.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setGetRequest('/pantry/1/complete/json/?kind=item&q=P')
+        self.assertEqual(json.loads(r.data)['names'], ['potato'])
+        self.setPostRequest('pantry/1/category/1/item/add/',
+                            new_item_name='Pear', quantity=1, price=1,
+                            description='')
+        r = self.setGetRequest('/pantry/1/complete/json/?kind=item&q=p')
+        self.assertEqual(json.loads(r.data)['names'], ['Pear', 'potato'])
+        r = self.setGetRequest('/pantry/1/complete/json/?kind=category&q=de')
+        self.assertEqual(json.loads(r.data)['names'], ['desserts'])
+        r = self.setGetRequest('/pantry/1/complete/json/?kind=pantry')
+        self.assertEqual(r.status_code, 400)
+        r = self.setGetRequest('/pantry/1/category/1/item/add/')
+        self.assertTrue('/pantry/1/complete/json/?kind=item' in r.data,
+                        r.data)
+
+    def testCategoryJSONSorted(self):
+        '''Test sorting and filtering the items of a category, with items
+        without a price last and the sort kept on the next page.
+        '''
+        self.setSession('A@aaa.com')
+        self.setPostRequest('pantry/1/category/3/item/add/',
+                            new_item_name='grub', quantity=2, price='',
+                            description='food')
+        names = lambda r: [item['name'] for item in r['all_items']]
+        r = json.loads(self.setGetRequest(
+            '/pantry/1/category/3/json/?sort=price&limit=2').data)
+        self.assertEqual(names(r), ['seltzer', 'cake'])
+        self.assertTrue('sort=price' in r['next'], r['next'])
+        r = json.loads(self.setGetRequest(r['next']).data)
+        self.assertEqual((names(r), r['next']), (['grub'], None))
+        r = json.loads(self.setGetRequest(
+            '/pantry/1/category/3/json/?sort=quantity&quantity_below=10')
+            .data)
+        self.assertEqual(names(r), ['cake', 'grub'])
+        r = json.loads(self.setGetRequest(
+            '/pantry/1/category/3/json/?sort=name&min_price=1&max_price=5')
+            .data)
+        self.assertEqual(names(r), ['seltzer'])
+        r = self.setGetRequest('/pantry/1/category/3/json/?sort=description')
+        self.assertEqual(r.status_code, 400)
+        r = self.setGetRequest('/pantry/1/category/3/?sort=quantity')
+        self.assertTrue(r.data.index('cake') < r.data.index('seltzer'),
+                        r.data)
+
+    def testPoolMetricsJSON(self):
+        '''Test that only administrators can read the pool metrics, which are
+        empty before any connection.
+        '''
+        r = self.app.get('/metrics/pool/json/')
+        self.assertEqual(r.status_code, 302)
+        self.setSession('A@aaa.com')
+        r = self.app.get('/metrics/pool/json/')
+        self.assertEqual(r.status_code, 403)
+        admins = item_server.ADMIN_EMAILS
+        item_server.ADMIN_EMAILS = frozenset(['A@aaa.com'])
+        try:
+            r = self.app.get('/metrics/pool/json/')
+        finally:
+            item_server.ADMIN_EMAILS = admins
+        self.assertTrue('"pool": {}' in r.data, r.data)
+
+    def testCacheMetricsJSON(self):
+        '''Test that only administrators can read the cache metrics.
+        '''
+        r = self.app.get('/metrics/cache/json/')
+        self.assertEqual(r.status_code, 302)
+        self.setSession('A@aaa.com')
+        r = self.app.get('/metrics/cache/json/')
+        self.assertEqual(r.status_code, 403)
+        admins = item_server.ADMIN_EMAILS
+        item_server.ADMIN_EMAILS = frozenset(['A@aaa.com'])
+        try:
+            r = self.app.get('/metrics/cache/json/')
+        finally:
+            item_server.ADMIN_EMAILS = admins
+        self.assertTrue('"hit_ratio"' in r.data, r.data)
+
+    def testSearch(self):
+        '''Test that a search only finds items of the user's pantries.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setGetRequest('/search/?q=high')
+        self.assertTrue('potato' in r.data, r.data)
+        self.assertFalse('steak' in r.data, r.data)
+        self.assertTrue('/pantry/1/category/2/item/7/' in r.data, r.data)
+
+    def testSearchJSONPaged(self):
+        '''Test that ranked search results are paged with an offset.
+        '''
+        self.setSession('A@aaa.com')
+        self.setPostRequest('pantry/1/category/1/item/add/',
+                            new_item_name='grub', quantity=1, price=1,
+                            description='high in fiber')
+        r = json.loads(self.setGetRequest('/search/json/?q=HIGH&limit=1')
+                       .data)
+        self.assertEqual([item['name'] for item in r['results']], ['potato'])
+        r = json.loads(self.setGetRequest(r['next']).data)
+        self.assertEqual([item['name'] for item in r['results']], ['grub'])
+        self.assertEqual(r['next'], None)
+
+    def testCategoryJSONPaged(self):
+        '''Test that a limited JSON listing links to the next page.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setGetRequest('/pantry/1/category/1/json/?limit=1')
+        self.assertTrue('apple' in r.data, r.data)
+        self.assertFalse('broccoli' in r.data, r.data)
+        self.assertTrue('/pantry/1/category/1/json/?' in r.data, r.data)
+        r = self.setGetRequest('/pantry/1/category/1/json/?limit=1&after=1')
+        self.assertTrue('broccoli' in r.data, r.data)
+        self.assertTrue('"next": null' in r.data, r.data)
+
+    def testCategoryIndexPaged(self):
+        '''Test the next page link on the category index.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setGetRequest('/pantry/1/?limit=2')
+        self.assertTrue('starches' in r.data, r.data)
+        self.assertFalse('desserts' in r.data, r.data)
+        self.assertTrue('Next page' in r.data, r.data)
+        r = self.setGetRequest('/pantry/1/?limit=2&after=2')
+        self.assertTrue('desserts' in r.data, r.data)
+        self.assertFalse('Next page' in r.data, r.data)
+
+    def testCategoryJSONStream(self):
+        '''Test streaming the items of a category as a JSON object.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setGetRequest('/pantry/1/category/1/json/stream/')
+        self.assertEqual([item['name'] for item
+                          in json.loads(r.data)['all_items']],
+                         ['apple', 'broccoli'])
+
+    def testCategoriesNDJSONStream(self):
+        '''Test streaming the categories of a pantry as NDJSON, with more
+        categories than fit in one chunk.
+        '''
+        self.setSession('A@aaa.com')
+        batch_size = item_server.STREAM_BATCH_SIZE
+        item_server.STREAM_BATCH_SIZE = 2
+        try:
+            r = self.setGetRequest('/pantry/1/category/json/stream/' \
+                                   '?format=ndjson')
+        finally:
+            item_server.STREAM_BATCH_SIZE = batch_size
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['name'] for line
+                          in r.data.splitlines()],
+                         ['vegetables', 'starches', 'desserts'])
+
+    def testPantryTreeJSON(self):
+        '''Test the nested JSON of every category and item in pantry 2.
+        '''
+        self.setSession('A@aaa.com')
+        r = self.setGetRequest('/pantry/2/tree/json/')
+        tree = json.loads(r.data)['categories']
+        self.assertEqual([(category['name'],
+                           [item['name'] for item in category['items']])
+                          for category in tree],
+                         [('veggies', []), ('snacks', ['chips']),
+                          ('meat', [])])
+
     def testDispItem1(self):
         self.setSession('A@aaa.com')
         r = self.setGetRequest('/pantry/1/category/1/item/1/')
@@ -294,6 +758,18 @@ class TestServer(unittest.TestCase):
                                 description='food')
         self.assertTrue('grub' in r.data, r.data)
         
+    def testAddItemMissingCategory(self):
+        '''Test that adding an item to a category that does not exist, or
+        that belongs to another pantry, answers 404.
+        '''
+        self.setSession('B@bbb.com')
+        for category_id in (99, 8):
+            r = self.app.post('pantry/2/category/%d/item/add/' % category_id,
+                              data={'new_item_name' : 'grub',
+                                    'description' : 'food'})
+            self.assertEqual(r.status_code, 404)
+        self.assertEqual(self.db_item('grub', 8), None)
+
     def testAddItemNoName(self):
         '''Test for adding an item without a name. Tests for error message.
         '''
@@ -305,6 +781,83 @@ class TestServer(unittest.TestCase):
                                 description='food')
         self.assertTrue('A name is required.' in r.data, r.data)
         
+    def testUploadItemsCSV(self):
+        '''Test adding the items in an uploaded CSV file.
+        '''
+        self.setSession('B@bbb.com')
+        csv_file = StringIO('name,description,quantity,price\n' \
+                            'pretzels,salty,3,2\npopcorn,,1,\n')
+        r = self.app.post('/pantry/2/category/5/item/add/upload/',
+                          data={'items_file' : (csv_file, 'items.csv')},
+                          follow_redirects=True)
+        self.assertTrue('pretzels' in r.data, r.data)
+        self.assertTrue('popcorn' in r.data, r.data)
+        self.assertEqual(self.db_item('popcorn', 5).price, None)
+
+    def testUploadItemsNotUTF8(self):
+        '''Test that a CSV file in another encoding than UTF-8 is reported.
+        '''
+        self.setSession('B@bbb.com')
+        csv_file = StringIO('name\ncaf\xe9\n')
+        r = self.app.post('/pantry/2/category/5/item/add/upload/',
+                          data={'items_file' : (csv_file, 'items.csv')})
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue('The file is not valid UTF-8.' in r.data, r.data)
+
+    def testUploadItemsJSON(self):
+        '''Test adding the items in an uploaded JSON file.
+        '''
+        self.setSession('B@bbb.com')
+        json_file = StringIO(json.dumps([{'name' : 'pretzels',
+                                          'quantity' : 3}]))
+        r = self.app.post('/pantry/2/category/5/item/add/upload/',
+                          data={'items_file' : (json_file, 'items.json')},
+                          follow_redirects=True)
+        self.assertTrue('pretzels' in r.data, r.data)
+        self.assertEqual(self.db_item('pretzels', 5).quantity, 3)
+
+    def testUploadItemsError(self):
+        '''Test that an invalid row is reported and nothing is added.
+        '''
+        self.setSession('B@bbb.com')
+        csv_file = StringIO('name,quantity\npretzels,3\npopcorn,lots\n')
+        r = self.app.post('/pantry/2/category/5/item/add/upload/',
+                          data={'items_file' : (csv_file, 'items.csv')},
+                          follow_redirects=True)
+        self.assertTrue('Item 2 has an invalid quantity.' in r.data, r.data)
+        self.assertEqual(self.db_item('pretzels', 5), None)
+
+    def testUploadItemsInvalidJSON(self):
+        '''Test that JSON items of the wrong type or too long are reported
+        and nothing is added.
+        '''
+        self.setSession('B@bbb.com')
+        errors = [([1], 'Item 1 has no name.'),
+                  ([{'name' : 'pretzels', 'quantity' : 2.9}],
+                   'Item 1 has an invalid quantity.'),
+                  ([{'name' : 'pretzels', 'price' : [1]}],
+                   'Item 1 has an invalid price.'),
+                  ([{'name' : 'pretzels', 'quantity' : True}],
+                   'Item 1 has an invalid quantity.'),
+                  ([{'name' : 5}], 'Item 1 has an invalid name.'),
+                  ([{'name' : 'p' * 81}],
+                   'Item 1 has a name longer than 80 characters.'),
+                  ([{'name' : 'pretzels', 'description' : 'd' * 251}],
+                   'Item 1 has a description longer than 250 characters.')]
+        for records, message in errors:
+            json_file = StringIO(json.dumps(records))
+            r = self.app.post('/pantry/2/category/5/item/add/upload/',
+                              data={'items_file' : (json_file, 'items.json')})
+            self.assertEqual(r.status_code, 200)
+            self.assertTrue(message in r.data, (message, r.data))
+        self.assertEqual(self.db_item('pretzels', 5), None)
+
+    def db_item(self, name, category_id):
+        '''Helper method to look up an item in the mock database.
+        '''
+        db = DBInterface(self.mDB, testing=True)
+        return db.get_dbobject_by_name('Item', name, category_id)
+
     def testAddItemForm(self):
         '''Test that get request displays add item form.
         '''
@@ -368,6 +921,236 @@ class TestServer(unittest.TestCase):
         r = self.setGetRequest('/pantry/1/category/1/item/1/json/')
         self.assertTrue('apple' and 'shiny and red' in r.data, r.data)
 
+    def testAuthCacheHit(self):
+        '''Test that a repeated page view is authorized from the cache.
+        '''
+        self.setSession('A@aaa.com')
+        self.setGetRequest('/pantry/1/')
+        self.assertEqual(item_server.auth_cache.get_access(1, 1), True)
+        r = self.setGetRequest('/pantry/1/')
+        self.assertTrue('vegetables' in r.data, r.data)
+        self.assertEqual(item_server.auth_cache.access.hits, 2)
+
+    def testAuthCacheInvalidatedOnDelete(self):
+        '''Test that deleting a pantry revokes the cached access check.
+        '''
+        self.setSession('A@aaa.com')
+        self.setGetRequest('/pantry/1/')
+        self.setPostRequest('/pantry/1/delete/', confirm_del=1)
+        self.assertEqual(item_server.auth_cache.get_access(1, 1), None)
+        r = self.setGetRequest('/pantry/1/')
+        self.assertTrue('You do not have access to that page.' in r.data,
+                        r.data)
+
+
+class TestCache(unittest.TestCase):
+    '''Tests the in-process caches.
+    '''
+
+    def testEviction(self):
+        '''Test that the least recently used entry is evicted.
+        '''
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual([cache.get('a'), cache.get('b'), cache.get('c')],
+                         [1, None, 3])
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def testExpiry(self):
+        '''Test that entries are not returned after their ttl.
+        '''
+        cache = LRUCache(ttl=60)
+        cache.set('a', 1, time=-1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+
+    def testExpiryClock(self):
+        '''Test that expiry follows the cache clock, so it can be controlled.
+        '''
+        now = [1000.0]
+        clock = cache_module._now
+        cache_module._now = lambda: now[0]
+        try:
+            cache = LRUCache(ttl=60)
+            cache.set('a', 1)
+            now[0] += 59
+            self.assertEqual(cache.get('a'), 1)
+            now[0] += 2
+            self.assertEqual(cache.get('a'), None)
+        finally:
+            cache_module._now = clock
+
+    def testInvalidatePantry(self):
+        '''Test that invalidating a pantry only drops checks against it.
+        '''
+        cache = AuthCache()
+        cache.set_access(1, 1, True)
+        cache.set_access(2, 1, False)
+        cache.set_access(1, 2, True)
+        cache.invalidate_pantry(1)
+        self.assertEqual([cache.get_access(1, 1), cache.get_access(2, 1),
+                          cache.get_access(1, 2)], [None, None, True])
+
+    def testNameIndex(self):
+        '''Test prefix lookups and writes applied to the name index.
+        '''
+        index = NameIndex()
+        index.build(1, 3, [(1, 'fruit'), (2, 'Fish')],
+                    [(1, 'apple'), (1, 'Apricot'), (2, 'anchovy'),
+                     (1, 'apple'), (2, 'cod')])
+        self.assertEqual(index.complete(1, 'Item', 'ap', 10),
+                         ['apple', 'Apricot'])
+        self.assertEqual(index.complete(1, 'Item', 'a', 2),
+                         ['anchovy', 'apple'])
+        self.assertEqual(index.complete(1, 'Category', 'F', 10),
+                         ['Fish', 'fruit'])
+        self.assertEqual(index.complete(2, 'Item', 'a', 10), None)
+        index.apply([({1 : 4}, [('Item', 'add', 5, 1, 'avocado', None),
+                                ('Item', 'add', None, 2, 'eel', None)]),
+                     ({1 : 5}, [('Item', 'update', 1, 1, 'pear', 'apple')]),
+                     ({1 : 6}, [('Category', 'delete', 2, 1, 'Fish',
+                                 'Fish')]),
+                     ({3 : 2}, [('Item', 'add', None, 9, 'kale', None)])])
+        self.assertEqual(index.get_version(1), 6)
+        self.assertEqual(index.complete(1, 'Item', '', 10),
+                         ['apple', 'Apricot', 'avocado', 'pear'])
+        self.assertEqual(index.complete(1, 'Category', '', 10), ['fruit'])
+        # an entry built after the commit already holds the write
+        index.apply([({1 : 6}, [('Item', 'add', None, 1, 'fig', None)])])
+        self.assertEqual(index.complete(1, 'Item', 'f', 10), [])
+        self.assertEqual(index.get_version(1), 6)
+        # the old name is needed to update a name in place
+        index.apply([({1 : 7}, [('Item', 'update', 1, 1, 'plum', None)])])
+        self.assertEqual(index.get_version(1), None)
+        # an entry that missed a write is dropped
+        index.build(1, 3, [(1, 'fruit')], [(1, 'apple')])
+        index.apply([({1 : 5}, [('Item', 'add', None, 1, 'fig', None)])])
+        self.assertEqual(index.get_version(1), None)
+
+    def testNameIndexBuiltBeforeApply(self):
+        '''Test that a write is not applied twice to an entry built by
+        another request between its commit and invalidate_written.
+        '''
+        mock = MockDB()
+        name_index = NameIndex()
+        writer = DBInterface(mock, testing=True, name_index=name_index)
+        reader = DBInterface(mock, testing=True, name_index=name_index)
+        item = writer.add_object('Item', 'banana', 'yellow', 3, 0.25, 1)
+        self.assertEqual(reader.complete_name(1, 'Item', 'ba', 10),
+                         ['banana'])
+        writer.invalidate_written()
+        writer.del_object(item)
+        writer.invalidate_written()
+        self.assertEqual(reader.complete_name(1, 'Item', 'ba', 10), [])
+        self.assertEqual(name_index.get_version(1),
+                         mock.pantries.get(1).version)
+
+    def testObjectCacheInvalidation(self):
+        '''Test that objects are read through the object cache and dropped
+        from it when written.
+        '''
+        object_cache = ObjectCache()
+        db = DBInterface(MockDB(), testing=True, object_cache=object_cache)
+        category = db.get_db_object_by_id('Category', 1)
+        self.assertIs(db.get_db_object_by_id('Category', 1), category)
+        self.assertEqual((object_cache.hits, object_cache.misses), (1, 1))
+        db.update_object(category)
+        db.get_db_object_by_id('Category', 1)
+        self.assertEqual((object_cache.hits, object_cache.misses), (1, 2))
+        db.get_db_object_by_id('Item', 1)
+        other = db.get_db_object_by_id('Category', 3)
+        db.del_object(category)
+        self.assertEqual(object_cache.get('Item', 1), None)
+        # only the deleted category and its items are dropped
+        self.assertIs(object_cache.get('Category', 3), other)
+        self.assertEqual(object_cache.stats()['hit_ratio'], 2.0 / 7)
+
+    def testNoFillFromReplica(self):
+        '''Test that an instance reading from a replica uses entries of the
+        shared caches without storing what it reads in them.
+        '''
+        mock = MockDB()
+        auth_cache = AuthCache()
+        object_cache = ObjectCache()
+        name_index = NameIndex()
+        primary = DBInterface(mock, testing=True, auth_cache=auth_cache,
+                              object_cache=object_cache,
+                              name_index=name_index)
+        replica = DBInterface(mock, testing=True, auth_cache=auth_cache,
+                              object_cache=object_cache,
+                              name_index=name_index, fill_caches=False)
+        replica.get_db_object_by_id('Category', 1)
+        replica.get_user_by_email('A@aaa.com')
+        replica.user_can_access(1, 1)
+        self.assertEqual(replica.complete_name(1, 'Item', 'b', 10),
+                         ['broccoli'])
+        self.assertEqual(object_cache.get('Category', 1), None)
+        self.assertEqual(auth_cache.get_user('A@aaa.com'), None)
+        self.assertEqual(auth_cache.get_access(1, 1), None)
+        self.assertEqual(name_index.get_version(1), None)
+        category = primary.get_db_object_by_id('Category', 2)
+        self.assertIs(replica.get_db_object_by_id('Category', 2), category)
+        self.assertEqual(object_cache.hits, 1)
+
+class TestEngine(unittest.TestCase):
+    '''Tests engine configuration and pool metrics.
+    '''
+
+    def testSettingsFromEnvironment(self):
+        '''Test that environment values are parsed and overrides win.
+        '''
+        environ = {'CATALOG_DATABASE_URL' : 'postgresql://u@h/db',
+                   'CATALOG_POOL_SIZE' : '20',
+                   'CATALOG_POOL_PRE_PING' : 'true',
+                   'CATALOG_STATEMENT_TIMEOUT' : '5000'}
+        settings = engine_settings(environ=environ, max_overflow=0)
+        self.assertEqual(settings['url'], 'postgresql://u@h/db')
+        self.assertEqual(settings['pool_size'], 20)
+        self.assertEqual(settings['max_overflow'], 0)
+        self.assertEqual(settings['pool_pre_ping'], True)
+        self.assertEqual(settings['statement_timeout'], 5000)
+        testing = engine_settings(testing=True, environ=environ)
+        self.assertEqual(testing['url'], 'sqlite:///test_item_catalog.db')
+
+    def testReadOnlySessions(self):
+        '''Test that read only sessions do not autoflush and connect to the
+        replica when there is one.
+        '''
+        session_maker = DBInterface.make_session_factory(testing=True,
+                                                         read_only=True)
+        self.assertFalse(session_maker().autoflush)
+        engine = make_engine(read_only=True,
+                             replica_url='sqlite:///replica.db')
+        self.assertEqual(str(engine.url), 'sqlite:///replica.db')
+        engine = make_engine(replica_url='sqlite:///replica.db',
+                             url='sqlite:///primary.db')
+        self.assertEqual(str(engine.url), 'sqlite:///primary.db')
+
+    def testPoolMetrics(self):
+        '''Test checkout counts reported for a queue pool.
+        '''
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=1)
+        first = engine.connect()
+        second = engine.connect()
+        metrics = pool_metrics(engine)
+        self.assertEqual((metrics['checked_out'], metrics['overflow'],
+                          metrics['checkouts']), (2, 1, 2))
+        first.close()
+        second.close()
+        self.assertEqual(pool_metrics(engine)['checked_out'], 0)
+
+    def testPrePing(self):
+        '''Test that a pre-pinged engine still executes statements.
+        '''
+        engine = make_engine(testing=True, pool_pre_ping=True)
+        self.assertEqual(engine.scalar('SELECT 2'), 2)
+
+
 class TestDatabase(unittest.TestCase):
     def setUp(self):
         mock = Mock()
@@ -375,6 +1158,9 @@ class TestDatabase(unittest.TestCase):
         session_maker = DBInterface.make_session_factory(testing=True)
         session = session_maker()
         self.db = DBInterface(session)
+        # the populator writes rows without DBInterface
+        self.db.rebuild_pantry_stats()
+        self.db._commit()
     
     # Test get by id ------
         
@@ -436,6 +1222,59 @@ class TestDatabase(unittest.TestCase):
         itemObjList = self.db.get_all_objects('Item', 1)
         self.assertEqual(expected, [item.name for item in itemObjList])
         
+    # Test composite loaders
+
+    def testGetCategoryWithItems(self):
+        '''Test that a category and its items are loaded in one statement.
+        '''
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            category, items = self.db.get_category_with_items(3)
+            self.assertEqual(category.name, 'desserts')
+            self.assertEqual(['seltzer', 'cake'], [item.name for item in items])
+        self.assertEqual(len(statements), 1, statements)
+
+    def testGetItemWithCategory(self):
+        '''Test loading an item together with its category.
+        '''
+        item, category = self.db.get_item_with_category(4)
+        self.assertEqual(item.name, 'steak')
+        self.assertEqual(category.name, 'meat')
+        self.assertEqual(category.id, item.parent_id)
+
+    def testGetPage(self):
+        '''Test paging through the items of category 1.
+        '''
+        page, next_after = self.db.get_page('Item', 1, 1)
+        self.assertEqual(['apple'], [item.name for item in page])
+        page, next_after = self.db.get_page('Item', 1, 1, next_after)
+        self.assertEqual(['broccoli'], [item.name for item in page])
+        self.assertEqual(next_after, None)
+
+    def testIterAllObjects(self):
+        '''Test iterating over the items of category 1 in small batches.
+        '''
+        items = self.db.iter_all_objects('Item', 1, batch_size=1)
+        self.assertEqual(['apple', 'broccoli'], [item.name for item in items])
+        self.assertEqual(self.db.get_db_object_by_id('Item', 1).serialize,
+                         {'name' : 'apple', 'id' : 1,
+                          'description' : 'shiny and red', 'quantity' : 5,
+                          'price' : 1, 'parent_id' : 1})
+
+    def testGetPantryTree(self):
+        '''Test that the tree of pantry 1 is built with two statements.
+        '''
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            tree = self.db.get_pantry_tree(1)
+        self.assertEqual(len(statements), 2, statements)
+        self.assertEqual([(category['name'],
+                           [item['name'] for item in category['items']])
+                          for category in tree],
+                         [('vegetables', ['apple', 'broccoli']),
+                          ('starches', ['potato']),
+                          ('desserts', ['seltzer', 'cake'])])
+        self.assertEqual(tree[0]['items'][0],
+                         self.db.get_db_object_by_id('Item', 1).serialize)
+
     # Test get object by name, associated with a specific parent.
     
     def testGetPantryByName(self):
@@ -487,6 +1326,16 @@ class TestDatabase(unittest.TestCase):
         pantries = self.db.get_authorized_pantries(user)
         self.assertEqual(['Pantry_B'], [pantry.name for pantry in pantries])
     
+    # Test checking access to a single pantry
+
+    def testUserCanAccess(self):
+        '''Test access to owned, shared, foreign and missing pantries.
+        '''
+        self.assertTrue(self.db.user_can_access(1, 1))
+        self.assertTrue(self.db.user_can_access(1, 2))
+        self.assertFalse(self.db.user_can_access(2, 1))
+        self.assertFalse(self.db.user_can_access(3, 17))
+    
     # Test adding objects
     
     def testAddUser(self):
@@ -514,6 +1363,17 @@ class TestDatabase(unittest.TestCase):
         self.assertTrue(actual in pantries, "Pantry was not added to "\
                         "user pantries list.")
         
+    def testAddPantryLoadedOwner(self):
+        '''Test that a new pantry shows up in its owner's already loaded
+        pantries before the session is committed.
+        '''
+        user_c = self.db.get_user_by_email('C@ccc.com')
+        self.assertEqual(len(self.db.get_authorized_pantries(user_c)), 1)
+        self.db.add_object('Pantry', 'Pantry_E', 3)
+        self.assertEqual(['Pantry_C', 'Pantry_E'], [pantry.name for pantry
+                         in self.db.get_authorized_pantries(user_c)])
+        self.db._commit()
+
     def testAddCategory(self):
         '''Test add category to Pantry B
         '''
@@ -543,6 +1403,254 @@ class TestDatabase(unittest.TestCase):
         vegetable_category = self.db.get_db_object_by_id('Category', 1)
         self.assertTrue(actual in vegetable_category.children)
     
+    def testAddItemMissingParent(self):
+        '''Test that the foreign key rejects an item whose category does not
+        exist, which SQLite only enforces when enabled on the connection.
+        '''
+        self.assertFalse(self.db.category_in_pantry(99, 1))
+        self.assertFalse(self.db.category_in_pantry(4, 1))
+        self.assertTrue(self.db.category_in_pantry(1, 1))
+        session = self.db.db.session
+        with self.assertRaises(IntegrityError):
+            session.execute(Item.__table__.insert().values(
+                name='grub', parent_id=99, version=0))
+        session.rollback()
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'grub', 99),
+                         None)
+
+    def testAddItemNoParentLoad(self):
+        '''Test that adding an item does not load its category or the other
+        items in it. The only other statements bump the pantry version and
+        its counters.
+        '''
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            self.db.add_object('Item', 'grub', 'a great food', 3, 4, 1)
+            self.db._commit()
+        self.assertEqual([statement.split()[0] for statement in statements],
+                         ['UPDATE', 'UPDATE', 'INSERT'])
+
+    def testPantryVersion(self):
+        '''Test that writes under a pantry increment its version, which is
+        read with one query.
+        '''
+        version, modified = self.db.get_pantry_version(1)
+        self.db.add_object('Item', 'grub', 'a great food', 3, 4, 1)
+        category = self.db.get_db_object_by_id('Category', 2)
+        category.name = 'tubers'
+        self.db.update_object(category)
+        self.db._commit()
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            new_version, new_modified = self.db.get_pantry_version(1)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(new_version, version + 2)
+        self.assertTrue(new_modified >= modified)
+        self.assertEqual(self.db.get_pantry_version(2)[0], 0)
+
+    def testPantrySummary(self):
+        '''Test that the totals of a pantry are computed in one query, and
+        that empty categories are included.
+        '''
+        self.db.add_object('Category', 'spices', 1)
+        self.db._commit()
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            summary = self.db.get_pantry_summary(1)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([(category['name'], category['item_count'],
+                           category['total_quantity'],
+                           category['total_value'])
+                          for category in summary['categories']],
+                         [('vegetables', 2, 15, 55), ('starches', 1, 50, 1000),
+                          ('desserts', 2, 16, 30), ('spices', 0, 0, 0)])
+        self.assertEqual((summary['item_count'], summary['total_quantity'],
+                          summary['total_value']), (5, 81, 1085))
+
+    def testPantryStats(self):
+        '''Test that the counters kept as objects are written match the
+        counters rebuilt from the rows, and that reading them is one query.
+        '''
+        self.db.add_object('Item', 'grub', 'a great food', 3, 4, 1)
+        item = self.db.get_dbobject_by_name('Item', 'apple', 1)
+        item.quantity = 10
+        self.db.update_object(item)
+        self.db.del_object(self.db.get_db_object_by_id('Category', 3))
+        self.db.add_objects('Item', [{'name' : 'pear', 'quantity' : 2,
+                                      'price' : 5, 'parent_id' : 2}])
+        self.db.add_object('Pantry', 'Pantry_E', 1)
+        self.db._commit()
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            stats = self.db.get_pantry_stats([1, 2, 3, 5])
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(stats[1], {'category_count' : 2, 'item_count' : 5,
+                                    'total_value' : 1082})
+        self.assertEqual(stats[5], {'category_count' : 0, 'item_count' : 0,
+                                    'total_value' : 0})
+        self.assertEqual(self.db.rebuild_pantry_stats(), 5)
+        self.db._commit()
+        self.assertEqual(self.db.get_pantry_stats([1, 2, 3, 5]), stats)
+
+    def testPantryStatsMissingRow(self):
+        '''Test that the counters of a pantry without a stats row are computed
+        from its rows, and that writes to it leave them right.
+        '''
+        self.db.db.session.query(PantryStats).filter_by(pantry_id=1).delete()
+        self.db._commit()
+        self.db.add_object('Item', 'grub', 'a great food', 3, 4, 1)
+        self.db._commit()
+        self.assertEqual(self.db.get_pantry_stats([1, 2])[1],
+                         {'category_count' : 3, 'item_count' : 6,
+                          'total_value' : 1097})
+
+    def testPantryStatsUnloadedItem(self):
+        '''Test that updating an item whose old values were never loaded
+        recomputes the value of its pantry.
+        '''
+        item = self.db.get_dbobject_by_name('Item', 'apple', 1)
+        self.db.db.session.expire(item)
+        item.price = 2
+        self.db.update_object(item)
+        self.db._commit()
+        self.assertEqual(self.db.get_pantry_stats([1])[1]['total_value'],
+                         1090)
+
+    def testCompleteName(self):
+        '''Test that writes committed through DBInterface update the name
+        index in place, and that writes made elsewhere rebuild it.
+        '''
+        self.db.name_index = NameIndex()
+        self.assertEqual(self.db.complete_name(1, 'Item', 'b', 10),
+                         ['broccoli'])
+        self.db.add_object('Item', 'beans', 'green', 1, 1, 2)
+        item = self.db.get_dbobject_by_name('Item', 'apple', 1)
+        item.name = 'banana'
+        self.db.update_object(item)
+        self.db.del_object(self.db.get_dbobject_by_name('Item', 'broccoli', 1))
+        self.db.add_objects('Item', [{'name' : 'bread', 'parent_id' : 3}])
+        self.db.add_object('Category', 'bakery', 1)
+        self.db._commit()
+        self.db.invalidate_written()
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            names = self.db.complete_name(1, 'Item', 'B', 10)
+            categories = self.db.complete_name(1, 'Category', 'b', 10)
+        self.assertEqual((names, categories),
+                         (['banana', 'beans', 'bread'], ['bakery']))
+        self.assertEqual(len(statements), 2)
+        other = DBInterface(self.db.db.session)
+        other.add_object('Item', 'bagel', 'round', 1, 1, 3)
+        other._commit()
+        self.assertEqual(self.db.complete_name(1, 'Item', 'ba', 10),
+                         ['bagel', 'banana'])
+        self.assertEqual(self.db.complete_name(99, 'Item', 'ba', 10), None)
+
+    def testItemPageSorted(self):
+        '''Test paging through items sorted by price, including items without
+        a price, and that the filters and the sort are done in SQL.
+        '''
+        self.db.add_objects('Item', [{'name' : name, 'price' : price,
+                                      'quantity' : 1, 'parent_id' : 1}
+                                     for name, price in (('grub', 5),
+                                                         ('kale', None),
+                                                         ('leek', 5),
+                                                         ('okra', None))])
+        self.db._commit()
+        names, after = [], None
+        while True:
+            items, after = self.db.get_item_page(1, 2, 'price', after)
+            names += [item.name for item in items]
+            if after is None:
+                break
+        self.assertEqual(names, ['apple', 'broccoli', 'grub', 'leek', 'kale',
+                                 'okra'])
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            items, _ = self.db.get_item_page(1, 10, 'name', None,
+                                             {'max_price' : 5,
+                                              'quantity_below' : 10})
+        self.assertEqual([item.name for item in items],
+                         ['apple', 'grub', 'leek'])
+        self.assertEqual(len(statements), 1)
+        plan = self.db.db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM item WHERE parent_id = 1 '
+            'AND price IS NOT NULL ORDER BY price, id').fetchall()
+        self.assertTrue('ix_item_parent_id_price_id' in str(plan), plan)
+        self.assertFalse('TEMP B-TREE' in str(plan), plan)
+
+    def testSearchItems(self):
+        '''Test that the search index follows items as they are added, bulk
+        added, edited and deleted, and that only the given pantries are
+        searched.
+        '''
+        self.db.add_object('Item', 'grub', 'high in fiber', 3, 4, 1)
+        self.db.add_objects('Item', [{'name' : 'kale', 'parent_id' : 2,
+                                      'description' : 'leafy, high in iron'}])
+        item = self.db.get_dbobject_by_name('Item', 'apple', 1)
+        item.name = 'pear'
+        self.db.update_object(item)
+        self.db.del_object(self.db.get_dbobject_by_name('Item', 'potato', 2))
+        self.db._commit()
+        results, more = self.db.search_items([1], 'High', 10)
+        self.assertEqual((sorted(result['name'] for result in results), more),
+                         (['grub', 'kale'], False))
+        self.assertEqual(results[0]['pantry_id'], 1)
+        self.assertEqual(self.db.search_items([1], 'apple', 10), ([], False))
+        results, _ = self.db.search_items([1], 'pear shiny', 10)
+        self.assertEqual([result['id'] for result in results], [item.id])
+        results, more = self.db.search_items([1, 3], 'high', 2)
+        self.assertTrue(more)
+        results += self.db.search_items([1, 3], 'high', 2, 2)[0]
+        self.assertEqual(sorted(result['name'] for result in results),
+                         ['grub', 'kale', 'steak'])
+        self.assertEqual(self.db.search_items([1], '!?', 10), ([], False))
+
+    def testChangesSince(self):
+        '''Test that only the categories and items written after a version
+        are returned, with tombstones for deleted ones.
+        '''
+        version = self.db.get_changes(1)['version']
+        self.db.add_object('Item', 'grub', 'a great food', 3, 4, 1)
+        category = self.db.get_db_object_by_id('Category', 2)
+        category.name = 'tubers'
+        self.db.update_object(category)
+        self.db.del_object(self.db.get_dbobject_by_name('Item', 'apple', 1))
+        self.db.add_objects('Item', [{'name' : 'pear', 'parent_id' : 3}])
+        self.db._commit()
+        changes = self.db.get_changes(1, version)
+        self.assertEqual(changes['version'], version + 4)
+        self.assertEqual([category['name'] for category
+                          in changes['categories']], ['tubers'])
+        self.assertEqual([item['name'] for item in changes['items']],
+                         ['grub', 'pear'])
+        self.assertEqual(changes['deleted'], [{'kind' : 'Item', 'id' : 1,
+                                               'version' : version + 3}])
+        self.assertEqual(self.db.get_changes(1, version + 4)['items'], [])
+        self.assertEqual(len(self.db.get_changes(1)['categories']), 3)
+
+    def testAddItems(self):
+        '''Test bulk adding items, validating parents with one query and
+        inserting with one statement.
+        '''
+        rows = [{'name' : 'grub', 'description' : 'a great food',
+                 'quantity' : 3, 'price' : 4, 'parent_id' : 1},
+                {'name' : 'kale', 'quantity' : 1, 'price' : None,
+                 'parent_id' : 2}]
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            self.assertEqual(self.db.add_objects('Item', rows), 2)
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('INSERT')]), 1,
+                         statements)
+        self.db._commit()
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'grub', 1)
+                         .description, 'a great food')
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'kale', 2)
+                         .quantity, 1)
+
+    def testAddItemsMissingParent(self):
+        '''Test that bulk adding items to a missing category fails.
+        '''
+        rows = [{'name' : 'grub', 'parent_id' : 1},
+                {'name' : 'kale', 'parent_id' : 17}]
+        self.assertRaises(ValueError, self.db.add_objects, 'Item', rows)
+        self.assertRaises(ValueError, self.db.add_objects, 'Pantry',
+                          [{'name' : 'Pantry_E', 'parent_id' : 1}])
+
     # Test deleting objects
     def testDelUserA(self):
         '''Test deleting user A. Make sure the delete cascades.
@@ -584,6 +1692,123 @@ class TestDatabase(unittest.TestCase):
         self.assertEquals(self.db.get_dbobject_by_name('Category', 'veggies', 2),
                           None)
         
+    def testDelPantryBulk(self):
+        '''Test that deleting a pantry does not load its children and uses
+        one statement per table.
+        '''
+        pantry_A = self.db.get_db_object_by_id('Pantry', 1)
+        with StatementRecorder(self.db.db.session.get_bind()) as statements:
+            self.db.del_object(pantry_A)
+            self.db._commit()
+        self.assertEqual([statement.split()[0] for statement in statements],
+                         ['DELETE'] * 6)
+        self.assertEqual(self.db.get_all_objects('Category', 1), [])
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'potato', 2),
+                         None)
+        self.assertFalse(self.db.user_can_access(1, 1))
+        self.assertEqual(len(self.db.get_all_objects('Item', 5)), 1)
+
+    def testScheduleDeletePantry(self):
+        '''Test that a pantry is hidden at once and deleted by the job.
+        '''
+        pantry_A = self.db.get_db_object_by_id('Pantry', 1)
+        job = self.db.schedule_delete(pantry_A, 1)
+        self.db._commit()
+        self.assertEqual((job.kind, job.target_id, job.status),
+                         ('Pantry', 1, 'pending'))
+        self.assertFalse(self.db.user_can_access(1, 1))
+        self.assertEqual(self.db.get_dbobject_by_name('Pantry', 'Pantry_A', 1),
+                         None)
+        self.assertEqual(['Pantry_D'], [pantry.name for pantry
+                                        in self.db.get_all_objects('Pantry', 1)])
+        self.assertEqual(len(self.db.get_all_objects('Category', 1)), 3)
+        self.db._close()
+        session_maker = DBInterface.make_session_factory(testing=True)
+        self.assertEqual(run_pending_jobs(session_maker, batch_size=2), 1)
+        job = self.db.get_db_object_by_id('Job', job.id)
+        # 5 items, 3 categories, the pantry and its counters
+        self.assertEqual((job.status, job.progress), ('done', 10))
+        self.assertEqual(self.db.get_all_objects('Category', 1), [])
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'potato', 2),
+                         None)
+        self.assertEqual(len(self.db.get_all_objects('Item', 5)), 1)
+
+    def testScheduleDeleteUser(self):
+        '''Test deleting user A in the background keeps the shared pantry.
+        '''
+        user_A = self.db.get_user_by_email('A@aaa.com')
+        self.db.schedule_delete(user_A, 1)
+        self.db._commit()
+        self.assertEqual(self.db.get_authorized_pantries(user_A), [])
+        self.db._close()
+        session_maker = DBInterface.make_session_factory(testing=True)
+        run_pending_jobs(session_maker)
+        self.assertEqual(self.db.get_user_by_email('A@aaa.com'), None)
+        self.assertEqual(self.db.get_all_objects('Pantry', 1), [])
+        self.assertTrue(self.db.user_can_access(2, 2))
+
+    def testScheduleDeleteUserPantryAdded(self):
+        '''Test that a user is marked deleted at once, and that a pantry added
+        for the user before the job runs is deleted with the user.
+        '''
+        user_A = self.db.get_user_by_email('A@aaa.com')
+        job_id = self.db.schedule_delete(user_A, 1).id
+        self.db._commit()
+        self.assertTrue(self.db.get_user_by_email('A@aaa.com').deleted)
+        self.db.add_object('Pantry', 'Pantry_E', 1)
+        self.db._commit()
+        self.db._close()
+        session_maker = DBInterface.make_session_factory(testing=True)
+        run_pending_jobs(session_maker)
+        self.assertEqual(self.db.get_db_object_by_id('Job', job_id).status,
+                         'done')
+        self.assertEqual(self.db.get_user_by_email('A@aaa.com'), None)
+        self.assertEqual(self.db.get_all_objects('Pantry', 1), [])
+
+    def testUploadItemsNonASCII(self):
+        '''Test that CSV cells are decoded, so non-ASCII items are stored and
+        lengths are counted in characters.
+        '''
+        description = u'\xe9' * 200
+        upload = FileStorage(StringIO((u'name,description\ncaf\xe9,%s\n'
+                                       % description).encode('utf-8')),
+                             'items.csv')
+        rows = item_server.parse_item_rows(upload, 1)
+        self.assertEqual(self.db.add_objects('Item', rows), 1)
+        self.db._commit()
+        item = self.db.get_dbobject_by_name('Item', u'caf\xe9', 1)
+        self.assertEqual(item.description, description)
+
+    def testGetJobMissing(self):
+        '''Test that an unknown job id is reported as None, so the job view
+        answers 404.
+        '''
+        self.assertEqual(self.db.get_job(999), None)
+        pantry_A = self.db.get_db_object_by_id('Pantry', 1)
+        job_id = self.db.schedule_delete(pantry_A, 1).id
+        self.db._commit()
+        self.assertEqual(self.db.get_job(job_id).target_id, 1)
+
+    def testAbandonedJobReclaimed(self):
+        '''Test that a running job whose worker died is claimed again once
+        its lease expires, and that the new worker finishes the purge.
+        '''
+        pantry_A = self.db.get_db_object_by_id('Pantry', 1)
+        job_id = self.db.schedule_delete(pantry_A, 1).id
+        self.db._commit()
+        self.db._close()
+        session_maker = DBInterface.make_session_factory(testing=True)
+        session = session_maker()
+        self.assertEqual(DBInterface(session).claim_next_job(300), job_id)
+        session.commit()
+        session.close()
+        # the worker died without deleting anything, its lease is still valid
+        self.assertEqual(run_pending_jobs(session_maker), 0)
+        self.assertEqual(run_pending_jobs(session_maker, lease=0), 1)
+        job = self.db.get_db_object_by_id('Job', job_id)
+        self.assertEqual((job.status, job.progress), ('done', 10))
+        self.assertEqual(self.db.get_all_objects('Category', 1), [])
+
     def testDelCategory(self):
         '''Test deleting fuit category from Pantry C
         '''
@@ -618,6 +1843,118 @@ class TestDatabase(unittest.TestCase):
         self.assertNotEqual(len_before, len_after,
                             'len before was {0} and len after was {1}'\
                             .format(len_before, len_after))
+
+    # Test the auth cache
+
+    def testCachedUserNoQuery(self):
+        '''Test that a cached user is returned in a new session without
+        querying the database.
+        '''
+        auth_cache = AuthCache()
+        session_maker = DBInterface.make_session_factory(testing=True)
+        first = DBInterface(session_maker(), auth_cache=auth_cache)
+        first.get_user_by_email('A@aaa.com')
+        first._close()
+        second = DBInterface(session_maker(), auth_cache=auth_cache)
+        with StatementRecorder(second.db.session.get_bind()) as statements:
+            user = second.get_user_by_email('A@aaa.com')
+            self.assertEqual((user.id, user.name), (1, 'A'))
+        self.assertEqual(statements, [])
+        self.assertEqual(sorted(pantry.name for pantry in user.children),
+                         ['Pantry_A', 'Pantry_B', 'Pantry_D'])
+        second._close()
+
+    def testCachedObjectNoQuery(self):
+        '''Test that a cached category is returned in a new session without
+        querying the database, and that an update is seen after the commit.
+        '''
+        object_cache = ObjectCache()
+        session_maker = DBInterface.make_session_factory(testing=True)
+        first = DBInterface(session_maker(), object_cache=object_cache)
+        first.get_db_object_by_id('Category', 1)
+        first._close()
+        second = DBInterface(session_maker(), object_cache=object_cache)
+        with StatementRecorder(second.db.session.get_bind()) as statements:
+            category = second.get_db_object_by_id('Category', 1)
+            self.assertEqual((category.id, category.name, category.parent_id),
+                             (1, 'vegetables', 1))
+        self.assertEqual(statements, [])
+        category.name = 'greens'
+        second.update_object(category)
+        second._commit()
+        second.invalidate_written()
+        second._close()
+        third = DBInterface(session_maker(), object_cache=object_cache)
+        self.assertEqual(third.get_db_object_by_id('Category', 1).name,
+                         'greens')
+        self.assertEqual(len(third.get_db_object_by_id('Category',
+                                                       1).children), 2)
+        third._close()
+
+    def testCachedObjectDeleted(self):
+        '''Test that updating a cached category whose row was deleted since
+        drops its cache entry, and that deleting a pantry drops the entries
+        of its children only.
+        '''
+        object_cache = ObjectCache()
+        session_maker = DBInterface.make_session_factory(testing=True)
+        first = DBInterface(session_maker(), object_cache=object_cache)
+        first.get_db_object_by_id('Category', 1)
+        first.get_db_object_by_id('Category', 4)
+        first.get_db_object_by_id('Item', 7)
+        first._close()
+        self.db.db.session.query(Item).filter_by(parent_id=1).delete()
+        self.db.db.session.query(Category).filter_by(id=1).delete()
+        self.db._commit()
+        second = DBInterface(session_maker(), object_cache=object_cache)
+        category = second.get_db_object_by_id('Category', 1)
+        category.name = 'greens'
+        self.assertRaises(StaleDataError, second.update_object, category)
+        second.db.session.rollback()
+        self.assertEqual(object_cache.get('Category', 1), None)
+        pantry = second.get_db_object_by_id('Pantry', 1)
+        second.del_object(pantry)
+        self.assertEqual(object_cache.get('Item', 7), None)
+        self.assertNotEqual(object_cache.get('Category', 4), None)
+        second._close()
+
+    # Test migrating an existing database
+
+    def testMigrateAddsIndexes(self):
+        '''Test that a migration restores a missing index and column and keeps
+        the data.
+        '''
+        engine = create_engine('sqlite:///test_item_catalog.db')
+        engine.execute('DROP INDEX ix_item_parent_id_name_id')
+        engine.execute('ALTER TABLE job DROP COLUMN error')
+        create_db(testing=True, migrate=True)
+        index_names = [index['name'] for index
+                       in inspect(engine).get_indexes('item')]
+        self.assertTrue('ix_item_parent_id_name_id' in index_names,
+                        index_names)
+        self.assertTrue('error' in [column['name'] for column
+                                    in inspect(engine).get_columns('job')])
+        self.assertEqual(self.db.get_dbobject_by_name('Item', 'apple', 1).name,
+                         'apple')
+
+    def testMigrateRebuildsPantryStats(self):
+        '''Test that a migration fills the counters of existing pantries.
+        '''
+        self.db._close()
+        engine = create_engine('sqlite:///test_item_catalog.db')
+        engine.execute('DROP TABLE pantry_stats')
+        create_db(testing=True, migrate=True)
+        self.assertEqual(engine.execute('SELECT count(*) FROM pantry_stats')
+                         .scalar(), 4)
+        self.assertEqual(self.db.get_pantry_stats([1])[1]['item_count'], 5)
+
+    def testUserEmailUnique(self):
+        '''Test that email addresses are covered by a unique index.
+        '''
+        indexes = inspect(create_engine('sqlite:///test_item_catalog.db'))\
+                  .get_indexes('users')
+        self.assertEqual([(index['name'], bool(index['unique']))
+                          for index in indexes], [('ix_users_email', True)])
     
     def teardown(self):
         self.db._close()
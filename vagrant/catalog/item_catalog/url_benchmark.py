@@ -0,0 +1,56 @@
+'''
+This module compares the cost of building the links of a listing with
+url_for and with row_url from item_server, for the view, edit and delete
+links of every row of an item table. Like the server, it must be run from
+the item_catalog directory, which holds client_secrets.json:
+    python url_benchmark.py [rows]
+'''
+import sys
+import timeit
+
+from flask import url_for
+from item_server import app, row_url
+
+ROWS = 10000
+
+# the links of each row of item_table.html
+ROW_LINKS = ('display_item', 'edit_item', 'del_item')
+
+
+def build_links(url_function, rows):
+    '''Build the links of a table of items.
+    @param url_function: url_for or row_url
+    @param rows: number of rows in the table
+    @return: the list of links
+    '''
+    links = []
+    for item_id in xrange(1, rows + 1):
+        for endpoint in ROW_LINKS:
+            links.append(url_function(endpoint, pantry_id=1, category_id=1,
+                                      item_id=item_id))
+    return links
+
+
+def compare(rows=ROWS, repeat=3):
+    '''Time building the links of a table with both functions.
+    @param rows: number of rows in the table
+    @param repeat: the best of this many runs is reported
+    @return: dict mapping the function name to the time taken in seconds
+    '''
+    times = {}
+    with app.test_request_context():
+        # both functions must build the same links
+        assert build_links(url_for, 10) == build_links(row_url, 10)
+        for url_function in (url_for, row_url):
+            times[url_function.__name__] = min(timeit.repeat(
+                lambda: build_links(url_function, rows), number=1,
+                repeat=repeat))
+    return times
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    times = compare(rows)
+    for name in ('url_for', 'row_url'):
+        print '%s: %.3f s for %d rows' % (name, times[name], rows)
+    print 'row_url is %.1f times faster' % (times['url_for'] / times['row_url'])